@@ -0,0 +1,266 @@
+"""
+Asyncio clients for the Yubico validation service. These build requests
+exactly like their counterparts in :mod:`yubiotp.client`, but send them with
+non-blocking asyncio streams, so a single event loop can keep many
+verifications in flight.
+
+The async clients support the replay cache, observers, and the circuit
+breaker of the synchronous clients, but not everything else:
+
+* Each request opens its own connection, so the ``pool`` attribute is
+  ignored.
+* Socket timeouts are not adaptive. Pass a ``timeout`` to
+  ``verify()`` instead.
+* :class:`AsyncYubiClient20` does not hedge requests: setting ``base_urls``
+  raises ``NotImplementedError``.
+
+>>> client = AsyncYubiClient20(1, b'secret')
+>>> client.url('cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl', 'nonce0123456789a')
+'http://api.yubico.com/wsapi/2.0/verify?id=1&otp=cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl&nonce=nonce0123456789a&h=EXw9lJYB%2FVsldeZPBcKcwNp8rVs%3D'
+"""
+
+import asyncio
+from email.parser import BytesHeaderParser
+import ssl
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from .client import (
+    LocalResponse,
+    YubiClient10,
+    YubiClient11,
+    YubiClient20,
+    YubiResponse,
+)
+from .metrics import NULL_TRACE
+
+__all__ = ['AsyncYubiClient10', 'AsyncYubiClient11', 'AsyncYubiClient20']
+
+
+class AsyncClientMixin(object):
+    """
+    Replaces the blocking verify methods of a validation client with
+    coroutines.
+    """
+
+    _ssl_context = None
+
+    async def verify(self, token, timeout=None):
+        """
+        Verify a single Yubikey OTP against the validation service.
+
+        :param str token: A modhex-encoded YubiKey OTP, as generated by a YubiKey
+            device.
+        :param float timeout: The maximum number of seconds to wait for the
+            whole exchange, or ``None`` to wait indefinitely.
+
+        :returns: A response from the validation service, or a
+            :class:`~yubiotp.client.LocalResponse` if the token was answered
+            locally.
+        :rtype: :class:`~yubiotp.client.YubiResponse`
+
+        :raises: :exc:`asyncio.TimeoutError` if the request times out.
+        :raises: :exc:`urllib.error.HTTPError` for a non-200 HTTP response.
+        """
+        trace = self._start_trace(token)
+        base_url = self.base_url
+
+        response = self._check_replay_cache(token)
+        if response is not None:
+            self._finish_trace(trace, None, response)
+            return response
+
+        try:
+            nonce = self.nonce()
+            trace.mark('nonce')
+
+            url = self.url(token, nonce)
+            trace.mark('url')
+        except Exception as e:
+            self._finish_trace(trace, base_url, error=e)
+            raise
+
+        stats = self._get_server_stats(base_url)
+        if not stats.allow_request(self.reset_timeout):
+            response = LocalResponse('CIRCUIT_OPEN', token, nonce)
+            self._finish_trace(trace, base_url, response)
+            return response
+
+        start = time.perf_counter()
+        try:
+            body = await asyncio.wait_for(
+                _fetch(url, self._get_ssl_context(url), trace), timeout
+            )
+            response = YubiResponse(body, self.api_key, token, nonce)
+            trace.mark('parse')
+        except asyncio.CancelledError:
+            stats.cancel_probe()
+            raise
+        except Exception as e:
+            stats.record(
+                time.perf_counter() - start,
+                error=True,
+                threshold=self.failure_threshold,
+            )
+            self._finish_trace(trace, base_url, error=e)
+            raise
+
+        stats.record(time.perf_counter() - start)
+        stats.win()
+
+        self._update_replay_cache(token, response)
+        self._finish_trace(trace, base_url, response)
+
+        return response
+
+    async def verify_many(self, tokens, concurrency=100, timeout=None):
+        """
+        Verify many tokens concurrently.
+
+        :param tokens: An iterable of tokens.
+        :param int concurrency: The maximum number of requests in flight.
+        :param float timeout: The timeout for each individual request.
+
+        :returns: For each token, in order, either a
+            :class:`~yubiotp.client.YubiResponse` or the exception raised while
+            verifying it.
+        :rtype: list
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def verify_one(token):
+            async with semaphore:
+                try:
+                    return await self.verify(token, timeout)
+                except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+                    return e
+
+        return await asyncio.gather(*(verify_one(token) for token in tokens))
+
+    def _get_ssl_context(self, url):
+        """
+        Returns the client's SSL context for an https URL, or ``None``. The
+        context is created once: loading the CA certificates reads from disk,
+        which would otherwise block the event loop on every request.
+        """
+        if urlsplit(url).scheme != 'https':
+            return None
+
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+
+        return self._ssl_context
+
+
+class AsyncYubiClient10(AsyncClientMixin, YubiClient10):
+    """
+    Asyncio client for the Yubico validation service, version 1.0. See
+    :class:`~yubiotp.client.YubiClient10` for the parameters.
+    """
+
+    pass
+
+
+class AsyncYubiClient11(AsyncClientMixin, YubiClient11):
+    """
+    Asyncio client for the Yubico validation service, version 1.1. See
+    :class:`~yubiotp.client.YubiClient11` for the parameters.
+    """
+
+    pass
+
+
+class AsyncYubiClient20(AsyncClientMixin, YubiClient20):
+    """
+    Asyncio client for the Yubico validation service, version 2.0. See
+    :class:`~yubiotp.client.YubiClient20` for the parameters. Unlike the
+    synchronous client, this can not hedge requests across ``base_urls``.
+    """
+
+    @property
+    def base_urls(self):
+        return [self.base_url]
+
+    @base_urls.setter
+    def base_urls(self, urls):
+        raise NotImplementedError('The async clients do not hedge across base_urls')
+
+
+async def _fetch(url, context=None, trace=NULL_TRACE):
+    """
+    Sends an HTTP GET request and returns the response body.
+
+    :param str url: An http or https URL.
+    :param context: The :class:`ssl.SSLContext` for an https URL.
+    :param trace: Receives ``connect``, ``request``, ``wait``, and ``read``
+        marks.
+    :rtype: bytes
+    """
+    parts = urlsplit(url)
+
+    if parts.scheme == 'https':
+        context = context or ssl.create_default_context()
+        port = parts.port or 443
+    else:
+        context = None
+        port = parts.port or 80
+
+    target = parts.path or '/'
+    if parts.query:
+        target = '{0}?{1}'.format(target, parts.query)
+
+    reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=context)
+    trace.mark('connect')
+
+    try:
+        request = 'GET {0} HTTP/1.1\r\nHost: {1}\r\nConnection: close\r\n\r\n'.format(
+            target, parts.netloc
+        )
+        writer.write(request.encode('latin-1'))
+        await writer.drain()
+        trace.mark('request')
+
+        status_line = await reader.readline()
+        trace.mark('wait')
+        try:
+            version, code, reason = status_line.decode('latin-1').split(' ', 2)
+            code = int(code)
+        except ValueError:
+            raise ValueError('Malformed HTTP status line')
+
+        lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            lines.append(line)
+        headers = BytesHeaderParser().parsebytes(b''.join(lines))
+
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = await _read_chunked(reader)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            body = await reader.read()
+        trace.mark('read')
+    finally:
+        writer.close()
+
+    if code != 200:
+        raise HTTPError(url, code, reason.strip(), headers, None)
+
+    return body
+
+
+async def _read_chunked(reader):
+    chunks = []
+
+    while True:
+        size = int((await reader.readline()).split(b';', 1)[0], 16)
+        if size == 0:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+    return b''.join(chunks)
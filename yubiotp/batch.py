@@ -0,0 +1,231 @@
+"""
+Vectorized operations on large batches of decrypted Yubico OTPs. This module
+requires NumPy, which is available as the ``numpy`` extra
+(``pip install yubiotp[numpy]``).
+
+>>> from binascii import unhexlify
+>>> from yubiotp.otp import OTP, encode_otp
+>>> key = b'0123456789abcdef'
+>>> otps = [OTP(unhexlify(b'0123456789ab'), 5, 0x0153f8, n, 0x1234) for n in (2, 0, 1)]
+>>> tokens = [encode_otp(otp, key, b'cclngiuv') for otp in otps]
+>>> batch = OTPBatch.from_tokens(tokens, key)
+>>> bool(batch.check_crc().all())
+True
+>>> batch.counter.tolist()
+[2, 0, 1]
+>>> batch.sorted().counter.tolist()
+[0, 1, 2]
+>>> batch.sorted().to_otps() == sorted(otps, key=lambda otp: otp.counter)
+True
+>>> batch.public_ids.tolist()
+[b'cclngiuv', b'cclngiuv', b'cclngiuv']
+"""
+
+import numpy as np
+
+from .crc import _TABLE, RESIDUAL
+from .otp import OTP, _new_cipher, _split_token
+
+__all__ = ['OTPBatch', 'OTP_DTYPE', 'PACKED_DTYPE']
+
+
+#: The layout of a packed OTP.
+PACKED_DTYPE = np.dtype(
+    [
+        ('uid', 'S6'),
+        ('session', '<u2'),
+        ('timestamp_low', 'u1'),
+        ('timestamp_high', '<u2'),
+        ('counter', 'u1'),
+        ('rand', '<u2'),
+        ('crc', '<u2'),
+    ]
+)
+
+#: The columns returned by :meth:`OTPBatch.fields`.
+OTP_DTYPE = np.dtype(
+    [
+        ('uid', 'S6'),
+        ('session', '<u2'),
+        ('timestamp', '<u4'),
+        ('counter', 'u1'),
+        ('rand', '<u2'),
+    ]
+)
+
+_CRC_TABLE = np.array(_TABLE, dtype=np.uint16)
+
+
+class OTPBatch(object):
+    """
+    A batch of decrypted OTPs, stored as an (N, 16) array of bytes. The fields
+    are available as NumPy arrays, and checksums are verified for the whole
+    batch at once.
+
+    Note that NumPy strips trailing NUL bytes when converting ``S6`` values
+    back to :class:`bytes`, so use :meth:`to_otps` to recover exact private
+    IDs.
+
+    :param data: An array-like of shape (N, 16) holding packed OTPs.
+    :param public_ids: Optionally, the modhex public ID of each OTP.
+
+    .. attribute:: data
+
+        The packed OTPs as a contiguous ``uint8`` array of shape (N, 16).
+
+    .. attribute:: public_ids
+
+        An array of public IDs (``S32``), or ``None``.
+    """
+
+    def __init__(self, data, public_ids=None):
+        data = np.ascontiguousarray(data, dtype=np.uint8)
+        if data.ndim != 2 or data.shape[1] != OTP.size:
+            raise ValueError('OTP data must have shape (N, 16)')
+
+        if public_ids is not None:
+            public_ids = np.asarray(public_ids, dtype='S32')
+            if public_ids.shape != (len(data),):
+                raise ValueError('There must be one public ID per OTP')
+
+        self.data = data
+        self.public_ids = public_ids
+
+    @classmethod
+    def from_buffer(cls, buf, public_ids=None):
+        """
+        Wraps a buffer of concatenated packed OTPs without copying it.
+
+        :param buf: A bytes-like object whose length is a multiple of 16.
+        """
+        data = np.frombuffer(buf, dtype=np.uint8)
+        if len(data) % OTP.size:
+            raise ValueError('Buffer length must be a multiple of 16')
+
+        return cls(data.reshape(-1, OTP.size), public_ids)
+
+    @classmethod
+    def from_tokens(cls, tokens, key):
+        """
+        Decrypts tokens that share a key in a single pass. Checksums are not
+        verified; see :meth:`check_crc`.
+
+        :param tokens: An iterable of modhex-encoded tokens.
+        :param bytes key: The 16-byte AES key.
+
+        :raises: ``ValueError`` if any token can not be decoded.
+        """
+        public_ids = []
+        blocks = []
+
+        for token in tokens:
+            public_id, buf = _split_token(token, key)
+            public_ids.append(public_id)
+            blocks.append(buf)
+
+        plaintext = _new_cipher(key).decrypt(b''.join(blocks)) if blocks else b''
+
+        return cls.from_buffer(plaintext, public_ids)
+
+    @classmethod
+    def from_otps(cls, otps):
+        """
+        Packs a sequence of :class:`~yubiotp.otp.OTP` objects.
+        """
+        otps = list(otps)
+        buf = bytearray(len(otps) * OTP.size)
+
+        for index, otp in enumerate(otps):
+            otp.pack_into(buf, index * OTP.size)
+
+        return cls.from_buffer(buf)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def records(self):
+        """
+        A structured view of the packed OTPs (see :data:`PACKED_DTYPE`).
+        """
+        return self.data.view(PACKED_DTYPE).reshape(-1)
+
+    @property
+    def uid(self):
+        return self.records['uid']
+
+    @property
+    def session(self):
+        return self.records['session']
+
+    @property
+    def timestamp(self):
+        records = self.records
+        high = records['timestamp_high'].astype(np.uint32)
+
+        return (high << 8) | records['timestamp_low']
+
+    @property
+    def counter(self):
+        return self.records['counter']
+
+    @property
+    def rand(self):
+        return self.records['rand']
+
+    def fields(self):
+        """
+        Returns the unpacked fields as a structured array (see
+        :data:`OTP_DTYPE`).
+        """
+        fields = np.empty(len(self), dtype=OTP_DTYPE)
+        fields['uid'] = self.uid
+        fields['session'] = self.session
+        fields['timestamp'] = self.timestamp
+        fields['counter'] = self.counter
+        fields['rand'] = self.rand
+
+        return fields
+
+    def check_crc(self):
+        """
+        Verifies every checksum, one column of bytes at a time.
+
+        :returns: A boolean array that is ``True`` for each valid OTP.
+        """
+        crc = np.full(len(self), 0xFFFF, dtype=np.uint16)
+
+        for column in self.data.T:
+            crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ column) & 0xFF]
+
+        return crc == RESIDUAL
+
+    def filter(self, selector):
+        """
+        Returns a new batch with the selected OTPs.
+
+        :param selector: A boolean mask or an array of indices.
+        """
+        public_ids = self.public_ids
+        if public_ids is not None:
+            public_ids = public_ids[selector]
+
+        return self.__class__(self.data[selector], public_ids)
+
+    def sorted(self):
+        """
+        Returns a new batch sorted by private ID, then session, then counter:
+        the order in which each device generated its OTPs.
+        """
+        return self.filter(np.lexsort((self.counter, self.session, self.uid)))
+
+    def to_otps(self):
+        """
+        Unpacks the batch into a list of :class:`~yubiotp.otp.OTP` objects.
+        Checksums are not verified.
+        """
+        buf = self.data.tobytes()
+
+        return [
+            OTP._from_packed(buf, offset) for offset in range(0, len(buf), OTP.size)
+        ]
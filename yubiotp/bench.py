@@ -0,0 +1,659 @@
+"""
+Performance benchmarks for yubiotp. Run with ``yubiotp-bench`` or
+``python -m yubiotp.bench``.
+
+Each benchmark times a batch of operations, choosing the batch size so that one
+run takes at least ``--min-time`` seconds, and keeps the best of several runs.
+Results are written as JSON, which can be saved and passed back later with
+``--baseline`` to flag regressions.
+
+>>> results = run_benchmarks(['crc16'], repeat=1, min_time=0.001)
+>>> sorted(results['crc16'])
+['group', 'median_ns_per_op', 'ns_per_op', 'number', 'ops_per_sec', 'repeat']
+>>> baseline = {'crc16': dict(results['crc16'], ops_per_sec=2e12)}
+>>> [row['name'] for row in compare(results, baseline, 0.1) if row['regressed']]
+['crc16']
+"""
+
+import asyncio
+from base64 import b64encode
+from collections import namedtuple
+from fnmatch import fnmatchcase
+import json
+from optparse import OptionParser
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+
+from yubiotp.client import YubiClient20, YubiResponse, param_signature
+from yubiotp.crc import crc16
+from yubiotp.keystore import MemoryKeyStore
+from yubiotp.modhex import modhex, unmodhex
+from yubiotp.otp import OTP, YubiKey, decode_otp, encode_otp
+from yubiotp.server import ValidationServer
+from yubiotp.validator import Validator
+
+try:
+    from importlib.metadata import PackageNotFoundError, version
+except ImportError:  # Python 3.7
+    version = None
+
+__all__ = ['BENCHMARKS', 'benchmark', 'run_benchmarks', 'compare']
+
+
+Benchmark = namedtuple('Benchmark', ['name', 'group', 'factory'])
+
+#: Registered benchmarks, by name, in the order they run.
+BENCHMARKS = {}
+
+
+def benchmark(name, group='micro'):
+    """
+    Registers a benchmark.
+
+    The decorated function is called with a :class:`BenchContext` and a number
+    of operations. It does any setup and returns a callable that performs that
+    many operations; only the callable is timed.
+
+    :param str name: A unique, dotted name.
+    :param str group: ``'micro'`` for single functions or ``'macro'`` for
+        whole code paths.
+    """
+
+    def register(factory):
+        BENCHMARKS[name] = Benchmark(name, group, factory)
+        return factory
+
+    return register
+
+
+def main():
+    options, patterns = parse_args()
+
+    if options.list:
+        for bench in BENCHMARKS.values():
+            print('{0} ({1})'.format(bench.name, bench.group))
+        sys.exit(0)
+
+    names = select(patterns)
+    if not names:
+        print('No benchmarks match.', file=sys.stderr)
+        sys.exit(1)
+
+    results = run_benchmarks(
+        names, options.repeat, options.min_time, devices=options.devices
+    )
+    document = {'environment': environment(), 'results': results}
+
+    comparison = None
+    if options.baseline is not None:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare(results, baseline['results'], options.threshold / 100)
+        document['comparison'] = comparison
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(document, f, indent=2)
+            f.write('\n')
+
+    if options.format == 'json':
+        json.dump(document, sys.stdout, indent=2)
+        print()
+    else:
+        write_table(results, comparison, sys.stdout)
+
+    if comparison is not None and any(row['regressed'] for row in comparison):
+        sys.exit(2)
+
+
+def parse_args():
+    parser = OptionParser(
+        usage='%prog [options] [pattern ...]',
+        description='Runs the yubiotp benchmarks and reports operations per second. Patterns are shell-style wildcards that select benchmarks by name.',
+    )
+
+    parser.add_option(
+        '-l',
+        '--list',
+        action='store_true',
+        dest='list',
+        help='List the benchmarks and exit.',
+    )
+    parser.add_option(
+        '-r',
+        '--repeat',
+        dest='repeat',
+        type='int',
+        default=5,
+        help='Runs of each benchmark. The best is reported. [%default]',
+    )
+    parser.add_option(
+        '-t',
+        '--min-time',
+        dest='min_time',
+        type='float',
+        default=0.2,
+        help='Minimum seconds per run. [%default]',
+    )
+    parser.add_option(
+        '-d',
+        '--devices',
+        dest='devices',
+        type='int',
+        default=64,
+        help='Virtual devices per thread in the validator benchmarks. [%default]',
+    )
+    parser.add_option(
+        '-F',
+        '--format',
+        dest='format',
+        type='choice',
+        choices=['json', 'text'],
+        default='json',
+        help='Output format (json, text). [%default]',
+    )
+    parser.add_option(
+        '-o',
+        '--output',
+        dest='output',
+        metavar='FILE',
+        help='Also save the JSON results to FILE, for use as a baseline.',
+    )
+    parser.add_option(
+        '-b',
+        '--baseline',
+        dest='baseline',
+        metavar='FILE',
+        help='Compare against results saved with --output. Exits with status 2 if anything regressed.',
+    )
+    parser.add_option(
+        '--threshold',
+        dest='threshold',
+        type='float',
+        default=10.0,
+        help='The slowdown, in percent, that counts as a regression. [%default]',
+    )
+
+    return parser.parse_args()
+
+
+def select(patterns):
+    """
+    Returns the names of the benchmarks that match any of the patterns, or
+    all of them if there are no patterns.
+    """
+    return [
+        name
+        for name in BENCHMARKS
+        if (not patterns) or any(fnmatchcase(name, p) for p in patterns)
+    ]
+
+
+def run_benchmarks(names, repeat=5, min_time=0.2, **options):
+    """
+    Runs benchmarks.
+
+    :param names: The names of registered benchmarks.
+    :param int repeat: The number of timed runs of each benchmark.
+    :param float min_time: The minimum duration of a run, in seconds.
+    :param options: Attributes of the :class:`BenchContext`.
+
+    :returns: A dict of results by name.
+    :rtype: dict
+    """
+    results = {}
+
+    with BenchContext(**options) as context:
+        for name in names:
+            bench = BENCHMARKS[name]
+            results[name] = measure(bench, context, repeat, min_time)
+
+    return results
+
+
+def measure(bench, context, repeat, min_time):
+    """
+    Times one benchmark.
+
+    :rtype: dict
+    """
+    number = 1
+    while True:
+        elapsed = _time(bench, context, number)
+        if elapsed >= min_time:
+            break
+        number = _next_number(number, elapsed, min_time)
+
+    timings = [elapsed]
+    timings.extend(_time(bench, context, number) for i in range(repeat - 1))
+    best = min(timings) / number
+
+    return {
+        'group': bench.group,
+        'number': number,
+        'repeat': len(timings),
+        'ns_per_op': best * 1e9,
+        'median_ns_per_op': statistics.median(timings) / number * 1e9,
+        'ops_per_sec': 1 / best,
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Compares results with a baseline.
+
+    :param dict results: Results from :func:`run_benchmarks`.
+    :param dict baseline: Earlier results.
+    :param float threshold: The fractional loss of throughput that counts as a
+        regression.
+
+    :returns: One dict for each benchmark in both sets, with the keys
+        ``name``, ``baseline``, ``current`` (operations per second),
+        ``change`` (a fraction), and ``regressed``.
+    :rtype: list
+    """
+    rows = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        before = baseline[name]['ops_per_sec']
+        after = result['ops_per_sec']
+        change = (after - before) / before
+
+        rows.append(
+            {
+                'name': name,
+                'baseline': before,
+                'current': after,
+                'change': change,
+                'regressed': change < -threshold,
+            }
+        )
+
+    return rows
+
+
+def environment():
+    """
+    Describes the interpreter and machine, to put results in context.
+    """
+    package_version = None
+    if version is not None:
+        try:
+            package_version = version('yubiotp')
+        except PackageNotFoundError:
+            pass
+
+    return {
+        'yubiotp': package_version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def write_table(results, comparison, stream):
+    changes = {row['name']: row for row in (comparison or [])}
+
+    for name, result in results.items():
+        line = '{0:<28} {1:>14,.0f} ops/s {2:>12,.1f} ns/op'.format(
+            name, result['ops_per_sec'], result['ns_per_op']
+        )
+
+        row = changes.get(name)
+        if row is not None:
+            line += ' {0:>+8.1%}{1}'.format(
+                row['change'], '  REGRESSED' if row['regressed'] else ''
+            )
+
+        print(line, file=stream)
+
+
+class BenchContext(object):
+    """
+    Resources shared by the benchmarks in a run. The stub validation server is
+    started the first time it's needed and stopped when the context exits.
+
+    :param int devices: Virtual devices per thread in the validator
+        benchmarks.
+    """
+
+    key = b'0123456789abcdef'
+    uid = bytes.fromhex('0123456789ab')
+    public_id = b'cclngiuv'
+    api_key = b'bench-api-key'
+
+    def __init__(self, devices=64):
+        self.devices = devices
+        self.token = encode_otp(
+            OTP(self.uid, 5, 0x0153F8, 0, 0x1234), self.key, self.public_id
+        ).decode()
+
+        self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    @property
+    def server(self):
+        """
+        A :class:`StubServer` running in this process.
+        """
+        if self._server is None:
+            self._server = StubServer(self.api_key)
+
+        return self._server
+
+
+class StubServer(object):
+    """
+    A :class:`~yubiotp.server.ValidationServer` on a background event loop,
+    listening on an ephemeral local port.
+
+    :param bytes api_key: The key for API id 1.
+    """
+
+    def __init__(self, api_key):
+        self.store = MemoryKeyStore()
+        server = ValidationServer(Validator(self.store), clients={'1': api_key})
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.listener = self._run(server.start('127.0.0.1', 0))
+        port = self.listener.sockets[0].getsockname()[1]
+        self.base_url = 'http://127.0.0.1:{0}/wsapi/2.0/verify'.format(port)
+
+        self._devices = 0
+
+    def add_device(self, key):
+        """
+        Registers a new device.
+
+        :returns: The device's public ID and a :class:`~yubiotp.otp.YubiKey`
+            to generate its OTPs.
+        """
+        public_id = modhex(b'\xff' + self._devices.to_bytes(5, 'big'))
+        uid = os.urandom(6)
+        self._devices += 1
+
+        self.store.add(public_id, key, uid)
+
+        return public_id, YubiKey(uid, 0)
+
+    def stop(self):
+        self.listener.close()
+        self._run(self.listener.wait_closed())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+#
+# Micro benchmarks
+#
+
+
+@benchmark('crc16')
+def bench_crc16(context, number):
+    buf = OTP(context.uid, 5, 0x0153F8, 0, 0x1234).pack()
+
+    return _repeat(number, crc16, buf)
+
+
+@benchmark('modhex')
+def bench_modhex(context, number):
+    return _repeat(number, modhex, os.urandom(16))
+
+
+@benchmark('unmodhex')
+def bench_unmodhex(context, number):
+    return _repeat(number, unmodhex, modhex(os.urandom(16)))
+
+
+@benchmark('otp.pack')
+def bench_otp_pack(context, number):
+    return _repeat(number, OTP(context.uid, 5, 0x0153F8, 0, 0x1234).pack)
+
+
+@benchmark('otp.unpack')
+def bench_otp_unpack(context, number):
+    buf = OTP(context.uid, 5, 0x0153F8, 0, 0x1234).pack()
+
+    return _repeat(number, OTP.unpack, buf)
+
+
+@benchmark('otp.encode')
+def bench_encode_otp(context, number):
+    otp = OTP(context.uid, 5, 0x0153F8, 0, 0x1234)
+
+    return _repeat(number, encode_otp, otp, context.key, context.public_id)
+
+
+@benchmark('otp.decode')
+def bench_decode_otp(context, number):
+    return _repeat(number, decode_otp, context.token.encode(), context.key)
+
+
+@benchmark('client.param_signature')
+def bench_param_signature(context, number):
+    params = YubiClient20(1, context.api_key, timestamp=True, sl=50).params(
+        context.token, 'abcdefghijklmnopqrstuvwxyz'
+    )
+
+    return _repeat(number, param_signature, params, context.api_key)
+
+
+@benchmark('client.url')
+def bench_url(context, number):
+    client = YubiClient20(1, os.urandom(20), timestamp=True, sl=50, timeout=5)
+
+    return _repeat(number, client.url, context.token)
+
+
+@benchmark('client.url.prepared')
+def bench_url_prepared(context, number):
+    client = YubiClient20(1, os.urandom(20), timestamp=True, sl=50, timeout=5)
+    client.prepare()
+
+    return _repeat(number, client.url, context.token)
+
+
+@benchmark('response.parse')
+def bench_response_parse(context, number):
+    raw, nonce = _signed_response(context)
+
+    def run():
+        for i in range(number):
+            YubiResponse(raw, context.api_key, context.token, nonce).fields
+
+    return run
+
+
+@benchmark('response.validate')
+def bench_response_validate(context, number):
+    raw, nonce = _signed_response(context)
+
+    def run():
+        for i in range(number):
+            YubiResponse(raw, context.api_key, context.token, nonce).is_valid()
+
+    return run
+
+
+#
+# Macro benchmarks
+#
+
+
+@benchmark('validator.verify', 'macro')
+def bench_validator(context, number):
+    return _validator_run(context, number, 1)
+
+
+@benchmark('validator.verify.threads4', 'macro')
+def bench_validator_threads4(context, number):
+    return _validator_run(context, number, 4)
+
+
+@benchmark('validator.verify.threads16', 'macro')
+def bench_validator_threads16(context, number):
+    return _validator_run(context, number, 16)
+
+
+@benchmark('client.verify', 'macro')
+def bench_verify(context, number):
+    """
+    Verifies fresh tokens against the stub server, one at a time, over a
+    kept-alive connection.
+    """
+    server = context.server
+    public_id, yubikey = server.add_device(context.key)
+    tokens = [
+        encode_otp(otp, context.key, public_id).decode()
+        for otp in yubikey.generate_many(number)
+    ]
+
+    client = YubiClient20(1, context.api_key, timestamp=True)
+    client.base_url = server.base_url
+
+    def run():
+        for token in tokens:
+            response = client.verify(token)
+            if not response.is_ok():
+                raise RuntimeError('Verification failed: {0}'.format(response.status()))
+
+        client.pool.clear()
+
+    return run
+
+
+#
+# Helpers
+#
+
+
+def _time(bench, context, number):
+    run = bench.factory(context, number)
+
+    start = time.perf_counter()
+    run()
+
+    return time.perf_counter() - start
+
+
+def _next_number(number, elapsed, min_time):
+    """
+    Estimates the batch size for a run of ``min_time`` seconds, growing by at
+    most a factor of 10 at a time.
+    """
+    if elapsed <= 0:
+        return number * 10
+
+    return max(number + 1, min(number * 10, int(number * min_time * 1.2 / elapsed)))
+
+
+def _repeat(number, func, *args):
+    def run():
+        for i in range(number):
+            func(*args)
+
+    return run
+
+
+def _signed_response(context):
+    """
+    Returns a signed response body for the context's token, as the stub server
+    would send it, and the nonce it answers.
+    """
+    nonce = 'abcdefghijklmnopqrstuvwxyz'
+    fields = [
+        ('nonce', nonce),
+        ('otp', context.token),
+        ('sessioncounter', '5'),
+        ('sessionuse', '0'),
+        ('sl', '100'),
+        ('status', 'OK'),
+        ('t', '2024-01-01T00:00:00Z0000'),
+        ('timestamp', str(0x0153F8)),
+    ]
+    signature = param_signature(fields, context.api_key)
+    fields.append(('h', b64encode(signature).decode()))
+
+    raw = ''.join('{0}={1}\r\n'.format(k, v) for k, v in fields).encode()
+
+    return raw, nonce
+
+
+def _validator_run(context, number, threads):
+    """
+    Verifies ``number`` tokens in total with several threads, each using its
+    own devices.
+    """
+    store = MemoryKeyStore()
+    validator = Validator(store)
+    work = []
+
+    for thread in range(threads):
+        size = (number // threads) + (thread < (number % threads))
+        count = -(-size // context.devices)
+        tokens = _make_tokens(store, thread, context.devices, count)
+        del tokens[size:]
+        work.append(tokens)
+
+    def verify(tokens):
+        for token in tokens:
+            validator.verify(token)
+
+    def run():
+        workers = [threading.Thread(target=verify, args=(tokens,)) for tokens in work]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    return run
+
+
+def _make_tokens(store, thread, devices, count):
+    """
+    Registers some new devices and returns a list of tokens interleaved
+    across them.
+    """
+    yubikeys = []
+
+    for i in range(devices):
+        public_id = modhex(b'\x00' + (thread * devices + i).to_bytes(5, 'big'))
+        key = os.urandom(16)
+        uid = os.urandom(6)
+
+        store.add(public_id, key, uid)
+        yubikeys.append((public_id, key, YubiKey(uid, 0)))
+
+    return [
+        encode_otp(yubikey.generate(), key, public_id)
+        for i in range(count)
+        for public_id, key, yubikey in yubikeys
+    ]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+"""
+Storage backends for the virtual devices managed by the yubikey command.
+
+:class:`ConfigDeviceStore` keeps devices in the original INI config file, which
+is read in full and rewritten on every change. :class:`SQLiteDeviceStore` keeps
+them in an indexed SQLite database, which scales to large fleets and lets
+several processes generate tokens at once. :func:`open_store` picks one based
+on the file.
+"""
+
+from collections import namedtuple
+import configparser
+import sqlite3
+
+__all__ = [
+    'DeviceRecord',
+    'DeviceStore',
+    'ConfigDeviceStore',
+    'SQLiteDeviceStore',
+    'DeviceExistsError',
+    'NoSuchDeviceError',
+    'open_store',
+    'read_config',
+    'write_config',
+]
+
+
+#: A virtual device. ``key`` and ``uid`` are hex strings; ``public_id`` is a
+#: modhex string.
+DeviceRecord = namedtuple(
+    'DeviceRecord', ['name', 'public_id', 'key', 'uid', 'session']
+)
+
+
+class DeviceExistsError(KeyError):
+    pass
+
+
+class NoSuchDeviceError(KeyError):
+    pass
+
+
+class DeviceStore(object):
+    """
+    Abstract interface to a collection of virtual devices.
+    """
+
+    def get(self, name):
+        """
+        Returns the named device, or ``None``.
+
+        :rtype: :class:`DeviceRecord`
+        """
+        raise NotImplementedError()
+
+    def find(self, public_id):
+        """
+        Returns a device with the given public ID, or ``None``.
+
+        :param str public_id: A modhex public ID.
+        :rtype: :class:`DeviceRecord`
+        """
+        raise NotImplementedError()
+
+    def add(self, record):
+        """
+        Adds a new device.
+
+        :raises: :exc:`DeviceExistsError`
+        """
+        raise NotImplementedError()
+
+    def remove(self, name):
+        """
+        Removes a device.
+
+        :raises: :exc:`NoSuchDeviceError`
+        """
+        raise NotImplementedError()
+
+    def reserve_session(self, name):
+        """
+        Atomically returns a device's next session counter and increments the
+        stored value, so that no other user of the store will get the same
+        session.
+
+        :rtype: int
+        :raises: :exc:`NoSuchDeviceError`
+        """
+        raise NotImplementedError()
+
+    def update_session(self, name, session):
+        """
+        Raises a device's stored session counter to at least ``session``.
+        """
+        raise NotImplementedError()
+
+    def update(self, records):
+        """
+        Adds or replaces many devices at once.
+        """
+        raise NotImplementedError()
+
+    def __iter__(self):
+        """
+        Iterates over all devices in the order they were added.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Saves any pending changes and releases resources.
+        """
+        pass
+
+
+class ConfigDeviceStore(DeviceStore):
+    """
+    Stores devices as ``device_<name>`` sections of an INI file. Changes are
+    written back in full by :meth:`close`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.config = configparser.ConfigParser()
+        self.config.read([path])
+
+        self._dirty = False
+
+    def get(self, name):
+        section = _section_name(name)
+        if not self.config.has_section(section):
+            return None
+
+        return _section_record(self.config, section)
+
+    def find(self, public_id):
+        for record in self:
+            if record.public_id == public_id:
+                return record
+
+        return None
+
+    def add(self, record):
+        section = _section_name(record.name)
+        if self.config.has_section(section):
+            raise DeviceExistsError(record.name)
+
+        self._set(record)
+
+    def remove(self, name):
+        if not self.config.remove_section(_section_name(name)):
+            raise NoSuchDeviceError(name)
+
+        self._dirty = True
+
+    def reserve_session(self, name):
+        record = self.get(name)
+        if record is None:
+            raise NoSuchDeviceError(name)
+
+        self.update_session(name, record.session + 1)
+
+        return record.session
+
+    def update_session(self, name, session):
+        section = _section_name(name)
+        if session > self.config.getint(section, 'session'):
+            self.config.set(section, 'session', str(session))
+            self._dirty = True
+
+    def update(self, records):
+        for record in records:
+            self._set(record)
+
+    def __iter__(self):
+        for section in self.config.sections():
+            if section.startswith('device_'):
+                yield _section_record(self.config, section)
+
+    def close(self):
+        if self._dirty:
+            with open(self.path, 'w') as f:
+                self.config.write(f)
+
+            self._dirty = False
+
+    def _set(self, record):
+        section = _section_name(record.name)
+        if not self.config.has_section(section):
+            self.config.add_section(section)
+
+        for field in DeviceRecord._fields[1:]:
+            self.config.set(section, field, str(getattr(record, field)))
+
+        self._dirty = True
+
+
+class SQLiteDeviceStore(DeviceStore):
+    """
+    Stores devices in an SQLite database, indexed by name and public ID.
+    Every change is committed immediately, and session reservations are
+    transactions, so concurrent processes never share a session.
+
+    :param str path: The database file. It will be created if necessary.
+    :param float timeout: Seconds to wait for another process's lock.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS devices ('
+        ' name TEXT PRIMARY KEY,'
+        ' public_id TEXT NOT NULL,'
+        ' key TEXT NOT NULL,'
+        ' uid TEXT NOT NULL,'
+        ' session INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS devices_public_id ON devices (public_id)',
+    ]
+
+    COLUMNS = 'name, public_id, key, uid, session'
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+
+        with self._transaction():
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def get(self, name):
+        return self._one('WHERE name = ?', (str(name),))
+
+    def find(self, public_id):
+        return self._one('WHERE public_id = ? ORDER BY rowid LIMIT 1', (public_id,))
+
+    def add(self, record):
+        try:
+            self.conn.execute(
+                'INSERT INTO devices ({0}) VALUES (?, ?, ?, ?, ?)'.format(self.COLUMNS),
+                _row(record),
+            )
+        except sqlite3.IntegrityError:
+            raise DeviceExistsError(record.name)
+
+    def remove(self, name):
+        cursor = self.conn.execute('DELETE FROM devices WHERE name = ?', (str(name),))
+        if cursor.rowcount == 0:
+            raise NoSuchDeviceError(name)
+
+    def reserve_session(self, name):
+        with self._transaction():
+            row = self.conn.execute(
+                'SELECT session FROM devices WHERE name = ?', (str(name),)
+            ).fetchone()
+            if row is None:
+                raise NoSuchDeviceError(name)
+
+            self.conn.execute(
+                'UPDATE devices SET session = session + 1 WHERE name = ?', (str(name),)
+            )
+
+        return row[0]
+
+    def update_session(self, name, session):
+        self.conn.execute(
+            'UPDATE devices SET session = MAX(session, ?) WHERE name = ?',
+            (session, str(name)),
+        )
+
+    def update(self, records):
+        with self._transaction():
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO devices ({0}) VALUES (?, ?, ?, ?, ?)'.format(
+                    self.COLUMNS
+                ),
+                (_row(record) for record in records),
+            )
+
+    def __iter__(self):
+        cursor = self.conn.execute(
+            'SELECT {0} FROM devices ORDER BY rowid'.format(self.COLUMNS)
+        )
+
+        return (DeviceRecord(*row) for row in cursor)
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM devices').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def _one(self, where, params):
+        row = self.conn.execute(
+            'SELECT {0} FROM devices {1}'.format(self.COLUMNS, where), params
+        ).fetchone()
+
+        return DeviceRecord(*row) if (row is not None) else None
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+
+class _Transaction(object):
+    """
+    Holds a write lock on an autocommit connection for the duration of a
+    ``with`` block.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute('COMMIT' if (exc_type is None) else 'ROLLBACK')
+
+
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+def open_store(path):
+    """
+    Opens a device store. Existing SQLite databases and paths ending in
+    ``.db``, ``.sqlite``, or ``.sqlite3`` are opened with
+    :class:`SQLiteDeviceStore`; anything else is treated as an INI config file.
+    """
+    if path.endswith(SQLITE_SUFFIXES) or _is_sqlite(path):
+        return SQLiteDeviceStore(path)
+    else:
+        return ConfigDeviceStore(path)
+
+
+def read_config(path):
+    """
+    Reads the devices from an INI config file.
+
+    :returns: A list of :class:`DeviceRecord`.
+    """
+    return list(ConfigDeviceStore(path))
+
+
+def write_config(records, stream):
+    """
+    Writes devices to a text stream in the INI config file format.
+    """
+    for record in records:
+        stream.write(
+            '[{0}]\npublic_id = {1}\nkey = {2}\nuid = {3}\nsession = {4}\n\n'.format(
+                _section_name(record.name),
+                record.public_id,
+                record.key,
+                record.uid,
+                record.session,
+            )
+        )
+
+
+def _is_sqlite(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+
+def _section_name(name):
+    return 'device_{0}'.format(name)
+
+
+def _section_record(config, section):
+    return DeviceRecord(
+        section.partition('_')[2],
+        config.get(section, 'public_id'),
+        config.get(section, 'key'),
+        config.get(section, 'uid'),
+        config.getint(section, 'session'),
+    )
+
+
+def _row(record):
+    return (str(record.name),) + tuple(record[1:])
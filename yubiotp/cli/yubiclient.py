@@ -1,8 +1,13 @@
 from base64 import b64decode
+from collections import Counter
+from itertools import chain
+import json
 from optparse import OptionParser
 import sys
+import time
 
 from yubiotp.client import YubiClient10, YubiClient11, YubiClient20
+from yubiotp.metrics import Histogram, LatencyCollector
 
 
 def main():
@@ -26,17 +31,55 @@ def main():
             options.timeout,
         )
 
-    if options.base_url:
-        client.base_url = options.base_url
+    if len(options.base_urls) > 1 and options.version == '2.0':
+        client.base_urls = options.base_urls
+    elif options.base_urls:
+        client.base_url = options.base_urls[-1]
 
-    is_valid = True
+    tokens = args
+    stream = None
+    if options.input is not None:
+        stream = sys.stdin if (options.input == '-') else open(options.input)
+        tokens = chain(tokens, read_tokens(stream))
 
-    for token in args:
-        if options.noexec:
+    if options.noexec:
+        for token in tokens:
             print(client.url(token))
-        else:
-            if not verify_otp(client, token, options.verbose):
-                is_valid = False
+        sys.exit(0)
+
+    summary = None
+    if options.summary or (options.input is not None):
+        summary = Summary()
+        client.observers.append(summary)
+
+    is_valid = True
+    is_error = False
+
+    if options.concurrency > 1:
+        results = client.verify_many(
+            tokens, max_workers=options.concurrency, ordered=False
+        )
+    else:
+        results = ((token, _verify(client, token)) for token in tokens)
+
+    for token, result in results:
+        if not report(client, token, result, options.verbose, options.format):
+            is_valid = False
+        if isinstance(result, Exception):
+            is_error = True
+        if summary is not None:
+            summary.record(result)
+
+    if stream not in (None, sys.stdin):
+        stream.close()
+    client.close()
+
+    if summary is not None:
+        summary.report(sys.stderr, options.format)
+
+    # As before, a request that fails outright exits with 1.
+    if is_error:
+        sys.exit(1)
 
     sys.exit(0 if is_valid else 2)
 
@@ -73,8 +116,10 @@ def parse_args():
     parser.add_option(
         '-u',
         '--base-url',
-        dest='base_url',
-        help="Base URL of the api. Defaults to a version-appropriate URL on api.yubico.com.",
+        dest='base_urls',
+        action='append',
+        default=[],
+        help="Base URL of the api. Defaults to a version-appropriate URL on api.yubico.com. (Version 2.0+) May be repeated to send hedged requests to several servers.",
     )
     parser.add_option(
         '-s',
@@ -103,13 +148,65 @@ def parse_args():
         help="(Version 2.0+) Seconds to wait for sync response.",
     )
 
+    parser.add_option(
+        '--input',
+        dest='input',
+        metavar='FILE',
+        help="Also verify the tokens in FILE, one per line. Use - for stdin. Implies --summary.",
+    )
+    parser.add_option(
+        '--concurrency',
+        dest='concurrency',
+        type='int',
+        default=1,
+        metavar='N',
+        help="The number of verifications to keep in flight. [%default]",
+    )
+    parser.add_option(
+        '--format',
+        dest='format',
+        type='choice',
+        choices=['text', 'jsonl'],
+        default='text',
+        help="The output format (text, jsonl). [%default]",
+    )
+    parser.add_option(
+        '--summary',
+        action='store_true',
+        dest='summary',
+        help="Print status counts and latency percentiles to stderr at the end.",
+    )
+
     options, args = parser.parse_args()
 
     return options, args
 
 
+def read_tokens(stream):
+    for line in stream:
+        token = line.strip()
+        if token:
+            yield token
+
+
 def verify_otp(client, otp, verbose=False):
-    response = client.verify(otp)
+    return report(client, otp, client.verify(otp), verbose)
+
+
+def report(client, otp, response, verbose=False, format='text'):
+    """
+    Prints the result of a verification.
+
+    :param response: A response or the exception raised by the request.
+    :returns: ``True`` if the token is valid.
+    """
+    if isinstance(response, Exception):
+        if format == 'jsonl':
+            print(json.dumps({'token': otp, 'status': 'ERROR', 'error': str(response)}))
+        else:
+            print('{0}: ERROR ({1})'.format(otp, response))
+
+        return False
 
     if verbose:
         print(client.url(otp), file=sys.stderr)
@@ -123,15 +220,108 @@ def verify_otp(client, otp, verbose=False):
             print('public_id: {0}'.format(response.public_id), file=sys.stderr)
             print(file=sys.stderr)
 
-    if response.is_ok():
-        is_valid = True
+    is_valid = response.is_ok()
+
+    if format == 'jsonl':
+        print(json.dumps({'token': otp, 'status': response.status(), 'ok': is_valid}))
+    elif is_valid:
         print('{0}: OK (strict)'.format(otp))
     else:
-        is_valid = False
         print('{0}: {1}'.format(otp, response.status()))
 
     return is_valid
 
 
+def _verify(client, token):
+    try:
+        return client.verify(token)
+    except Exception as e:
+        return e
+
+
+class Summary(LatencyCollector):
+    """
+    Collects response statuses and latencies for the final summary. Statuses
+    are counted for every token, including those answered locally without a
+    request; latencies only for actual requests.
+    """
+
+    def __init__(self):
+        super(Summary, self).__init__()
+
+        self.statuses = Counter()
+        self.overall = Histogram()
+        self.start = time.perf_counter()
+
+    def request_finished(self, trace):
+        super(Summary, self).request_finished(trace)
+
+        self.overall.observe(trace.elapsed)
+
+    def record(self, response):
+        if isinstance(response, Exception):
+            self.statuses['ERROR'] += 1
+        else:
+            self.statuses[response.status()] += 1
+
+    def snapshot(self):
+        snapshot = super(Summary, self).snapshot()
+        snapshot['counts'] = dict(self.statuses)
+        snapshot['overall'] = self.overall.snapshot()
+        snapshot['elapsed'] = time.perf_counter() - self.start
+
+        return snapshot
+
+    def report(self, stream, format='text'):
+        snapshot = self.snapshot()
+
+        if format == 'jsonl':
+            snapshot['base_url'] = {
+                str(url): stats for url, stats in snapshot['base_url'].items()
+            }
+            print(json.dumps({'summary': snapshot}), file=stream)
+            return
+
+        count = sum(snapshot['counts'].values())
+        elapsed = snapshot['elapsed']
+        print(
+            '{0} tokens in {1:.2f}s ({2:.1f}/s)'.format(
+                count, elapsed, (count / elapsed) if elapsed else 0.0
+            ),
+            file=stream,
+        )
+        for status, n in sorted(snapshot['counts'].items()):
+            print('  {0}: {1}'.format(status, n), file=stream)
+
+        print(file=stream)
+        print(
+            '{0:<40} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9}'.format(
+                'Latency (ms)', 'count', 'p50', 'p90', 'p99', 'max'
+            ),
+            file=stream,
+        )
+
+        rows = [('overall', snapshot['overall'])]
+        rows.extend(
+            (url or '(local)', stats)
+            for url, stats in sorted(
+                snapshot['base_url'].items(), key=lambda item: str(item[0])
+            )
+        )
+        for label, stats in rows:
+            print(
+                '{0:<40} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9}'.format(
+                    label,
+                    stats['count'],
+                    *(_ms(stats[key]) for key in ['p50', 'p90', 'p99', 'max']),
+                ),
+                file=stream,
+            )
+
+
+def _ms(seconds):
+    return '-' if (seconds is None) else '{0:.2f}'.format(seconds * 1000)
+
+
 if __name__ == '__main__':
     main()
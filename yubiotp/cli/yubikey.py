@@ -5,14 +5,34 @@ utilities for things like converting to and from modhex.
 """
 
 from binascii import hexlify, unhexlify
-import configparser
+import csv
+from hashlib import sha256
+import heapq
+import hmac
+from itertools import zip_longest
+import json
+import multiprocessing
 from optparse import Option, OptionGroup, OptionParser, OptionValueError
+import os
 from os.path import expanduser
-from random import choice
+from random import Random, choice
 import sys
 
+from Crypto.Cipher import AES
+
 from yubiotp.modhex import hex_to_modhex, modhex, modhex_to_hex, unmodhex
-from yubiotp.otp import YubiKey, decode_otp, encode_otp
+from yubiotp.otp import VirtualClock, YubiKey, decode_otp, decode_otp_many, encode_otp
+
+from .devicestore import (
+    SQLITE_SUFFIXES,
+    DeviceExistsError,
+    DeviceRecord,
+    NoSuchDeviceError,
+    SQLiteDeviceStore,
+    open_store,
+    read_config,
+    write_config,
+)
 
 
 def main():
@@ -31,6 +51,9 @@ def main():
         'gen': GenHandler(),
         'parse': ParseHandler(),
         'modhex': ModhexHandler(),
+        'corpus': CorpusHandler(),
+        'import': ImportHandler(),
+        'export': ExportHandler(),
     }
 
     handler = handlers.get(args[0])
@@ -84,7 +107,7 @@ class Handler(object):
             dest='config',
             default='~/.yubikey',
             metavar='PATH',
-            help='A config file to store device state. [%default]',
+            help='A config file to store device state. Paths ending in .db, .sqlite, or .sqlite3 are SQLite databases, which are much faster with many devices. [%default]',
         ),
         make_option(
             '-n',
@@ -130,7 +153,7 @@ class Handler(object):
     @classmethod
     def global_option_parser(cls):
         parser = OptionParser(
-            usage='%prog [global opts] <list|init|delete|gen|parse|modhex> [any opts] [args]',
+            usage='%prog [global opts] <list|init|delete|gen|parse|modhex|corpus|import|export> [any opts] [args]',
             description=cls.description,
         )
 
@@ -151,9 +174,50 @@ class ListHandler(Handler):
     description = 'List all virtual YubiKey devices.'
 
     def handle(self, opts, args):
-        config = configparser.ConfigParser()
-        config.read([expanduser(opts.config)])
-        config.write(sys.stdout)
+        store = open_store(expanduser(opts.config))
+        try:
+            write_config(store, sys.stdout)
+        finally:
+            store.close()
+
+
+class ImportHandler(Handler):
+    name = 'import'
+    options = []
+    args = 'path ...'
+    description = 'Add or replace devices from config files, such as a corpus manifest. This is how to move devices into an SQLite database.'
+
+    def handle(self, opts, args):
+        store = open_store(expanduser(opts.config))
+        try:
+            for path in args[1:]:
+                store.update(read_config(expanduser(path)))
+        finally:
+            store.close()
+
+
+class ExportHandler(Handler):
+    name = 'export'
+    options = [
+        make_option(
+            '-o',
+            '--output',
+            dest='output',
+            default='-',
+            metavar='PATH',
+            help='Where to write the devices in the config file format. [stdout]',
+        ),
+    ]
+    args = ''
+    description = 'Export all devices in the config file format.'
+
+    def handle(self, opts, args):
+        store = open_store(expanduser(opts.config))
+        try:
+            with open_output(opts.output, 'w') as output:
+                write_config(store, output)
+        finally:
+            store.close()
 
 
 class InitHandler(Handler):
@@ -257,13 +321,48 @@ class GenHandler(Handler):
 
 class ParseHandler(Handler):
     name = 'parse'
-    options = []
-    args = 'token ...'
-    description = (
-        'Parse tokens generated by the selected virtual device and display its fields.'
-    )
+    options = [
+        make_option(
+            '-i',
+            '--input',
+            dest='input',
+            metavar='PATH',
+            help='Read tokens from a file, one per line, or - for stdin. Each token is decoded with the key of whichever device has its public ID.',
+        ),
+        make_option(
+            '-F',
+            '--format',
+            dest='format',
+            type='choice',
+            choices=['jsonl', 'csv'],
+            default='jsonl',
+            help='The output format for --input: jsonl or csv. [%default]',
+        ),
+        make_option(
+            '-o',
+            '--output',
+            dest='output',
+            default='-',
+            metavar='PATH',
+            help='Where to write decoded tokens for --input. [stdout]',
+        ),
+        make_option(
+            '-e',
+            '--errors',
+            dest='errors',
+            default='-',
+            metavar='PATH',
+            help='Where to write tokens that could not be decoded, in the same format. [stderr]',
+        ),
+    ]
+    args = '[token ...]'
+    description = 'Parse tokens generated by the selected virtual device and display its fields. With --input, parse a stream of tokens from any of the virtual devices.'
 
     def handle(self, opts, args):
+        if opts.input is not None:
+            self.handle_stream(opts)
+            return
+
         device = Device(opts.config, opts.device_name)
         key = device.get_config('key', unhex=True)
 
@@ -281,6 +380,147 @@ class ParseHandler(Handler):
                 print('random: 0x{0:x}'.format(otp.rand))
                 print()
 
+    def handle_stream(self, opts):
+        store = open_store(expanduser(opts.config))
+        try:
+            keys = {
+                record.public_id.encode(): (record.name, unhexlify(record.key))
+                for record in store
+            }
+        finally:
+            store.close()
+
+        writer_class = PARSE_WRITERS[opts.format]
+
+        with open_input(opts.input) as lines, open_output(
+            opts.output, 'w'
+        ) as output, open_output(opts.errors, 'w', sys.stderr) as errors:
+            parse_stream(lines, keys, writer_class(output, errors))
+
+
+def parse_stream(lines, keys, writer, batch_size=10000):
+    """
+    Decodes a stream of tokens in batches.
+
+    :param lines: An iterable of tokens as bytes. Surrounding whitespace and
+        blank lines are ignored.
+    :param dict keys: Maps public IDs to (device name, AES key) pairs.
+    :param writer: Receives the results.
+    """
+    batch = []
+
+    for line in lines:
+        token = line.strip()
+        if token:
+            batch.append(token)
+            if len(batch) >= batch_size:
+                _parse_batch(batch, keys, writer)
+                batch = []
+
+    if batch:
+        _parse_batch(batch, keys, writer)
+
+
+def _parse_batch(tokens, keys, writer):
+    items = []
+    names = []
+    for token in tokens:
+        device = keys.get(token[:-32])
+        if device is None:
+            writer.write_error(token, 'Unknown public_id')
+        else:
+            items.append((token, device[1]))
+            names.append(device[0])
+
+    results = decode_otp_many(items)
+
+    for (token, key), name, result in zip(items, names, results):
+        if isinstance(result, Exception):
+            writer.write_error(token, str(result))
+        else:
+            writer.write_otp(token, name, *result)
+
+
+class JSONLinesWriter(object):
+    """
+    Writes decoded tokens as JSON objects, one per line.
+    """
+
+    def __init__(self, output, errors):
+        self.output = output
+        self.errors = errors
+
+        self._names = {}
+
+    def write_otp(self, token, name, public_id, otp):
+        quoted = self._names.get(name)
+        if quoted is None:
+            quoted = self._names[name] = json.dumps(name)
+
+        self.output.write(
+            '{{"token": "{0}", "device": {1}, "public_id": "{2}", "uid": "{3}", '
+            '"session": {4}, "timestamp": {5}, "counter": {6}, "random": {7}}}\n'.format(
+                token.decode(),
+                quoted,
+                public_id.decode(),
+                otp.uid.hex(),
+                otp.session,
+                otp.timestamp,
+                otp.counter,
+                otp.rand,
+            )
+        )
+
+    def write_error(self, token, message):
+        self.errors.write(
+            json.dumps({'token': token.decode('utf-8', 'replace'), 'error': message})
+            + '\n'
+        )
+
+
+class CSVWriter(object):
+    """
+    Writes decoded tokens as CSV, with a header row.
+    """
+
+    FIELDS = [
+        'token',
+        'device',
+        'public_id',
+        'uid',
+        'session',
+        'timestamp',
+        'counter',
+        'random',
+    ]
+
+    def __init__(self, output, errors):
+        self.output = csv.writer(output, lineterminator='\n')
+        self.errors = csv.writer(errors, lineterminator='\n')
+
+        self.output.writerow(self.FIELDS)
+        self.errors.writerow(['token', 'error'])
+
+    def write_otp(self, token, name, public_id, otp):
+        self.output.writerow(
+            [
+                token.decode(),
+                name,
+                public_id.decode(),
+                otp.uid.hex(),
+                otp.session,
+                otp.timestamp,
+                otp.counter,
+                otp.rand,
+            ]
+        )
+
+    def write_error(self, token, message):
+        self.errors.writerow([token.decode('utf-8', 'replace'), message])
+
+
+PARSE_WRITERS = {'jsonl': JSONLinesWriter, 'csv': CSVWriter}
+
 
 class ModhexHandler(Handler):
     name = 'modhex'
@@ -320,6 +560,303 @@ class ModhexHandler(Handler):
                 print(e, file=sys.stderr)
 
 
+class CorpusHandler(Handler):
+    name = 'corpus'
+    options = [
+        make_option(
+            '-d',
+            '--devices',
+            dest='devices',
+            type='int',
+            default=100,
+            help='The number of virtual devices to simulate. [%default]',
+        ),
+        make_option(
+            '-c',
+            '--count',
+            dest='count',
+            type='int',
+            default=10000,
+            help='The total number of tokens to generate. [%default]',
+        ),
+        make_option(
+            '-o',
+            '--output',
+            dest='output',
+            default='-',
+            metavar='PATH',
+            help='Where to write tokens, one per line. [stdout]',
+        ),
+        make_option(
+            '-m',
+            '--manifest',
+            dest='manifest',
+            metavar='PATH',
+            help='Where to write the devices, in the config file format. This can be read by yubiserver.',
+        ),
+        make_option(
+            '-k',
+            '--master-key',
+            dest='master_key',
+            type='hex',
+            help='Derive device keys and private IDs from this hex-encoded secret. If omitted, they are random.',
+        ),
+        make_option(
+            '-s',
+            '--seed',
+            dest='seed',
+            help='Seed the simulation for reproducible output.',
+        ),
+        make_option(
+            '-i',
+            '--interval',
+            dest='interval',
+            type='float',
+            default=60.0,
+            help='The mean number of seconds between presses on each device. [%default]',
+        ),
+        make_option(
+            '-j',
+            '--jobs',
+            dest='jobs',
+            type='int',
+            default=1,
+            help='The number of worker processes. [%default]',
+        ),
+    ]
+    args = ''
+    description = 'Generate a large corpus of tokens from many new virtual devices for load testing. Devices press their buttons at random intervals. Each worker process simulates its own share of the devices and writes its tokens in order of simulated time, but the output of several workers is interleaved in chunks, so only the tokens of each device are guaranteed to be in order.'
+
+    def handle(self, opts, args):
+        if opts.devices < 1 or opts.jobs < 1:
+            usage('--devices and --jobs must be positive')
+
+        jobs = min(opts.jobs, opts.devices)
+        shards = [
+            CorpusShard(
+                shard,
+                jobs,
+                opts.devices,
+                opts.count,
+                seed=opts.seed,
+                master_key=(
+                    unhexlify(opts.master_key.encode()) if opts.master_key else None
+                ),
+                interval=opts.interval,
+            )
+            for shard in range(jobs)
+        ]
+
+        with open_output(opts.output) as output:
+            manifests = write_corpus(shards, output)
+
+        if opts.manifest:
+            # Shards hold alternating devices, so this restores their order.
+            records = [
+                record
+                for records in zip_longest(*manifests)
+                for record in records
+                if record is not None
+            ]
+            write_manifest(records, opts.manifest)
+
+
+class CorpusShard(object):
+    """
+    Simulates every ``jobs``-th device, starting with device ``shard``, and
+    produces its share of a token corpus.
+    """
+
+    chunk_size = 10000
+
+    def __init__(
+        self, shard, jobs, devices, count, seed=None, master_key=None, interval=60.0
+    ):
+        self.shard = shard
+        self.indexes = range(shard, devices, jobs)
+        self.count = count // jobs + (1 if shard < count % jobs else 0)
+        self.seed = seed
+        self.master_key = master_key
+        self.interval = interval
+
+        self.devices = None
+
+    def chunks(self):
+        """
+        Yields the shard's tokens in chunks of newline-terminated lines.
+        """
+        rng = self._random('schedule')
+        self.devices = [self._make_device(index) for index in self.indexes]
+
+        schedule = [
+            (rng.expovariate(1 / self.interval), position)
+            for position in range(len(self.devices))
+        ]
+        heapq.heapify(schedule)
+
+        lines = []
+        for i in range(self.count):
+            when, position = schedule[0]
+            public_id, key, cipher, clock, yubikey = self.devices[position][1:]
+
+            clock.now = when
+            otp = yubikey.generate()
+            lines.append(public_id + modhex(cipher.encrypt(otp.pack())))
+
+            heapq.heapreplace(
+                schedule, (when + rng.expovariate(1 / self.interval), position)
+            )
+
+            if len(lines) >= self.chunk_size:
+                yield b'\n'.join(lines) + b'\n'
+                lines = []
+
+        if lines:
+            yield b'\n'.join(lines) + b'\n'
+
+    def manifest(self):
+        """
+        Returns a :class:`~yubiotp.cli.devicestore.DeviceRecord` for each of
+        the shard's devices. Call this after :meth:`chunks` is exhausted so
+        that the session counters are current.
+        """
+        return [
+            DeviceRecord(
+                str(index),
+                public_id.decode(),
+                hexlify(key).decode(),
+                hexlify(yubikey.uid).decode(),
+                yubikey.session + 1,
+            )
+            for index, public_id, key, cipher, clock, yubikey in self.devices
+        ]
+
+    def _make_device(self, index):
+        secret = self._secret(index)
+        key, uid = secret[:16], secret[16:22]
+        public_id = modhex(index.to_bytes(6, 'big'))
+        clock = VirtualClock()
+        yubikey = YubiKey(uid, 0, clock=clock, seed=self._seed('device', index))
+
+        return (index, public_id, key, AES.new(key, AES.MODE_ECB), clock, yubikey)
+
+    def _secret(self, index):
+        """
+        Returns 32 bytes of key material for a device.
+        """
+        if self.master_key is not None:
+            return hmac.new(
+                self.master_key, 'device_{0}'.format(index).encode(), sha256
+            ).digest()
+        elif self.seed is not None:
+            return self._random('secret', index).getrandbits(256).to_bytes(32, 'big')
+        else:
+            return os.urandom(32)
+
+    def _seed(self, *parts):
+        if self.seed is None:
+            return None
+
+        return ':'.join(str(part) for part in (self.seed,) + parts)
+
+    def _random(self, *parts):
+        return Random(self._seed(*parts))
+
+
+def write_corpus(shards, output):
+    """
+    Runs the shards, each in its own process if there are more than one, and
+    writes their tokens to a binary stream as they arrive. Chunks from
+    different shards are not merged by time.
+
+    :returns: The manifest of each shard.
+    """
+    if len(shards) == 1:
+        shard = shards[0]
+        for chunk in shard.chunks():
+            output.write(chunk)
+
+        return [shard.manifest()]
+
+    queue = multiprocessing.Queue(maxsize=len(shards) * 4)
+    workers = [
+        multiprocessing.Process(target=_run_shard, args=(shard, queue))
+        for shard in shards
+    ]
+    for worker in workers:
+        worker.start()
+
+    manifests = [None] * len(shards)
+    running = len(shards)
+    try:
+        while running > 0:
+            shard, chunk, manifest = queue.get()
+            if isinstance(manifest, Exception):
+                raise manifest
+            elif manifest is None:
+                output.write(chunk)
+            else:
+                manifests[shard] = manifest
+                running -= 1
+    finally:
+        for worker in workers:
+            if running > 0:
+                worker.terminate()
+            worker.join()
+
+    return manifests
+
+
+def write_manifest(records, path):
+    """
+    Writes devices to an SQLite database or, for any other path, a config
+    file.
+    """
+    if path.endswith(SQLITE_SUFFIXES):
+        store = SQLiteDeviceStore(expanduser(path))
+        try:
+            store.update(records)
+        finally:
+            store.close()
+    else:
+        with open_output(path, 'w') as output:
+            write_config(records, output)
+
+
+def _run_shard(shard, queue):
+    try:
+        for chunk in shard.chunks():
+            queue.put((shard.shard, chunk, None))
+
+        queue.put((shard.shard, None, shard.manifest()))
+    except Exception as e:
+        queue.put((shard.shard, None, e))
+
+
+def open_input(path):
+    """
+    Opens a buffered binary input file, or stdin for '-'.
+    """
+    if path == '-':
+        return os.fdopen(os.dup(sys.stdin.fileno()), 'rb', buffering=1 << 20)
+    else:
+        return open(path, 'rb', buffering=1 << 20)
+
+
+def open_output(path, mode='wb', stream=None):
+    """
+    Opens a buffered output file, or a standard stream (stdout by default) for
+    '-'.
+    """
+    if path == '-':
+        if stream is None:
+            stream = sys.stdout
+        stream.flush()
+        return os.fdopen(os.dup(stream.fileno()), mode, buffering=1 << 20)
+    else:
+        return open(path, mode, buffering=1 << 20)
+
+
 def usage(message, parser=None):
     print(message)
     print()
@@ -334,45 +871,32 @@ class Device(object):
     def __init__(self, config_path, name):
         self.config_path = expanduser(config_path)
         self.name = name
-        self.section_name = 'device_{0}'.format(name)
 
-        self.config = self._load_config()
+        self.store = open_store(self.config_path)
         self.yubikey = None
 
-    def _load_config(self):
-        config = configparser.ConfigParser()
-        config.read([self.config_path])
-
-        return config
+        self._record = None
 
     def create(self, public_id, key, uid, session):
         if len(key) != 32:
             raise ValueError('AES keys must be exactly 16 bytes')
 
         try:
-            self.config.add_section(self.section_name)
-        except configparser.DuplicateSectionError:
+            self.store.add(DeviceRecord(self.name, public_id, key, uid, int(session)))
+        except DeviceExistsError:
             usage('A device named "{0}" already exists.'.format(self.name))
-        else:
-            self.set_config('public_id', public_id)
-            self.set_config('key', key)
-            self.set_config('uid', uid)
-            self.set_config('session', session)
 
     def delete(self):
         try:
-            self.config.remove_section(self.section_name)
-        except configparser.NoSectionError:
+            self.store.remove(self.name)
+        except NoSuchDeviceError:
             usage('The device named "{0}" does not exist.'.format(self.name))
 
     def gen_token(self):
         self.ensure_yubikey()
 
         otp = self.yubikey.generate()
-        key = self.get_config('key', unhex=True)
-        public_id = self.get_config('public_id').encode()
-
-        token = encode_otp(otp, key, public_id=public_id)
+        token = encode_otp(otp, self._key, public_id=self._public_id)
 
         return token
 
@@ -380,9 +904,12 @@ class Device(object):
         if self.yubikey is None:
             try:
                 uid = self.get_config('uid', unhex=True)
-                session = int(self.get_config('session'))
+                self._key = self.get_config('key', unhex=True)
+                self._public_id = self.get_config('public_id').encode()
 
-                self.get_config('key')
+                # Claim a session now, so that concurrent users of the store
+                # can't generate the same tokens.
+                session = self.store.reserve_session(self.name)
             except Exception as e:
                 usage(
                     'The device named "{0}" does not exist or is corrupt. ({1})'.format(
@@ -395,22 +922,24 @@ class Device(object):
         return self.yubikey
 
     def save(self):
-        if self.yubikey is not None:
-            self.set_config('session', self.yubikey.session + 1)
-
-        with open(self.config_path, 'w') as f:
-            self.config.write(f)
+        try:
+            if self.yubikey is not None:
+                self.store.update_session(self.name, self.yubikey.session + 1)
+        finally:
+            self.store.close()
 
     def get_config(self, key, unhex=False):
-        value = self.config.get(self.section_name, key)
+        if self._record is None:
+            self._record = self.store.get(self.name)
+            if self._record is None:
+                raise NoSuchDeviceError(self.name)
+
+        value = str(getattr(self._record, key))
         if unhex:
             value = unhexlify(value.encode())
 
         return value
 
-    def set_config(self, key, value):
-        self.config.set(self.section_name, key, str(value))
-
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,150 @@
+"""
+Runs a local Yubico validation server (protocol version 2.0) for the virtual
+devices managed by the yubikey command.
+"""
+
+import asyncio
+from base64 import b64decode
+from binascii import unhexlify
+import configparser
+from optparse import OptionParser
+from os.path import expanduser
+import sqlite3
+import sys
+
+from yubiotp.cli.devicestore import open_store
+from yubiotp.keystore import MemoryKeyStore
+from yubiotp.server import ValidationServer
+from yubiotp.validator import Validator
+
+
+def main():
+    options, args = parse_args()
+
+    try:
+        clients = parse_clients(options.clients)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    store = MemoryKeyStore()
+    try:
+        load_devices(expanduser(options.config), store)
+    except (configparser.Error, sqlite3.Error) as e:
+        print('Unable to load devices: {0}'.format(e), file=sys.stderr)
+        sys.exit(1)
+
+    server = ValidationServer(Validator(store), clients, options.path)
+
+    print(
+        'Serving {0} devices on http://{1}:{2}{3}'.format(
+            len(store), options.host, options.port, options.path
+        ),
+        file=sys.stderr,
+    )
+
+    try:
+        asyncio.run(serve(server, options.host, options.port))
+    except KeyboardInterrupt:
+        pass
+
+
+async def serve(server, host, port):
+    listener = await server.start(host, port)
+
+    async with listener:
+        await listener.serve_forever()
+
+
+def parse_args():
+    parser = OptionParser(
+        usage='%prog [options]',
+        description="Runs a Yubico validation server (protocol version 2.0) that verifies tokens from the virtual devices in a yubikey config file or SQLite database, such as a corpus manifest. If you don't supply any clients, all API ids are accepted and responses are not signed.",
+    )
+
+    parser.add_option(
+        '-f',
+        '--config',
+        dest='config',
+        default='~/.yubikey',
+        metavar='PATH',
+        help='The yubikey config file or SQLite database with the devices to accept. [%default]',
+    )
+    parser.add_option(
+        '-H',
+        '--host',
+        dest='host',
+        default='127.0.0.1',
+        help='The address to listen on. [%default]',
+    )
+    parser.add_option(
+        '-p',
+        '--port',
+        dest='port',
+        type='int',
+        default=8000,
+        help='The port to listen on. [%default]',
+    )
+    parser.add_option(
+        '-c',
+        '--client',
+        dest='clients',
+        action='append',
+        default=[],
+        metavar='ID[:KEY]',
+        help='An API id and optional base64-encoded API key. May be repeated.',
+    )
+    parser.add_option(
+        '--path',
+        dest='path',
+        default='/wsapi/2.0/verify',
+        help='The URL path of the verify endpoint. [%default]',
+    )
+
+    options, args = parser.parse_args()
+
+    return options, args
+
+
+def parse_clients(specs):
+    """
+    Parses --client options into a mapping of API ids to raw keys, or ``None``
+    if there are none.
+    """
+    if not specs:
+        return None
+
+    clients = {}
+    for spec in specs:
+        api_id, _, api_key = spec.partition(':')
+        try:
+            clients[api_id] = b64decode(api_key.encode(), validate=True) or None
+        except ValueError:
+            raise ValueError('Invalid API key for client {0}'.format(api_id))
+
+    return clients
+
+
+def load_devices(path, store):
+    """
+    Adds every device in a yubikey device store (an INI config file or an
+    SQLite database) to a key store.
+    """
+    devices = open_store(path)
+
+    try:
+        for record in devices:
+            try:
+                store.add(
+                    record.public_id.encode(),
+                    unhexlify(record.key.encode()),
+                    unhexlify(record.uid.encode()),
+                )
+            except ValueError as e:
+                print('Skipping {0}: {1}'.format(record.name, e), file=sys.stderr)
+    finally:
+        devices.close()
+
+
+if __name__ == '__main__':
+    main()
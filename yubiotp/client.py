@@ -1,10 +1,17 @@
 from base64 import b64decode, b64encode
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from hashlib import sha1
 import hmac
-from random import choice
+import os
+import queue
 import string
-from urllib.parse import urlencode
-from urllib.request import urlopen
+import threading
+import time
+from urllib.parse import quote_plus, urlencode
+
+from .metrics import NULL_TRACE, RequestTrace
+from .pool import ConnectionPool, fetch, uses_proxy
 
 
 class YubiClient10(object):
@@ -22,14 +29,83 @@ class YubiClient10(object):
         The base URL of the validation service. Set this if you want to use a
         custom validation service. Defaults to
         ``'http[s]://api.yubico.com/wsapi/verify'``.
+
+    .. attribute:: pool
+
+        The :class:`~yubiotp.pool.ConnectionPool` that keeps connections to the
+        validation service alive between requests. Set this to ``None`` to open
+        a new connection for every request. Requests that need to go through a
+        proxy always use a new connection.
+
+    .. attribute:: observers
+
+        A list of :class:`~yubiotp.metrics.ClientObserver` objects to notify
+        as each request finishes. See :mod:`yubiotp.metrics`.
+
+    .. attribute:: replay_cache
+
+        An optional :class:`ReplayCache`. Tokens found there are answered
+        locally with a :class:`LocalResponse` whose status is
+        ``'REPLAYED_OTP'``, and tokens that verify successfully are added to
+        it. Defaults to ``None``.
+
+    If the API credentials and other request parameters won't change, call
+    :meth:`prepare` to speed up request signing.
+
+    The client keeps health statistics for each server (see
+    :meth:`server_stats`). Two features build on them, and both are off by
+    default:
+
+    * A circuit breaker. If :attr:`failure_threshold` is set, a server's
+      circuit opens after that many consecutive connection or HTTP errors, and
+      the server is skipped for :attr:`reset_timeout` seconds. After that, one
+      request is let through as a probe: if it succeeds, the circuit closes
+      again. While every server's circuit is open, :meth:`verify` returns a
+      :class:`LocalResponse` with the status ``'CIRCUIT_OPEN'`` instead of
+      sending a request (or raising an exception).
+
+    * Adaptive socket timeouts. If :attr:`adaptive_timeout` is ``True``, the
+      socket timeout for each server is its smoothed latency plus four times
+      its smoothed deviation, but no less than :attr:`min_socket_timeout`.
+      Otherwise, requests wait as long as the operating system allows.
+
+    .. attribute:: failure_threshold
+
+        Consecutive failures that open a server's circuit, or ``None`` (the
+        default) to disable the circuit breaker.
+
+    .. attribute:: reset_timeout
+
+        Seconds a circuit stays open before a probe. Defaults to 30.
+
+    .. attribute:: adaptive_timeout
+
+        Whether socket timeouts follow observed latency. Defaults to
+        ``False``.
+
+    .. attribute:: min_socket_timeout
+
+        The lower bound for adaptive socket timeouts. Defaults to 2 seconds.
     """
 
     _NONCE_CHARS = string.ascii_letters + string.digits
 
+    failure_threshold = None
+    reset_timeout = 30.0
+    adaptive_timeout = False
+    min_socket_timeout = 2.0
+
     def __init__(self, api_id=1, api_key=None, ssl=False):
         self.api_id = api_id
         self.api_key = api_key
         self.ssl = ssl
+        self.pool = ConnectionPool()
+        self.observers = []
+        self.replay_cache = None
+
+        self._prepared = None
+        self._server_stats = {}
+        self._server_stats_lock = threading.Lock()
 
     def verify(self, token):
         """
@@ -38,20 +114,127 @@ class YubiClient10(object):
         :param str token: A modhex-encoded YubiKey OTP, as generated by a YubiKey
             device.
 
-        :returns: A response from the validation service.
+        :returns: A response from the validation service, or a
+            :class:`LocalResponse` if the token was answered locally.
         :rtype: :class:`YubiResponse`
         """
-        nonce = self.nonce()
+        trace = self._start_trace(token)
 
-        url = self.url(token, nonce)
-        stream = urlopen(url)
-        response = YubiResponse(
-            stream.read().decode('utf-8'), self.api_key, token, nonce
-        )
-        stream.close()
+        response = self._check_replay_cache(token)
+        if response is not None:
+            self._finish_trace(trace, None, response)
+            return response
+
+        try:
+            nonce = self.nonce()
+            trace.mark('nonce')
+
+            query = self.param_string(token, nonce)
+            trace.mark('url')
+        except Exception as e:
+            self._finish_trace(trace, self.base_url, error=e)
+            raise
+
+        base_url, response, error = self._send(token, nonce, query, trace)
+        if error is not None:
+            self._finish_trace(trace, base_url, error=error)
+            raise error
+
+        self._update_replay_cache(token, response)
+        self._finish_trace(trace, base_url, response)
 
         return response
 
+    def _send(self, token, nonce, query, trace):
+        """
+        Sends a prepared request.
+
+        :returns: The server we asked, and either its response or the
+            exception raised while asking it.
+        :rtype: ``(base_url, response, error)``
+        """
+        base_url = self.base_url
+
+        try:
+            response = self._request_server(base_url, token, nonce, query, trace)
+        except Exception as e:
+            return (base_url, None, e)
+
+        if response is None:
+            response = LocalResponse('CIRCUIT_OPEN', token, nonce)
+        else:
+            self._get_server_stats(base_url).win()
+
+        return (base_url, response, None)
+
+    def verify_many(self, tokens, max_workers=8, ordered=True, window=None):
+        """
+        Verify a stream of tokens concurrently on a pool of threads. Tokens are
+        consumed lazily and at most ``window`` requests are outstanding at a
+        time, so this is suitable for arbitrarily long inputs.
+
+        :param tokens: An iterable of tokens.
+        :param int max_workers: The number of threads.
+        :param bool ordered: If ``True``, results are produced in input order.
+            Otherwise, they are produced as they complete.
+        :param int window: The maximum number of tokens submitted but not yet
+            produced. Defaults to twice ``max_workers``.
+
+        :returns: A generator of ``(token, result)`` pairs, where ``result`` is
+            either a :class:`YubiResponse` or the exception raised while
+            verifying the token.
+        """
+        if window is None:
+            window = max_workers * 2
+
+        window = max(window, max_workers, 1)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            try:
+                for token in tokens:
+                    pending.append((token, executor.submit(self.verify, token)))
+                    while len(pending) >= window:
+                        yield self._next_result(pending, ordered)
+
+                while pending:
+                    yield self._next_result(pending, ordered)
+            finally:
+                for token, future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def _next_result(pending, ordered):
+        """
+        Removes a finished request from the pending queue and returns its
+        token and result.
+        """
+        if ordered:
+            token, future = pending.popleft()
+        else:
+            done, _ = wait(
+                [future for token, future in pending], return_when=FIRST_COMPLETED
+            )
+            for index, (token, future) in enumerate(pending):
+                if future in done:
+                    del pending[index]
+                    break
+
+        try:
+            result = future.result()
+        except Exception as e:
+            result = e
+
+        return (token, result)
+
+    def close(self):
+        """
+        Closes the client's pooled connections. The client remains usable,
+        but will no longer keep connections alive.
+        """
+        if self.pool is not None:
+            self.pool.close()
+
     def url(self, token, nonce=None):
         """
         Generates the validation URL without sending a request.
@@ -85,16 +268,172 @@ class YubiClient10(object):
     def base_url(self):
         delattr(self, '_base_url')
 
+    def server_stats(self):
+        """
+        Returns the health of each server that has been sent requests: counters
+        of requests sent, wins, errors, responses discarded because another
+        server won, and requests rejected by the circuit breaker; mean, 95th
+        percentile, and smoothed latencies in seconds; the smoothed error rate;
+        the current socket timeout; and the circuit state (``'closed'``,
+        ``'open'``, or ``'half-open'``).
+
+        :rtype: dict
+        """
+        with self._server_stats_lock:
+            servers = dict(self._server_stats)
+
+        snapshots = {}
+        for url, stats in servers.items():
+            snapshot = snapshots[url] = stats.snapshot()
+            snapshot['timeout'] = self._socket_timeout(stats)
+
+        return snapshots
+
+    def _request_server(
+        self, base_url, token, nonce, query, trace=NULL_TRACE, finished=None
+    ):
+        """
+        Sends a request to one server, subject to its circuit breaker, and
+        records the outcome. Returns ``None`` if the circuit is open.
+        """
+        stats = self._get_server_stats(base_url)
+        if (finished is None) and not stats.allow_request(self.reset_timeout):
+            return None
+
+        url = '{0}?{1}'.format(base_url, query)
+        start = time.perf_counter()
+        try:
+            body = self._fetch(
+                url,
+                trace=trace,
+                timeout=self._socket_timeout(stats),
+                discard=finished,
+            )
+            response = YubiResponse(body, self.api_key, token, nonce)
+            trace.mark('parse')
+        except Exception:
+            stats.record(
+                time.perf_counter() - start,
+                error=True,
+                threshold=self.failure_threshold,
+            )
+            raise
+
+        stats.record(
+            time.perf_counter() - start,
+            late=(finished is not None) and finished.is_set(),
+        )
+
+        return response
+
+    def _socket_timeout(self, stats):
+        if not self.adaptive_timeout:
+            return None
+
+        timeout = stats.timeout(self.min_socket_timeout)
+        cap = self._max_socket_timeout()
+        if (timeout is not None) and (cap is not None):
+            timeout = min(timeout, cap)
+        elif timeout is None:
+            timeout = cap
+
+        return timeout
+
+    def _max_socket_timeout(self):
+        return None
+
+    def _get_server_stats(self, base_url):
+        with self._server_stats_lock:
+            stats = self._server_stats.get(base_url)
+            if stats is None:
+                stats = self._server_stats[base_url] = _ServerStats()
+
+        return stats
+
+    def _fetch(self, url, trace=NULL_TRACE, timeout=None, discard=None):
+        if (self.pool is None) or uses_proxy(url):
+            body = fetch(url, timeout, trace)
+        else:
+            body = self.pool.request(url, timeout=timeout, trace=trace, discard=discard)
+
+        return body
+
+    def _check_replay_cache(self, token):
+        """
+        Returns a local response if the token is in the replay cache.
+        """
+        cache = self.replay_cache
+
+        if (cache is not None) and (token in cache):
+            return LocalResponse('REPLAYED_OTP', token)
+
+        return None
+
+    def _update_replay_cache(self, token, response):
+        cache = self.replay_cache
+
+        if (cache is not None) and response.is_ok():
+            cache.add(token)
+
+    def _start_trace(self, token):
+        return RequestTrace(token) if self.observers else NULL_TRACE
+
+    def _finish_trace(self, trace, base_url, response=None, error=None):
+        """
+        Records the outcome of a request and notifies the observers.
+        """
+        if trace is NULL_TRACE:
+            return
+
+        trace.base_url = base_url
+        if response is not None:
+            trace.status = response.status()
+            trace.mark('validate')
+        else:
+            trace.status = 'ERROR'
+            trace.error = error
+
+        for observer in self.observers:
+            observer.request_finished(trace)
+
     def default_base_url(self):
         if self.ssl:
             return 'https://api.yubico.com/wsapi/verify'
         else:
             return 'http://api.yubico.com/wsapi/verify'
 
+    def prepare(self):
+        """
+        Precomputes everything about a request that doesn't depend on the
+        token or nonce: the HMAC key schedule, the signed parameter prefix,
+        and the static parts of the query string. Subsequent URLs are built
+        from this snapshot, so call this again (or :meth:`unprepare`) after
+        changing any request parameters, such as :attr:`api_key`.
+
+        >>> client = YubiClient20(7, b'secret', timestamp=True, sl=50)
+        >>> url = client.url('cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl', 'abcdefghijklmnop')
+        >>> client.prepare().url('cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl', 'abcdefghijklmnop') == url
+        True
+
+        :returns: ``self``
+        """
+        self._prepared = _PreparedParams.for_client(self)
+
+        return self
+
+    def unprepare(self):
+        """
+        Discards the snapshot taken by :meth:`prepare`.
+        """
+        self._prepared = None
+
     def nonce(self):
-        return ''.join(choice(self._NONCE_CHARS) for i in range(32))
+        return _NonceSource.for_chars(self._NONCE_CHARS).take(32)
 
     def param_string(self, token, nonce):
+        if self._prepared is not None:
+            return self._prepared.param_string(token, nonce)
+
         params = self.params(token, nonce)
 
         if self.api_key is not None:
@@ -162,8 +501,42 @@ class YubiClient20(YubiClient11):
         The base URL of the validation service. Set this if you want to use a
         custom validation service. Defaults to
         ``'http[s]://api.yubico.com/wsapi/2.0/verify'``.
+
+    .. attribute:: base_urls
+
+        A list of equivalent validation servers. If there is more than one,
+        :meth:`verify` sends each token to the server that has been fastest so
+        far and, if it hasn't answered within :attr:`hedge_delay`, to the next
+        one as well. The first valid response wins and the rest are discarded.
+        Defaults to ``[base_url]``.
+
+    .. attribute:: hedge_delay
+
+        Seconds to wait for a server before also asking the next one. If this
+        is ``None`` (the default), we use the 95th percentile of the first
+        server's observed latency.
+
+    .. attribute:: max_hedge_workers
+
+        Hedged requests run on a thread pool shared by all calls to
+        :meth:`verify`, with at most this many threads. Defaults to 16. A
+        request that loses the race runs until it finishes or times out, and
+        its connection is then closed rather than reused. Requests still
+        waiting for a thread when the race is decided are never sent.
+
+    Adaptive socket timeouts (see :class:`YubiClient10`) are capped by
+    :attr:`timeout` when that is set.
     """
 
+    hedge_delay = None
+    default_hedge_delay = 0.1
+    min_hedge_samples = 20
+    max_hedge_workers = 16
+
+    # Statuses that a hedged request may cause by itself: once one server has
+    # accepted a token, its peers will report it as replayed.
+    _HEDGE_REPLAY_STATUSES = ('REPLAYED_OTP', 'REPLAYED_REQUEST')
+
     def __init__(
         self, api_id=1, api_key=None, ssl=False, timestamp=False, sl=None, timeout=None
     ):
@@ -172,6 +545,167 @@ class YubiClient20(YubiClient11):
         self.sl = sl
         self.timeout = timeout
 
+        self._base_urls = None
+        self._hedge_executor = None
+        self._hedge_executor_lock = threading.Lock()
+
+    def close(self):
+        super(YubiClient20, self).close()
+
+        with self._hedge_executor_lock:
+            executor, self._hedge_executor = self._hedge_executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _send(self, token, nonce, query, trace):
+        if self._base_urls is None or len(self._base_urls) < 2:
+            return super(YubiClient20, self)._send(token, nonce, query, trace)
+
+        result = self._verify_hedged(token, nonce, query)
+        trace.mark('read')
+
+        return result
+
+    @property
+    def base_urls(self):
+        if self._base_urls is None:
+            return [self.base_url]
+        else:
+            return list(self._base_urls)
+
+    @base_urls.setter
+    def base_urls(self, urls):
+        urls = list(urls)
+        if not urls:
+            raise ValueError('base_urls may not be empty')
+
+        self._base_urls = urls
+        self.base_url = urls[0]
+
+    def _verify_hedged(self, token, nonce, query):
+        urls = self._rank_servers()
+        results = queue.Queue()
+        finished = threading.Event()
+
+        def request(base_url):
+            try:
+                response = self._request_server(
+                    base_url, token, nonce, query, finished=finished
+                )
+            except Exception as e:
+                results.put((base_url, None, e))
+            else:
+                results.put((base_url, response, None))
+
+        executor = self._get_hedge_executor()
+        futures = []
+
+        def launch():
+            # Skip servers whose circuit opened after we ranked them.
+            while urls:
+                base_url = urls.pop(0)
+                if self._get_server_stats(base_url).allow_request(self.reset_timeout):
+                    futures.append((base_url, executor.submit(request, base_url)))
+                    return True
+
+            return False
+
+        if not urls:
+            return (None, LocalResponse('CIRCUIT_OPEN', token, nonce), None)
+
+        delay = self._hedge_delay(urls[0])
+        in_flight = 1 if launch() else 0
+        held = None
+        fallback = None
+        error = None
+
+        try:
+            while in_flight > 0:
+                try:
+                    base_url, response, e = results.get(timeout=delay if urls else None)
+                except queue.Empty:
+                    if launch():
+                        in_flight += 1
+                    continue
+
+                in_flight -= 1
+
+                if e is not None:
+                    error = (base_url, None, e)
+                    if launch():
+                        in_flight += 1
+                elif not response.is_valid():
+                    fallback = (base_url, response, None)
+                    if launch():
+                        in_flight += 1
+                elif response.fields.get('status') in self._HEDGE_REPLAY_STATUSES:
+                    # This may be our own request echoing back from a peer.
+                    # Hold it until the others have answered.
+                    if held is None:
+                        held = (base_url, response, None)
+                else:
+                    self._get_server_stats(base_url).win()
+                    return (base_url, response, None)
+        finally:
+            finished.set()
+            for base_url, future in futures:
+                if future.cancel():
+                    self._get_server_stats(base_url).cancel_probe()
+
+        if held is not None:
+            self._get_server_stats(held[0]).win()
+            return held
+        elif fallback is not None:
+            return fallback
+        elif error is not None:
+            return error
+        else:
+            return (None, LocalResponse('CIRCUIT_OPEN', token, nonce), None)
+
+    def _get_hedge_executor(self):
+        with self._hedge_executor_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    self.max_hedge_workers, thread_name_prefix='yubiotp-hedge'
+                )
+
+            return self._hedge_executor
+
+    def _max_socket_timeout(self):
+        return float(self.timeout) if (self.timeout is not None) else None
+
+    def _rank_servers(self):
+        """
+        Orders the available servers by smoothed latency, with unmeasured
+        servers in their configured order ahead of the rest. Servers whose
+        circuits are open are left out.
+        """
+        with self._server_stats_lock:
+            stats = dict(self._server_stats)
+
+        def latency(indexed):
+            index, url = indexed
+            srtt = stats[url].srtt if url in stats else None
+
+            return (srtt is not None, srtt or 0, index)
+
+        return [
+            url
+            for index, url in sorted(enumerate(self.base_urls), key=latency)
+            if (url not in stats) or stats[url].is_available(self.reset_timeout)
+        ]
+
+    def _hedge_delay(self, base_url):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+
+        delay = self._get_server_stats(base_url).percentile(
+            0.95, self.min_hedge_samples
+        )
+
+        return delay if (delay is not None) else self.default_hedge_delay
+
     def default_base_url(self):
         if self.ssl:
             return 'https://api.yubico.com/wsapi/2.0/verify'
@@ -192,34 +726,281 @@ class YubiClient20(YubiClient11):
         return params
 
 
+class _ServerStats(object):
+    """
+    Thread-safe health counters and circuit breaker for one server.
+
+    Latency is smoothed as in TCP's retransmission timer (RFC 6298): ``srtt``
+    is the smoothed latency and ``rttvar`` its smoothed mean deviation.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    LATENCY_GAIN = 1 / 8
+    DEVIATION_GAIN = 1 / 4
+    ERROR_GAIN = 1 / 16
+
+    def __init__(self, window=256):
+        self.requests = 0
+        self.wins = 0
+        self.errors = 0
+        self.discarded = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=window)
+
+        self.srtt = None
+        self.rttvar = None
+        self.error_rate = 0.0
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+        self._lock = threading.Lock()
+
+    def allow_request(self, reset_timeout):
+        """
+        Returns ``True`` if a request may be sent. An open circuit becomes
+        half-open after ``reset_timeout`` seconds and admits a single probe.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and (
+                time.monotonic() - self.opened_at >= reset_timeout
+            ):
+                self.state = self.HALF_OPEN
+                return True
+
+            self.rejected += 1
+
+            return False
+
+    def cancel_probe(self):
+        """
+        Gives back a probe that :meth:`allow_request` admitted but that was
+        never sent, so that the next request may probe instead.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def is_available(self, reset_timeout):
+        with self._lock:
+            return (self.state == self.CLOSED) or (
+                self.state == self.OPEN
+                and time.monotonic() - self.opened_at >= reset_timeout
+            )
+
+    def record(self, latency, error=False, late=False, threshold=None):
+        with self._lock:
+            self.requests += 1
+            self.error_rate += ((1.0 if error else 0.0) - self.error_rate) * (
+                self.ERROR_GAIN
+            )
+
+            if error:
+                self.errors += 1
+                self.failures += 1
+                if (self.state == self.HALF_OPEN) or (
+                    threshold is not None and self.failures >= threshold
+                ):
+                    self.state = self.OPEN
+                    self.opened_at = time.monotonic()
+            else:
+                self.failures = 0
+                self.state = self.CLOSED
+                self.latencies.append(latency)
+                self._smooth(latency)
+                if late:
+                    self.discarded += 1
+
+    def _smooth(self, latency):
+        if self.srtt is None:
+            self.srtt = latency
+            self.rttvar = latency / 2
+        else:
+            self.rttvar += (abs(self.srtt - latency) - self.rttvar) * (
+                self.DEVIATION_GAIN
+            )
+            self.srtt += (latency - self.srtt) * self.LATENCY_GAIN
+
+    def timeout(self, minimum):
+        """
+        Returns a socket timeout derived from the observed latency, or
+        ``None`` if there are no observations yet.
+        """
+        with self._lock:
+            if self.srtt is None:
+                return None
+
+            return max(self.srtt + 4 * self.rttvar, minimum)
+
+    def win(self):
+        with self._lock:
+            self.wins += 1
+
+    def mean_latency(self):
+        with self._lock:
+            latencies = list(self.latencies)
+
+        return (sum(latencies) / len(latencies)) if latencies else None
+
+    def percentile(self, fraction, min_samples=1):
+        with self._lock:
+            latencies = sorted(self.latencies)
+
+        if len(latencies) < max(min_samples, 1):
+            return None
+
+        return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+    def snapshot(self):
+        with self._lock:
+            counters = {
+                'requests': self.requests,
+                'wins': self.wins,
+                'errors': self.errors,
+                'discarded': self.discarded,
+                'rejected': self.rejected,
+                'state': self.state,
+                'srtt': self.srtt,
+                'error_rate': self.error_rate,
+            }
+
+        counters['mean_latency'] = self.mean_latency()
+        counters['p95_latency'] = self.percentile(0.95)
+
+        return counters
+
+
 class YubiResponse(object):
     """
     A response from the Yubico validation service.
 
+    The response body is parsed the first time a field is needed, and the
+    results of the validity checks are computed once and remembered. Assigning
+    to :attr:`raw`, :attr:`fields`, or :attr:`signature` discards the
+    remembered checks, but changes made to :attr:`fields` in place are not
+    noticed.
+
+    :param raw: The response body, as bytes or str.
+    :param bytes api_key: The API key used to sign the request, if any.
+    :param str token: The token we sent.
+    :param str nonce: The nonce we sent, if any.
+
     .. attribute:: fields
 
         A dictionary of the response fields (excluding 'h').
+
+    >>> raw = b'otp=cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl\\r\\nnonce=abc\\r\\nsessioncounter=3\\r\\nstatus=OK\\r\\n'
+    >>> response = YubiResponse(raw, None, 'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl', 'abc')
+    >>> response.is_ok(), response.status()
+    (True, 'OK')
+    >>> response.sessioncounter, response.sessionuse
+    (3, None)
+    >>> response.public_id
+    'cclngiuv'
     """
 
+    __slots__ = [
+        '_raw',
+        'api_key',
+        'token',
+        'nonce',
+        '_fields',
+        '_signature',
+        '_checks',
+    ]
+
     def __init__(self, raw, api_key, token, nonce):
-        self.raw = raw
+        self._raw = raw
         self.api_key = api_key
         self.token = token
         self.nonce = nonce
 
-        self.fields = {}
-        self.signature = None
+        self._fields = None
+        self._signature = None
+        self._checks = None
+
+    @property
+    def raw(self):
+        """
+        The response body as a string.
+        """
+        if isinstance(self._raw, bytes):
+            self._raw = self._raw.decode('utf-8', 'replace')
 
-        self._parse_response()
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw):
+        self._raw = raw
+        self._fields = None
+        self._signature = None
+        self._checks = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._parse_response()
+
+        return self._fields
+
+    @fields.setter
+    def fields(self, fields):
+        if self._fields is None:
+            self._parse_response()
+
+        self._fields = fields
+        self._checks = None
+
+    @property
+    def signature(self):
+        """
+        The decoded signature from the response, or ``None``.
+        """
+        if self._fields is None:
+            self._parse_response()
+
+        return self._signature
+
+    @signature.setter
+    def signature(self, signature):
+        if self._fields is None:
+            self._parse_response()
+
+        self._signature = signature
+        self._checks = None
 
     def _parse_response(self):
-        self.fields = dict(
-            tuple(line.split('=', 1)) for line in self.raw.splitlines() if '=' in line
-        )
+        raw = self._raw
+
+        if isinstance(raw, bytes):
+            fields = {}
+            for line in raw.splitlines():
+                key, sep, value = line.partition(b'=')
+                if sep:
+                    fields[key.decode('utf-8', 'replace')] = value.decode(
+                        'utf-8', 'replace'
+                    )
+        else:
+            fields = dict(
+                tuple(line.split('=', 1)) for line in raw.splitlines() if '=' in line
+            )
 
-        if 'h' in self.fields:
-            self.signature = b64decode(self.fields['h'].encode())
-            del self.fields['h']
+        signature = fields.pop('h', None)
+        if signature is not None:
+            try:
+                signature = b64decode(signature.encode())
+            except ValueError:
+                signature = b''
+
+        self._fields = fields
+        self._signature = signature
 
     def is_ok(self):
         """
@@ -251,16 +1032,17 @@ class YubiResponse(object):
         :returns: ``True`` if none of the validity checks fail.
         :rtype: bool
         """
-        results = [
-            self.is_signature_valid(),
-            self.is_token_valid(),
-            self.is_nonce_valid(),
-        ]
+        if self._checks is None:
+            self._checks = (
+                self.is_signature_valid(),
+                self.is_token_valid(),
+                self.is_nonce_valid(),
+            )
 
         if strict:
-            is_valid = all(results)
+            is_valid = all(self._checks)
         else:
-            is_valid = False not in results
+            is_valid = False not in self._checks
 
         return is_valid
 
@@ -272,9 +1054,14 @@ class YubiResponse(object):
             request. ``False`` if the signature is invalid.
         :rtype: bool
         """
+        if self._checks is not None:
+            return self._checks[0]
+
         if self.api_key is not None:
             signature = param_signature(self.fields.items(), self.api_key)
-            is_valid = signature == self.signature
+            is_valid = (self.signature is not None) and hmac.compare_digest(
+                signature, self.signature
+            )
         else:
             is_valid = True
 
@@ -289,6 +1076,9 @@ class YubiResponse(object):
             contain a token.
         :rtype: bool for a positive result or ``None`` for an ambiguous result.
         """
+        if self._checks is not None:
+            return self._checks[1]
+
         if 'otp' in self.fields:
             is_valid = self.fields['otp'] == self.token
         else:
@@ -306,6 +1096,9 @@ class YubiResponse(object):
             true of error responses.
         :rtype: bool for a positive result or ``None`` for an ambiguous result.
         """
+        if self._checks is not None:
+            return self._checks[2]
+
         reply = self.fields.get('nonce')
 
         if (self.nonce is not None) and (reply is None):
@@ -329,6 +1122,382 @@ class YubiResponse(object):
 
         return public_id
 
+    @property
+    def timestamp(self):
+        """
+        The YubiKey's internal timestamp (8 Hz), if the response includes it.
+
+        :rtype: int or ``None``
+        """
+        return self._int_field('timestamp')
+
+    @property
+    def sessioncounter(self):
+        """
+        The YubiKey's non-volatile usage counter, if the response includes it.
+
+        :rtype: int or ``None``
+        """
+        return self._int_field('sessioncounter')
+
+    @property
+    def sessionuse(self):
+        """
+        The YubiKey's volatile usage counter, if the response includes it.
+
+        :rtype: int or ``None``
+        """
+        return self._int_field('sessionuse')
+
+    @property
+    def sl(self):
+        """
+        The percentage of servers that were synchronized, if the response
+        includes it.
+
+        :rtype: int or ``None``
+        """
+        return self._int_field('sl')
+
+    def _int_field(self, name):
+        try:
+            return int(self.fields[name])
+        except (KeyError, ValueError):
+            return None
+
+
+class LocalResponse(YubiResponse):
+    """
+    A response made up by the client without asking a validation server, for
+    example because every server's circuit breaker is open. It carries the
+    token, the nonce, and a status that no server would send, so
+    :meth:`~YubiResponse.is_ok` is always ``False``.
+
+    :param str status: The status, such as ``'CIRCUIT_OPEN'``.
+    :param str token: The token that was to be verified.
+    :param str nonce: The nonce that was to be sent, if any.
+
+    >>> response = LocalResponse('CIRCUIT_OPEN', 'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl')
+    >>> response.is_ok(), response.status()
+    (False, 'CIRCUIT_OPEN')
+    """
+
+    __slots__ = []
+
+    def __init__(self, status, token, nonce=None):
+        fields = [('otp', token), ('status', status)]
+        if nonce is not None:
+            fields.insert(1, ('nonce', nonce))
+
+        super(LocalResponse, self).__init__(
+            ''.join('{0}={1}\r\n'.format(*field) for field in fields),
+            None,
+            token,
+            nonce,
+        )
+
+
+class ReplayCache(object):
+    """
+    A bounded, thread-safe record of tokens that a validation server has
+    recently accepted. Set a client's ``replay_cache`` to one of these to
+    answer repeated tokens locally, without a round trip.
+
+    Entries expire ``ttl`` seconds after they are added, and the oldest are
+    evicted first when the cache is full. Tokens are at most 64 characters,
+    so memory use is bounded by ``maxsize``.
+
+    :param int maxsize: The maximum number of tokens to remember.
+    :param float ttl: Seconds to remember each token.
+    :param clock: A function returning the current time in seconds.
+
+    .. attribute:: hits
+
+    .. attribute:: misses
+
+    .. attribute:: evictions
+
+    >>> now = [0]
+    >>> cache = ReplayCache(maxsize=2, ttl=60, clock=lambda: now[0])
+    >>> cache.add('token1')
+    >>> 'token1' in cache
+    True
+    >>> cache.add('token2')
+    >>> cache.add('token3')
+    >>> 'token1' in cache
+    False
+    >>> now[0] = 61
+    >>> 'token3' in cache
+    False
+    >>> cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 3, 'size': 0, 'maxsize': 2}
+    True
+    """
+
+    MAX_TOKEN_LENGTH = 64
+
+    def __init__(self, maxsize=10000, ttl=300.0, clock=time.monotonic):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Every entry has the same lifetime, so insertion order is also
+        # expiration order.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, token):
+        now = self.clock()
+
+        with self._lock:
+            self._expire(now)
+
+            if token in self._entries:
+                self.hits += 1
+                return True
+
+            self.misses += 1
+
+        return False
+
+    def add(self, token):
+        """
+        Remembers a token that a server has accepted. Oversized tokens are
+        ignored.
+
+        :param str token: The token.
+        """
+        if len(token) > self.MAX_TOKEN_LENGTH:
+            return
+
+        now = self.clock()
+
+        with self._lock:
+            self._expire(now)
+
+            self._entries.pop(token, None)
+            self._entries[token] = now + self.ttl
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Forgets all tokens. Counters are left alone.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns a snapshot of the cache counters.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+    def _expire(self, now):
+        entries = self._entries
+
+        while entries:
+            token, expires = next(iter(entries.items()))
+            if expires > now:
+                break
+
+            del entries[token]
+            self.evictions += 1
+
+
+class _PreparedParams(object):
+    """
+    A precompiled version of :meth:`YubiClient10.param_string` for one
+    client's fixed parameters. The signature input and the query string are
+    each rendered as a list of literal strings interleaved with token and
+    nonce slots.
+    """
+
+    _TOKEN = '\x00token\x00'
+    _NONCE = '\x00nonce\x00'
+
+    def __init__(self, params, api_key):
+        self._hmac = None
+        self._signed = []
+
+        if api_key is not None:
+            pieces = self._render(
+                ('{0}={1}'.format(k, v) for k, v in sorted(params)), '&', str
+            )
+            prefix = pieces.pop(0) if isinstance(pieces[0], str) else ''
+            self._hmac = hmac.new(api_key, prefix.encode('utf-8'), sha1)
+            self._signed = pieces
+
+        self._query = self._render(
+            ('{0}={1}'.format(quote_plus(str(k)), _quote_value(v)) for k, v in params),
+            '&',
+            quote_plus,
+        )
+
+    @classmethod
+    def for_client(cls, client):
+        """
+        Returns a prepared version of a client's parameters, or ``None`` if
+        they can't be precompiled (e.g. a subclass derives a parameter from
+        the token).
+        """
+        params = client.params(cls._TOKEN, cls._NONCE)
+        keys = [k for k, v in params]
+        dynamic = [v for k, v in params if v in (cls._TOKEN, cls._NONCE)]
+        text = ''.join('{0}{1}'.format(k, v) for k, v in params)
+
+        if len(set(keys)) != len(keys):
+            return None
+
+        if text.count('\x00') != 2 * len(dynamic):
+            return None
+
+        return cls(params, client.api_key)
+
+    def param_string(self, token, nonce):
+        query = self._fill(self._query, _quote_fast(token), _quote_fast(nonce))
+
+        if self._hmac is not None:
+            signer = self._hmac.copy()
+            signer.update(self._fill(self._signed, token, nonce).encode('utf-8'))
+            signature = b64encode(signer.digest()).decode('ascii')
+            query = '{0}&h={1}'.format(query, signature.translate(_B64_QUOTES))
+
+        return query
+
+    def _render(self, fields, separator, quote):
+        """
+        Joins rendered fields and splits the result around the slots.
+        """
+        text = separator.join(fields)
+        pieces = []
+
+        for piece in _split_slots(text, [self._TOKEN, quote(self._TOKEN)], 0):
+            if isinstance(piece, int):
+                pieces.append(piece)
+            else:
+                pieces.extend(_split_slots(piece, [self._NONCE, quote(self._NONCE)], 1))
+
+        return [piece for piece in pieces if piece != '']
+
+    @staticmethod
+    def _fill(pieces, token, nonce):
+        values = (token, nonce)
+
+        return ''.join(
+            values[piece] if isinstance(piece, int) else piece for piece in pieces
+        )
+
+
+def _split_slots(text, markers, slot):
+    """
+    Splits text around any of the given markers, replacing each marker with
+    the slot index.
+    """
+    for marker in markers:
+        if marker in text:
+            parts = text.split(marker)
+            pieces = [parts[0]]
+            for part in parts[1:]:
+                pieces.extend([slot, part])
+
+            return pieces
+
+    return [text]
+
+
+# Percent-encodings for the base64 characters that quote_plus() escapes.
+_B64_QUOTES = str.maketrans({'+': '%2B', '/': '%2F', '=': '%3D'})
+
+
+def _quote_fast(value):
+    if value.isascii() and value.isalnum():
+        return value
+    else:
+        return quote_plus(value)
+
+
+def _quote_value(value):
+    # Matches urlencode().
+    if isinstance(value, bytes):
+        return quote_plus(value)
+    else:
+        return quote_plus(str(value))
+
+
+class _NonceSource(object):
+    """
+    Draws random strings over an alphabet from a buffer of cryptographically
+    secure random bytes, refilled in bulk.
+    """
+
+    _sources = {}
+
+    def __init__(self, chars, batch=4096):
+        # Bytes at or above the largest multiple of len(chars) are discarded,
+        # so that every character is equally likely.
+        limit = 256 - (256 % len(chars))
+
+        self.batch = batch
+        self._table = bytes(ord(chars[i % len(chars)]) for i in range(256))
+        self._discard = bytes(range(limit, 256))
+        self._buffer = ''
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_chars(cls, chars):
+        source = cls._sources.get(chars)
+        if source is None:
+            source = cls._sources.setdefault(chars, cls(chars))
+
+        return source
+
+    def take(self, count):
+        with self._lock:
+            start = self._offset
+            end = start + count
+
+            while end > len(self._buffer):
+                self._buffer = self._buffer[start:] + (
+                    os.urandom(self.batch)
+                    .translate(self._table, self._discard)
+                    .decode('ascii')
+                )
+                start, end = 0, count
+
+            self._offset = end
+            value = self._buffer[start:end]
+
+        return value
+
+    @classmethod
+    def _reset(cls):
+        # A forked child must not hand out the bytes its parent buffered.
+        cls._sources = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_NonceSource._reset)
+
 
 def param_signature(params, api_key):
     """
@@ -0,0 +1,204 @@
+"""
+Local key storage for verifying Yubico OTP tokens without a validation
+service. A key store maps each device's modhex public ID to its AES key and
+private ID.
+
+>>> from binascii import unhexlify
+>>> store = MemoryKeyStore()
+>>> store.add(b'cclngiuv', b'0123456789abcdef', unhexlify(b'0123456789ab'))
+>>> public_id, otp = store.verify_token(b'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl')
+>>> public_id == b'cclngiuv'
+True
+>>> otp.counter
+0
+>>> store.verify_token(b'ccccccccttkhthcilurtkerbjnnkljfkjccklkhl')
+Traceback (most recent call last):
+    ...
+yubiotp.keystore.UnknownDeviceError: No key for public_id 'cccccccc'
+"""
+
+import threading
+
+from .modhex import is_modhex
+from .otp import decode_otp
+
+__all__ = ['KeyStore', 'MemoryKeyStore', 'UnknownDeviceError', 'UIDMismatchError']
+
+
+class UnknownDeviceError(ValueError):
+    """
+    Raised when a token's public ID is not in the key store.
+    """
+
+    pass
+
+
+class UIDMismatchError(ValueError):
+    """
+    Raised when a token decrypts with the device's key but carries the wrong
+    private ID.
+    """
+
+    pass
+
+
+class KeyStore(object):
+    """
+    Abstract interface to a collection of device keys. Subclasses need only
+    implement :meth:`lookup`.
+    """
+
+    def lookup(self, public_id):
+        """
+        Returns the key material for a device.
+
+        :param bytes public_id: The modhex-encoded public ID.
+
+        :returns: The 16-byte AES key and 6-byte private ID, or ``None`` if the
+            device is unknown.
+        :rtype: (bytes, bytes) or ``None``
+        """
+        raise NotImplementedError()
+
+    def verify_token(self, token):
+        """
+        Decodes a token with the key of the device that generated it.
+
+        :param bytes token: A modhex-encoded token, including the public ID.
+
+        :returns: The public ID and the decrypted OTP structure, as with
+            :func:`~yubiotp.otp.decode_otp`.
+        :rtype: (bytes, :class:`~yubiotp.otp.OTP`)
+
+        :raises: :exc:`UnknownDeviceError` if the public ID is not in the
+            store.
+        :raises: :exc:`UIDMismatchError` if the decrypted private ID does not
+            belong to the device.
+        :raises: ``ValueError`` or :exc:`~yubiotp.otp.CRCError` under the same
+            conditions as :func:`~yubiotp.otp.decode_otp`.
+        """
+        public_id = token[:-32]
+        entry = self.lookup(public_id)
+
+        if entry is None:
+            raise UnknownDeviceError(
+                'No key for public_id {0!r}'.format(
+                    public_id.decode('ascii', 'replace')
+                )
+            )
+
+        key, uid = entry
+        public_id, otp = decode_otp(token, key)
+
+        if otp.uid != uid:
+            raise UIDMismatchError('OTP private ID does not match the device')
+
+        return (public_id, otp)
+
+
+class MemoryKeyStore(KeyStore):
+    """
+    An in-memory :class:`KeyStore`. Key material for all devices is packed into
+    a single byte array of fixed-width records, with a dictionary mapping each
+    public ID to its record. This keeps lookups O(1) and the per-device
+    overhead small even with hundreds of thousands of devices loaded.
+
+    Lookups are lock-free; mutations are serialized.
+
+    >>> store = MemoryKeyStore()
+    >>> store.add(b'cccccccb', b'k' * 16, b'u' * 6)
+    >>> store.add(b'cccccccd', b'K' * 16, b'U' * 6)
+    >>> store.remove(b'cccccccb')
+    >>> store.add(b'ccccccce', b'x' * 16, b'y' * 6)
+    >>> len(store), b'cccccccb' in store
+    (2, False)
+    >>> store.lookup(b'ccccccce') == (b'x' * 16, b'y' * 6)
+    True
+    >>> store.add(b'cccccccd', b'short', b'u' * 6)
+    Traceback (most recent call last):
+        ...
+    ValueError: Key must be exactly 16 bytes
+    """
+
+    KEY_SIZE = 16
+    UID_SIZE = 6
+    RECORD_SIZE = KEY_SIZE + UID_SIZE
+
+    def __init__(self):
+        self._records = bytearray()
+        self._index = {}
+        self._free = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, public_id):
+        return public_id in self._index
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def add(self, public_id, key, uid):
+        """
+        Adds a device to the store, replacing any existing device with the
+        same public ID.
+
+        :param bytes public_id: The modhex-encoded public ID.
+        :param bytes key: The 16-byte AES key.
+        :param bytes uid: The 6-byte private ID.
+        """
+        if not is_modhex(public_id) or len(public_id) > 32:
+            raise ValueError('public_id must be a modhex string of up to 32 characters')
+
+        if len(key) != self.KEY_SIZE:
+            raise ValueError('Key must be exactly 16 bytes')
+
+        if len(uid) != self.UID_SIZE:
+            raise ValueError('uid must be exactly 6 bytes')
+
+        public_id = bytes(public_id)
+        record = bytes(key) + bytes(uid)
+
+        with self._lock:
+            slot = self._index.get(public_id)
+            if slot is None:
+                slot = self._free.pop() if self._free else self._allocate()
+
+            offset = slot * self.RECORD_SIZE
+            end = offset + self.RECORD_SIZE
+            self._records[offset:end] = record
+            self._index[public_id] = slot
+
+    def remove(self, public_id):
+        """
+        Removes a device from the store.
+
+        :raises: ``KeyError`` if the device is unknown.
+        """
+        with self._lock:
+            slot = self._index.pop(public_id)
+
+            offset = slot * self.RECORD_SIZE
+            end = offset + self.RECORD_SIZE
+            self._records[offset:end] = bytes(self.RECORD_SIZE)
+            self._free.append(slot)
+
+    def lookup(self, public_id):
+        slot = self._index.get(public_id)
+
+        if slot is None:
+            return None
+
+        offset = slot * self.RECORD_SIZE
+        middle = offset + self.KEY_SIZE
+        end = offset + self.RECORD_SIZE
+        records = self._records
+
+        return (bytes(records[offset:middle]), bytes(records[middle:end]))
+
+    def _allocate(self):
+        slot = len(self._records) // self.RECORD_SIZE
+        self._records.extend(bytes(self.RECORD_SIZE))
+
+        return slot
@@ -0,0 +1,313 @@
+"""
+Lightweight instrumentation for the validation clients.
+
+A client's ``observers`` are notified when each request finishes, with a
+:class:`RequestTrace` that records when each phase of the request ended.
+:class:`LatencyCollector` is a ready-made observer that keeps latency
+histograms.
+
+>>> h = Histogram()
+>>> for ms in range(1, 101):
+...     h.observe(ms / 1000)
+>>> h.count
+100
+>>> 0.045 <= h.percentile(0.5) <= 0.055
+True
+>>> 0.090 <= h.percentile(0.95) <= 0.105
+True
+>>> h.reset()
+>>> h.count, h.percentile(0.5)
+(0, None)
+"""
+
+import math
+import threading
+import time
+
+__all__ = ['Histogram', 'RequestTrace', 'ClientObserver', 'LatencyCollector']
+
+
+class Histogram(object):
+    """
+    A thread-safe histogram with logarithmically sized buckets. Each bucket
+    spans a fixed ratio, so percentiles are accurate to within that ratio
+    regardless of scale, and recording a value costs a logarithm and an
+    increment.
+
+    :param float minimum: The upper bound of the first bucket. Smaller values
+        are counted there.
+    :param float maximum: Values above this are counted in the last bucket.
+    :param int buckets_per_doubling: Resolution. The default of 8 gives a
+        relative error under 10%.
+    """
+
+    def __init__(self, minimum=1e-6, maximum=1e3, buckets_per_doubling=8):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.buckets_per_doubling = buckets_per_doubling
+
+        self._scale = buckets_per_doubling / math.log(2)
+        self._size = int(math.ceil(math.log(maximum / minimum) * self._scale)) + 1
+        self._lock = threading.Lock()
+
+        self.reset()
+
+    def observe(self, value):
+        """
+        Records a value.
+        """
+        index = self._index(value)
+
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, fraction):
+        """
+        Returns the approximate value at a given fraction of the distribution
+        (e.g. 0.99), or ``None`` if nothing has been recorded.
+        """
+        with self._lock:
+            if self.count == 0:
+                return None
+
+            rank = max(1, int(math.ceil(self.count * fraction)))
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    break
+
+            return min(self._upper_bound(index), self.max)
+
+    def snapshot(self):
+        """
+        Returns a summary of the distribution.
+
+        :rtype: dict
+        """
+        with self._lock:
+            count, total, maximum = self.count, self.sum, self.max
+
+        return {
+            'count': count,
+            'sum': total,
+            'mean': (total / count) if count else None,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': maximum if count else None,
+        }
+
+    def buckets(self):
+        """
+        Returns ``(upper_bound, count)`` for each non-empty bucket.
+        """
+        with self._lock:
+            counts = list(self.counts)
+
+        return [
+            (self._upper_bound(index), count)
+            for index, count in enumerate(counts)
+            if count
+        ]
+
+    def cumulative(self, bounds):
+        """
+        Returns the number of values at or below each of the given bounds, as
+        for a Prometheus histogram. Values are attributed to the upper bound
+        of their bucket, so bounds between bucket boundaries are approximate.
+
+        :param bounds: An ascending sequence of upper bounds.
+        :rtype: list
+        """
+        with self._lock:
+            counts = list(self.counts)
+
+        totals = []
+        index = seen = 0
+
+        for bound in bounds:
+            limit = bound * (1 + 1e-9)
+            while index < len(counts) and self._upper_bound(index) <= limit:
+                seen += counts[index]
+                index += 1
+            totals.append(seen)
+
+        return totals
+
+    def reset(self):
+        """
+        Discards all recorded values.
+        """
+        with self._lock:
+            self.counts = [0] * self._size
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+    def _index(self, value):
+        if value <= self.minimum:
+            return 0
+
+        index = int(math.ceil(math.log(value / self.minimum) * self._scale))
+
+        return min(index, self._size - 1)
+
+    def _upper_bound(self, index):
+        return self.minimum * math.exp(index / self._scale)
+
+
+class RequestTrace(object):
+    """
+    The timeline of a single verification request.
+
+    .. attribute:: token
+
+    .. attribute:: base_url
+
+        The server that answered, once known.
+
+    .. attribute:: marks
+
+        A list of ``(phase, timestamp)`` pairs in the order the phases ended,
+        starting with ``'start'``. Timestamps come from
+        :func:`time.perf_counter`. The phases recorded by the synchronous
+        clients are ``nonce``, ``url``, ``connect``, ``request``, ``wait``,
+        ``read``, ``parse``, and ``validate``.
+
+    .. attribute:: status
+
+        The response status, or ``'ERROR'`` if the request raised an
+        exception.
+
+    .. attribute:: error
+
+        The exception, if any.
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.base_url = None
+        self.status = None
+        self.error = None
+        self.marks = [('start', time.perf_counter())]
+
+    def mark(self, phase):
+        self.marks.append((phase, time.perf_counter()))
+
+    @property
+    def elapsed(self):
+        """
+        Seconds from the start of the request to the last mark.
+        """
+        return self.marks[-1][1] - self.marks[0][1]
+
+    def durations(self):
+        """
+        Returns the time spent in each phase, in seconds.
+
+        :rtype: dict
+        """
+        return {
+            phase: end - start
+            for (_, start), (phase, end) in zip(self.marks, self.marks[1:])
+        }
+
+
+class _NullTrace(object):
+    """
+    Stands in for a :class:`RequestTrace` when nobody is observing.
+    """
+
+    def mark(self, phase):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class ClientObserver(object):
+    """
+    Interface for objects in a client's ``observers`` list.
+    """
+
+    def request_finished(self, trace):
+        """
+        Called after every request, successful or not. This runs on the
+        verifying thread, so it should be quick and must not raise.
+
+        :param trace: The completed trace.
+        :type trace: :class:`RequestTrace`
+        """
+        pass
+
+
+class LatencyCollector(ClientObserver):
+    """
+    A :class:`ClientObserver` that keeps latency histograms per response status
+    and per server.
+
+    >>> collector = LatencyCollector()
+    >>> trace = RequestTrace('token')
+    >>> trace.base_url, trace.status = 'http://localhost/verify', 'OK'
+    >>> trace.mark('validate')
+    >>> collector.request_finished(trace)
+    >>> collector.snapshot()['status']['OK']['count']
+    1
+    >>> list(collector.snapshot()['base_url'])
+    ['http://localhost/verify']
+    >>> collector.reset()
+    >>> collector.snapshot()
+    {'status': {}, 'base_url': {}}
+    """
+
+    def __init__(self, **histogram_options):
+        self._histogram_options = histogram_options
+        self._lock = threading.Lock()
+
+        self.reset()
+
+    def request_finished(self, trace):
+        elapsed = trace.elapsed
+
+        self._histogram(self._by_status, trace.status).observe(elapsed)
+        self._histogram(self._by_base_url, trace.base_url).observe(elapsed)
+
+    def snapshot(self):
+        """
+        Returns summaries of all histograms.
+
+        :rtype: dict
+        """
+        with self._lock:
+            by_status = dict(self._by_status)
+            by_base_url = dict(self._by_base_url)
+
+        return {
+            'status': {k: h.snapshot() for k, h in by_status.items()},
+            'base_url': {k: h.snapshot() for k, h in by_base_url.items()},
+        }
+
+    def reset(self):
+        """
+        Discards all histograms.
+        """
+        with self._lock:
+            self._by_status = {}
+            self._by_base_url = {}
+
+    def _histogram(self, histograms, key):
+        histogram = histograms.get(key)
+
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(
+                    key, Histogram(**self._histogram_options)
+                )
+
+        return histogram
@@ -9,10 +9,16 @@ which uses keyboard-independent characters.
 """
 
 from binascii import hexlify, unhexlify
-from functools import partial
-import struct
 
-__all__ = ['modhex', 'unmodhex', 'is_modhex', 'hex_to_modhex', 'modhex_to_hex']
+__all__ = [
+    'modhex',
+    'unmodhex',
+    'is_modhex',
+    'hex_to_modhex',
+    'modhex_to_hex',
+    'ModhexEncoder',
+    'ModhexDecoder',
+]
 
 
 def modhex(data):
@@ -22,7 +28,7 @@ def modhex(data):
     >>> modhex(b'abcdefghijklmnop') == b'hbhdhehfhghhhihjhkhlhnhrhthuhvic'
     True
     """
-    return hex_to_modhex(hexlify(data))
+    return hexlify(data).translate(_HEX_TO_MODHEX)
 
 
 def unmodhex(encoded):
@@ -46,12 +52,7 @@ def is_modhex(encoded):
     >>> is_modhex(b'cbdefghijklnrtuvyy')
     False
     """
-    if any(c not in modhex_chars for c in encoded):
-        return False
-    elif len(encoded) % 2 != 0:
-        return False
-    else:
-        return True
+    return (len(encoded) % 2 == 0) and not bytes(encoded).translate(None, modhex_chars)
 
 
 def hex_to_modhex(hex_str):
@@ -60,15 +61,14 @@ def hex_to_modhex(hex_str):
 
     >>> hex_to_modhex(b'69b6481c8baba2b60e8f22179b58cd56') == b'hknhfjbrjnlnldnhcujvddbikngjrtgh'
     True
+    >>> hex_to_modhex(b'69B6') == b'hknh'
+    True
     >>> hex_to_modhex(b'6j')
     Traceback (most recent call last):
         ...
     ValueError: Illegal hex character in input
     """
-    try:
-        return b''.join(int2byte(hex_to_modhex_char(b)) for b in iter(hex_str.lower()))
-    except ValueError:
-        raise ValueError('Illegal hex character in input')
+    return _translate(hex_str, _HEX_TO_MODHEX, 'Illegal hex character in input')
 
 
 def modhex_to_hex(modhex_str):
@@ -82,12 +82,82 @@ def modhex_to_hex(modhex_str):
         ...
     ValueError: Illegal modhex character in input
     """
-    try:
-        return b''.join(
-            int2byte(modhex_to_hex_char(b)) for b in iter(modhex_str.lower())
-        )
-    except ValueError:
-        raise ValueError('Illegal modhex character in input')
+    return _translate(modhex_str, _MODHEX_TO_HEX, 'Illegal modhex character in input')
+
+
+class ModhexEncoder(object):
+    """
+    Incrementally encodes a stream of bytes as modhex. Every input byte
+    produces exactly two output characters, so chunks can be encoded
+    independently without buffering.
+
+    >>> encoder = ModhexEncoder()
+    >>> chunks = [b'abcdefgh', b'ijklmnop']
+    >>> b''.join(encoder.encode(chunk) for chunk in chunks) == modhex(b''.join(chunks))
+    True
+    """
+
+    def encode(self, data, final=False):
+        """
+        Encode the next chunk of input.
+
+        :param bytes data: Raw bytes.
+        :param bool final: ``True`` for the last chunk of the stream.
+        :rtype: bytes
+        """
+        return modhex(data)
+
+    def reset(self):
+        pass
+
+
+class ModhexDecoder(object):
+    """
+    Incrementally decodes a stream of modhex characters. Chunks may be split at
+    any position; an odd trailing character is held until the next call.
+
+    >>> decoder = ModhexDecoder()
+    >>> decoder.decode(b'hbhdh') == b'ab'
+    True
+    >>> decoder.decode(b'ehfhghhhihjhkhlhnhrhthuhvic', final=True) == b'cdefghijklmnop'
+    True
+    >>> decoder.decode(b'hbh', final=True)
+    Traceback (most recent call last):
+        ...
+    ValueError: Truncated modhex input
+    >>> decoder.decode(b'xx')
+    Traceback (most recent call last):
+        ...
+    ValueError: Illegal modhex character in input
+    """
+
+    def __init__(self):
+        self._pending = b''
+
+    def decode(self, data, final=False):
+        """
+        Decode the next chunk of input.
+
+        :param bytes data: Modhex characters.
+        :param bool final: ``True`` for the last chunk of the stream.
+        :rtype: bytes
+        :raises: ``ValueError`` on an illegal character or if the stream ends
+            in the middle of a byte.
+        """
+        hex_str = self._pending + modhex_to_hex(data)
+
+        if len(hex_str) % 2 != 0:
+            if final:
+                self._pending = b''
+                raise ValueError('Truncated modhex input')
+            hex_str, self._pending = hex_str[:-1], hex_str[-1:]
+        else:
+            self._pending = b''
+
+        return unhexlify(hex_str)
+
+    def reset(self):
+        self._pending = b''
 
 
 #
@@ -95,22 +165,36 @@ def modhex_to_hex(modhex_str):
 #
 
 
-def int2byte(i):
-    return struct.Struct(">B").pack(i)
+hex_chars = b'0123456789abcdef'
+modhex_chars = b'cbdefghijklnrtuv'
 
 
-def lookup(alist, key):
-    try:
-        return next(v for (k, v) in alist if k == key)
-    except StopIteration:
-        raise ValueError()
+def _make_table(src, dst):
+    """
+    Builds a translation table that maps src to dst (case-insensitively) and
+    every other byte to NUL, which can then be detected in a single scan.
+    """
+    table = bytearray(256)
 
+    for s, d in zip(src, dst):
+        table[s] = d
+        table[ord(chr(s).upper())] = d
 
-hex_chars = b'0123456789abcdef'
-modhex_chars = b'cbdefghijklnrtuv'
+    return bytes(table)
+
+
+def _translate(data, table, message):
+    # Text has never been accepted, but should fail like any other bad input.
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        raise ValueError(message)
+
+    translated = bytes(data).translate(table)
+
+    if b'\0' in translated:
+        raise ValueError(message)
+
+    return translated
 
-hex_to_modhex_map = list(zip(iter(hex_chars), iter(modhex_chars)))
-modhex_to_hex_map = list(zip(iter(modhex_chars), iter(hex_chars)))
 
-hex_to_modhex_char = partial(lookup, hex_to_modhex_map)
-modhex_to_hex_char = partial(lookup, modhex_to_hex_map)
+_HEX_TO_MODHEX = _make_table(hex_chars, modhex_chars)
+_MODHEX_TO_HEX = _make_table(modhex_chars, hex_chars)
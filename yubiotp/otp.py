@@ -18,16 +18,31 @@ True
 """
 
 from binascii import hexlify
-from datetime import datetime
-from random import randrange
-from struct import pack, unpack
+from collections import OrderedDict
+from random import Random
+from struct import Struct
+import threading
+import time
 
 from Crypto.Cipher import AES
 
-from .crc import crc16, verify_crc16
+from .crc import crc16, verify_crc16, verify_crc16_many
+from .metrics import Histogram
 from .modhex import is_modhex, modhex, unmodhex
 
-__all__ = ['decode_otp', 'encode_otp', 'OTP', 'YubiKey', 'CRCError']
+__all__ = [
+    'decode_otp',
+    'decode_otp_many',
+    'encode_otp',
+    'OTP',
+    'YubiKey',
+    'VirtualClock',
+    'CRCError',
+    'CipherCache',
+    'set_cipher_cache',
+    'DecodeMetrics',
+    'set_decode_metrics',
+]
 
 
 class CRCError(ValueError):
@@ -55,18 +70,98 @@ def decode_otp(token, key):
     :raises: :exc:`CRCError` if the checksum on the decrypted data is
         incorrect.
     """
-    if len(key) != 16:
-        raise ValueError('Key must be exactly 16 bytes')
+    if _decode_metrics is not None:
+        return _decode_otp_measured(token, key, _decode_metrics)
 
-    public_id, token = token[:-32], token[-32:]
+    public_id, buf = _split_token(token, key)
 
-    buf = unmodhex(token)
-    buf = AES.new(key, AES.MODE_ECB).decrypt(buf)
+    buf = _new_cipher(key).decrypt(buf)
     otp = OTP.unpack(buf)
 
     return (public_id, otp)
 
 
+def decode_otp_many(items):
+    """
+    Decodes a batch of modhex-encoded Yubico OTP tokens. Tokens that share a
+    key are decrypted together in a single pass, so this is much faster than
+    calling :func:`decode_otp` in a loop when there are many tokens per key.
+
+    :param items: An iterable of ``(token, key)`` pairs, with the same meaning
+        as the arguments to :func:`decode_otp`.
+
+    :returns: One entry per input item, in order. Each entry is either a
+        ``(public_id, otp)`` tuple or the exception (``ValueError``,
+        ``TypeError``, or :exc:`CRCError`) that :func:`decode_otp` would have
+        raised for that item. A bad token never affects the rest of the batch.
+    :rtype: list
+
+    >>> key = b'0123456789abcdef'
+    >>> token = b'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl'
+    >>> results = decode_otp_many([(token, key), (token, b'fedcba9876543210'), (b'xx', key)])
+    >>> results[0] == decode_otp(token, key)
+    True
+    >>> results[1]
+    CRCError('OTP checksum is invalid')
+    >>> results[2]
+    ValueError('Illegal modhex character in input')
+    """
+    results = []
+    groups = {}
+    metrics = _decode_metrics
+
+    for index, (token, key) in enumerate(items):
+        try:
+            public_id, buf = _split_token(token, key, metrics)
+            key = bytes(key)
+        except (TypeError, ValueError) as e:
+            results.append(e)
+        else:
+            results.append(None)
+            groups.setdefault(key, []).append((index, public_id, buf))
+
+    for key, group in groups.items():
+        plaintext = _new_cipher(key).decrypt(
+            b''.join(buf for index, public_id, buf in group)
+        )
+        checks = verify_crc16_many(plaintext)
+
+        for offset, (index, public_id, buf), is_valid in zip(
+            range(0, len(plaintext), 16), group, checks
+        ):
+            if is_valid:
+                otp = OTP._from_packed(plaintext, offset)
+                results[index] = (public_id, otp)
+            else:
+                results[index] = CRCError('OTP checksum is invalid')
+
+        if metrics is not None:
+            failures = checks.count(False)
+            metrics._count('decoded', len(group) - failures)
+            metrics._count('crc', failures)
+
+    return results
+
+
+def _decode_otp_measured(token, key, metrics):
+    """
+    :func:`decode_otp` with metrics.
+    """
+    public_id, buf = _split_token(token, key, metrics)
+
+    start = time.perf_counter()
+    try:
+        otp = OTP.unpack(_new_cipher(key).decrypt(buf))
+    except CRCError:
+        metrics._count('crc')
+        raise
+
+    # The histogram counts these, so this is the only lock we take.
+    metrics.latency.observe(time.perf_counter() - start)
+
+    return (public_id, otp)
+
+
 def encode_otp(otp, key, public_id=b''):
     """
     Encodes an :class:`OTP` structure, encrypts it with the given key and
@@ -81,6 +176,16 @@ def encode_otp(otp, key, public_id=b''):
 
     :raises: ValueError if any parameters are out of range.
     """
+    _check_encode_args(key, public_id)
+
+    buf = otp.pack()
+    buf = _new_cipher(key).encrypt(buf)
+    token = modhex(buf)
+
+    return public_id + token
+
+
+def _check_encode_args(key, public_id):
     if len(key) != 16:
         raise ValueError('Key must be exactly 16 bytes')
 
@@ -90,11 +195,322 @@ def encode_otp(otp, key, public_id=b''):
     if len(public_id) > 32:
         raise ValueError('public_id may be no longer than 32 modhex characters')
 
-    buf = otp.pack()
-    buf = AES.new(key, AES.MODE_ECB).encrypt(buf)
-    token = modhex(buf)
 
-    return public_id + token
+class CipherCache(object):
+    """
+    A bounded, thread-safe LRU cache of AES cipher objects, keyed by AES key.
+    Install one with :func:`set_cipher_cache` to let :func:`encode_otp` and
+    :func:`decode_otp` reuse expanded key schedules for frequently seen
+    devices.
+
+    Cached cipher objects hold the expanded key schedule of each key, so the
+    keys stay in memory for as long as they are cached. Pycryptodome cipher
+    objects can not be zeroed: evicting an entry or clearing the cache only
+    drops references, and the memory is released (but not wiped) once nothing
+    else refers to the cipher.
+
+    :param int maxsize: The maximum number of cipher objects to keep.
+
+    .. attribute:: hits
+
+    .. attribute:: misses
+
+    .. attribute:: evictions
+
+    >>> cache = CipherCache(maxsize=2)
+    >>> c1 = cache.get(b'0123456789abcdef')
+    >>> cache.get(b'0123456789abcdef') is c1
+    True
+    >>> _ = cache.get(b'1123456789abcdef')
+    >>> _ = cache.get(b'2123456789abcdef')
+    >>> cache.stats() == {'hits': 1, 'misses': 3, 'evictions': 1, 'size': 2, 'maxsize': 2}
+    True
+    >>> cache.clear()
+    >>> len(cache)
+    0
+    """
+
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns an ECB-mode AES cipher for the given key, creating it if
+        necessary.
+
+        :param bytes key: A 16-byte AES key.
+        """
+        index = bytes(key)
+
+        with self._lock:
+            cipher = self._entries.get(index)
+            if cipher is not None:
+                self._entries.move_to_end(index)
+                self.hits += 1
+                return cipher
+
+            self.misses += 1
+
+        cipher = AES.new(key, AES.MODE_ECB)
+
+        with self._lock:
+            self._entries[index] = cipher
+            self._entries.move_to_end(index)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return cipher
+
+    def clear(self):
+        """
+        Drops all cached cipher objects. Counters are left alone.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns a snapshot of the cache counters.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+
+def set_cipher_cache(cache):
+    """
+    Installs a :class:`CipherCache` for :func:`encode_otp`, :func:`decode_otp`,
+    and :func:`decode_otp_many`. Caching is off by default.
+
+    :param cache: A :class:`CipherCache` or ``None`` to disable caching.
+    :returns: The previously installed cache, if any.
+
+    >>> key = b'0123456789abcdef'
+    >>> token = b'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl'
+    >>> set_cipher_cache(CipherCache(maxsize=16))
+    >>> decode_otp(token, key) == decode_otp(token, key)
+    True
+    >>> set_cipher_cache(None).stats()['hits']
+    1
+    """
+    global _cipher_cache
+
+    previous, _cipher_cache = _cipher_cache, cache
+
+    return previous
+
+
+_cipher_cache = None
+
+
+def _new_cipher(key):
+    cache = _cipher_cache
+
+    if cache is None:
+        return AES.new(key, AES.MODE_ECB)
+    else:
+        return cache.get(key)
+
+
+class DecodeMetrics(object):
+    """
+    Counters and a latency histogram for :func:`decode_otp`. Install one with
+    :func:`set_decode_metrics`; metrics are off by default and cost nothing
+    but a check for ``None`` until then.
+
+    Failures are counted by reason: ``key`` (the key is not 16 bytes),
+    ``modhex`` (the token is not modhex), ``length`` (the token does not end
+    with 16 bytes of OTP data), and ``crc`` (the checksum is wrong, which
+    usually means the wrong key). :func:`decode_otp_many` updates the
+    counters but not the histogram, since it decrypts tokens in groups.
+
+    .. attribute:: latency
+
+        A :class:`~yubiotp.metrics.Histogram` of the seconds spent decrypting
+        and unpacking each token that :func:`decode_otp` decoded successfully.
+
+    >>> metrics = DecodeMetrics()
+    >>> previous = set_decode_metrics(metrics)
+    >>> token = b'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl'
+    >>> _ = decode_otp(token, b'0123456789abcdef')
+    >>> for key in [b'fedcba9876543210', b'short']:
+    ...     try:
+    ...         decode_otp(token, key)
+    ...     except ValueError:
+    ...         pass
+    >>> _ = set_decode_metrics(previous)
+    >>> snapshot = metrics.snapshot()
+    >>> snapshot['decoded'], snapshot['errors']
+    (1, {'key': 1, 'modhex': 0, 'length': 0, 'crc': 1})
+    >>> snapshot['latency']['count']
+    1
+    >>> print(metrics.prometheus_text().splitlines()[2])
+    yubiotp_otp_decoded_total 1
+    >>> metrics.reset()
+    >>> metrics.snapshot()['latency']['count']
+    0
+    """
+
+    #: Failure reasons, in the order they're checked.
+    REASONS = ['key', 'modhex', 'length', 'crc']
+
+    #: The bucket boundaries for :meth:`prometheus_text`: powers of two from
+    #: 1 microsecond to about half a second.
+    PROMETHEUS_BUCKETS = [1e-6 * (2**i) for i in range(20)]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = Histogram(minimum=1e-6, maximum=10.0)
+
+        self.reset()
+
+    def snapshot(self):
+        """
+        Returns the current counts and a summary of the latency histogram.
+
+        :rtype: dict
+        """
+        with self._lock:
+            counts = dict(self._counts)
+        latency = self.latency.snapshot()
+
+        return {
+            'decoded': counts.pop('decoded') + latency['count'],
+            'errors': counts,
+            'latency': latency,
+        }
+
+    def reset(self):
+        """
+        Sets all counts to zero.
+        """
+        # 'decoded' only counts decode_otp_many(); latency counts the rest.
+        with self._lock:
+            self._counts = dict.fromkeys(['decoded'] + self.REASONS, 0)
+
+        self.latency.reset()
+
+    def prometheus_text(self, prefix='yubiotp_otp'):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        :param str prefix: The prefix for the metric names.
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        name = prefix + '_decrypt_seconds'
+
+        lines = [
+            '# HELP {0}_decoded_total Tokens decoded successfully.'.format(prefix),
+            '# TYPE {0}_decoded_total counter'.format(prefix),
+            '{0}_decoded_total {1}'.format(prefix, snapshot['decoded']),
+            '# HELP {0}_decode_errors_total Tokens that failed to decode.'.format(
+                prefix
+            ),
+            '# TYPE {0}_decode_errors_total counter'.format(prefix),
+        ]
+        lines.extend(
+            '{0}_decode_errors_total{{reason="{1}"}} {2}'.format(
+                prefix, reason, snapshot['errors'][reason]
+            )
+            for reason in self.REASONS
+        )
+
+        lines.append(
+            '# HELP {0} Time spent decrypting and unpacking tokens.'.format(name)
+        )
+        lines.append('# TYPE {0} histogram'.format(name))
+        bounds = self.PROMETHEUS_BUCKETS
+        lines.extend(
+            '{0}_bucket{{le="{1!r}"}} {2}'.format(name, bound, count)
+            for bound, count in zip(bounds, self.latency.cumulative(bounds))
+        )
+        latency = snapshot['latency']
+        lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(name, latency['count']))
+        lines.append('{0}_sum {1!r}'.format(name, latency['sum']))
+        lines.append('{0}_count {1}'.format(name, latency['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+
+def set_decode_metrics(metrics):
+    """
+    Installs a :class:`DecodeMetrics` for :func:`decode_otp` and
+    :func:`decode_otp_many`.
+
+    :param metrics: A :class:`DecodeMetrics` or ``None`` to disable metrics.
+    :returns: The previously installed metrics, if any.
+    """
+    global _decode_metrics
+
+    previous, _decode_metrics = _decode_metrics, metrics
+
+    return previous
+
+
+_decode_metrics = None
+
+
+def _split_token(token, key, metrics=None):
+    """
+    Validates the key and splits a token into its public ID and its decoded
+    (but still encrypted) 16-byte OTP block. If this fails and ``metrics`` is
+    given, the step that failed is counted as the :class:`DecodeMetrics`
+    reason.
+    """
+    reason = 'key'
+    try:
+        if len(key) != 16:
+            raise ValueError('Key must be exactly 16 bytes')
+
+        reason = 'modhex'
+        public_id, token = token[:-32], token[-32:]
+        buf = unmodhex(token)
+
+        reason = 'length'
+        if len(buf) != 16:
+            raise ValueError('Token must contain 16 bytes of OTP data')
+    except (TypeError, ValueError):
+        if metrics is not None:
+            metrics._count(reason)
+        raise
+
+    return (public_id, buf)
+
+
+#: The layout of a packed OTP: uid, session, timestamp (low byte, high word),
+#: counter, rand, and crc.
+_OTP_STRUCT = Struct('<6s H BH B H H')
+
+#: The checksummed part of a packed OTP.
+_OTP_FIELDS_STRUCT = Struct('<6s H BH B H')
+
+#: Sets the slots of an immutable :class:`OTP`.
+_setattr = object.__setattr__
 
 
 class OTP(object):
@@ -102,19 +518,51 @@ class OTP(object):
     A single YubiKey OTP. This is typically instantiated by parsing an encoded
     OTP.
 
+    OTP objects are immutable and hashable, and have no per-instance
+    dictionary. They only compare equal to other OTP objects.
+
     :param bytes uid: The private ID as a 6-byte binary string.
     :param int session: The non-volatile usage counter.
     :param int timestamp: An integer in [0..2^24].
     :param int counter: The volatile usage counter.
     :param int rand: An arbitrary number in [0..2^16].
+
+    >>> from binascii import unhexlify
+    >>> otp = OTP(unhexlify(b'0123456789ab'), 5, 0x0153f8, 0, 0x1234)
+    >>> buf = bytearray(20)
+    >>> otp.pack_into(buf, 4)
+    >>> bytes(buf[4:]) == otp.pack()
+    True
+    >>> OTP.unpack_from(buf, 4) == otp
+    True
+    >>> len({otp, OTP.unpack(otp.pack())})
+    1
+    >>> otp.counter = 1
+    Traceback (most recent call last):
+        ...
+    AttributeError: OTP objects are immutable
     """
 
+    __slots__ = ['uid', 'session', 'timestamp', 'counter', 'rand']
+
+    #: The size of a packed OTP in bytes.
+    size = _OTP_STRUCT.size
+
     def __init__(self, uid, session, timestamp, counter, rand):
-        self.uid = uid
-        self.session = session
-        self.timestamp = timestamp
-        self.counter = counter
-        self.rand = rand
+        _setattr(self, 'uid', uid)
+        _setattr(self, 'session', session)
+        _setattr(self, 'timestamp', timestamp)
+        _setattr(self, 'counter', counter)
+        _setattr(self, 'rand', rand)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('OTP objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('OTP objects are immutable')
+
+    def __reduce__(self):
+        return (self.__class__, self._fields())
 
     def __repr__(self):
         return 'OTP({self.uid!r}, {self.session!r}, {self.timestamp!r}, {self.counter!r}, {self.rand!r})'.format(
@@ -130,37 +578,51 @@ class OTP(object):
         if self.__class__ is not other.__class__:
             return False
 
-        self_props = (self.uid, self.session, self.timestamp, self.counter, self.rand)
-        other_props = (
-            other.uid,
-            other.session,
-            other.timestamp,
-            other.counter,
-            other.rand,
+        return self._fields() == other._fields()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.__class__,) + self._fields())
+
+    def _fields(self):
+        return (self.uid, self.session, self.timestamp, self.counter, self.rand)
+
+    def _packed_fields(self):
+        """
+        Returns the values of the packed fields, including the checksum.
+        """
+        uid, session, timestamp, counter, rand = self._fields()
+        fields = (
+            uid,
+            session,
+            timestamp & 0xFF,
+            (timestamp >> 8) & 0xFFFF,
+            counter,
+            rand,
         )
+        crc = ~crc16(_OTP_FIELDS_STRUCT.pack(*fields)) & 0xFFFF
 
-        return self_props == other_props
+        return fields + (crc,)
 
     def pack(self):
         """
         Returns the OTP packed into a binary string, ready to be encrypted and
         encoded.
         """
-        fields = (
-            self.uid,
-            self.session,
-            self.timestamp & 0xFF,
-            (self.timestamp >> 8) & 0xFFFF,
-            self.counter,
-            self.rand,
-        )
+        return _OTP_STRUCT.pack(*self._packed_fields())
 
-        buf = pack('<6s H BH B H', *fields)
-
-        crc = ~crc16(buf) & 0xFFFF
-        buf += pack('<H', crc)
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the OTP into a writable buffer, such as a :class:`bytearray`, in
+        place.
 
-        return buf
+        :param buffer: A writable bytes-like object with at least
+            :attr:`size` bytes after ``offset``.
+        :param int offset: The position to write at.
+        """
+        _OTP_STRUCT.pack_into(buffer, offset, *self._packed_fields())
 
     @classmethod
     def unpack(cls, buf):
@@ -174,11 +636,61 @@ class OTP(object):
         if not verify_crc16(buf):
             raise CRCError('OTP checksum is invalid')
 
-        uid, session, t1, t2, counter, rand, crc = unpack('<6s H BH B H H', buf)
+        return cls._from_packed(buf)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        """
+        Parse a packed OTP from a position in a larger buffer without copying
+        it out first.
+
+        :param buffer: A bytes-like object.
+        :param int offset: The position of the packed OTP.
+        :raises: ``ValueError`` if the buffer is too short.
+        :raises: :exc:`CRCError` if the OTP does not pass crc validation.
+        """
+        end = offset + cls.size
+        if offset < 0 or len(buffer) < end:
+            raise ValueError('Buffer is too short')
+
+        if not verify_crc16(memoryview(buffer)[offset:end]):
+            raise CRCError('OTP checksum is invalid')
+
+        return cls._from_packed(buffer, offset)
+
+    @classmethod
+    def _from_packed(cls, buf, offset=0):
+        uid, session, t1, t2, counter, rand, crc = _OTP_STRUCT.unpack_from(buf, offset)
+
+        return cls(uid, session, (t2 << 8) | t1, counter, rand)
 
-        timestamp = (t2 << 8) | t1
 
-        return cls(uid, session, timestamp, counter, rand)
+class VirtualClock(object):
+    """
+    A clock for :class:`YubiKey` simulations that only moves when told to.
+    Calling it returns the current time in seconds.
+
+    :param float start: The initial time.
+
+    >>> clock = VirtualClock()
+    >>> yubikey = YubiKey(b'\\x00' * 6, 0, clock=clock, seed=1)
+    >>> first = yubikey.generate().timestamp
+    >>> clock.advance(10)
+    >>> (yubikey.generate().timestamp - first) % 0x1000000
+    80
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        """
+        Moves the clock forward.
+        """
+        self.now += seconds
 
 
 class YubiKey(object):
@@ -193,13 +705,27 @@ class YubiKey(object):
         after you have finished generating tokens.
     :param int counter: The volatile session counter. This defaults to 0 at
         init time, but the caller can override this.
+    :param clock: A function returning the current time in seconds, such as
+        a :class:`VirtualClock`. Timestamps advance at 8 Hz according to this
+        clock. Defaults to :func:`time.monotonic`.
+    :param seed: Seeds this device's random number generator, for
+        reproducible simulations. Defaults to system randomness.
+
+    >>> yubikey = YubiKey(b'\\x00' * 6, 0, counter=0xFE, clock=VirtualClock(), seed=1)
+    >>> [(otp.session, otp.counter) for otp in yubikey.generate_many(3)]
+    [(0, 254), (0, 255), (1, 0)]
+    >>> tokens = yubikey.encode_many(2, b'0123456789abcdef', b'cclngiuv')
+    >>> [decode_otp(token, b'0123456789abcdef')[1].counter for token in tokens]
+    [1, 2]
     """
 
-    def __init__(self, uid, session, counter=0):
+    def __init__(self, uid, session, counter=0, clock=None, seed=None):
         self.uid = uid
         self.session = min(session, 0x7FFF)
         self.counter = min(counter, 0xFF)
+        self.clock = clock if (clock is not None) else time.monotonic
 
+        self._random = Random(seed)
         self._init_timestamp()
 
     def generate(self):
@@ -209,25 +735,84 @@ class YubiKey(object):
         :rtype: :class:`OTP`
         """
         otp = OTP(
-            self.uid, self.session, self._timestamp(), self.counter, randrange(0xFFFF)
+            self.uid,
+            self.session,
+            self._timestamp(),
+            self.counter,
+            self._random.randrange(0xFFFF),
         )
         self._increment_counter()
 
         return otp
 
+    def generate_many(self, count):
+        """
+        Returns a list of new OTP objects, as if the user had pressed the
+        button ``count`` times in quick succession. They all share the current
+        timestamp.
+
+        :rtype: list of :class:`OTP`
+        """
+        uid = self.uid
+        session = self.session
+        counter = self.counter
+        timestamp = self._timestamp()
+        randrange = self._random.randrange
+
+        otps = []
+        for i in range(count):
+            otps.append(OTP(uid, session, timestamp, counter, randrange(0xFFFF)))
+            if counter >= 0xFF:
+                session = min(session + 1, 0x7FFF)
+                counter = 0
+            else:
+                counter += 1
+
+        self.session = session
+        self.counter = counter
+
+        return otps
+
+    def encode_many(self, count, key, public_id=b''):
+        """
+        Generates ``count`` OTPs with :meth:`generate_many` and returns them
+        as tokens, all encrypted in a single pass.
+
+        :param int count: The number of tokens.
+        :param bytes key: A 16-byte AES key as a binary string.
+        :param bytes public_id: An optional public id, modhex-encoded.
+
+        :rtype: list of bytes
+        """
+        _check_encode_args(key, public_id)
+
+        otps = self.generate_many(count)
+        buf = bytearray(len(otps) * OTP.size)
+        for index, otp in enumerate(otps):
+            otp.pack_into(buf, index * OTP.size)
+
+        encoded = modhex(_new_cipher(key).encrypt(bytes(buf)))
+        size = OTP.size * 2
+
+        tokens = []
+        for start in range(0, len(encoded), size):
+            end = start + size
+            tokens.append(public_id + encoded[start:end])
+
+        return tokens
+
     def _init_timestamp(self):
-        self._timestamp_base = randrange(0x00FFFF)
-        self._timestamp_start = datetime.now()
+        self._timestamp_base = self._random.randrange(0x00FFFF)
+        self._timestamp_start = self.clock()
 
     def _timestamp(self):
         """
-        Returns the current timestamp value, based on the number of seconds
-        since the object was created.
+        Returns the current timestamp value, based on the 8 Hz ticks since the
+        object was created.
         """
-        delta = datetime.now() - self._timestamp_start
-        delta = delta.days * 86400 + delta.seconds
+        ticks = int((self.clock() - self._timestamp_start) * 8)
 
-        return (self._timestamp_base + (delta * 8)) % 0xFFFFFF
+        return (self._timestamp_base + ticks) % 0x1000000
 
     def _increment_counter(self):
         if self.counter >= 0xFF:
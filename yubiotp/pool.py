@@ -0,0 +1,352 @@
+"""
+A thread-safe pool of persistent HTTP/1.1 connections, used by the validation
+clients to avoid a new TCP (and TLS) handshake for every request.
+"""
+
+from collections import deque
+import http.client
+import select
+import ssl
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+import urllib.request
+from urllib.request import getproxies, proxy_bypass, urlopen
+
+from .metrics import NULL_TRACE
+
+__all__ = ['ConnectionPool', 'fetch']
+
+
+#: The same User-Agent that :func:`urllib.request.urlopen` sends.
+USER_AGENT = 'Python-urllib/{0}'.format(urllib.request.__version__)
+
+_REDIRECT_STATUSES = frozenset([301, 302, 303, 307, 308])
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive connections for reuse, grouped by scheme, host, and
+    port. Each request has exclusive use of its connection, so a pool can be
+    shared freely between threads.
+
+    Verification requests are not idempotent: a server that has seen a token
+    will report it as replayed. So a request is only retried on a new
+    connection if the old one failed before the whole request was written.
+    Idle connections that the server has already closed are detected and
+    discarded before they are used. Requests carry the same User-Agent as
+    :func:`urllib.request.urlopen`, and redirects are followed by handing the
+    new location over to it.
+
+    After :meth:`close`, the pool still works, but it closes each connection
+    after use instead of keeping it.
+
+    :param int maxsize: The maximum number of idle connections to keep per
+        host. Extra connections are closed when they are released.
+    :param float idle_timeout: Idle connections older than this many seconds
+        are closed rather than reused.
+    :param float timeout: The default socket timeout for new connections, or
+        ``None`` for the system default.
+
+    .. attribute:: requests
+
+        The number of requests sent.
+
+    .. attribute:: connections
+
+        The number of connections opened.
+
+    .. attribute:: reused
+
+        The number of requests sent on an existing connection.
+
+    .. attribute:: reconnects
+
+        The number of idle connections found to have been closed by the
+        server, either when they were taken from the pool or while sending a
+        request on them. The request then goes out on a new connection.
+
+    .. attribute:: evicted
+
+        The number of idle connections closed for being too old or because the
+        pool was full.
+    """
+
+    def __init__(self, maxsize=10, idle_timeout=30.0, timeout=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.reconnects = 0
+        self.evicted = 0
+
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+        self._closed = False
+
+    def request(self, url, timeout=None, trace=NULL_TRACE, discard=None):
+        """
+        Sends a GET request and returns the response body.
+
+        :param str url: An http or https URL.
+        :param float timeout: The socket timeout for this request. Defaults to
+            the pool's timeout.
+        :param trace: Receives ``connect``, ``request``, ``wait``, and ``read``
+            marks.
+        :type trace: :class:`~yubiotp.metrics.RequestTrace`
+        :param discard: An optional :class:`threading.Event`. If it is set by
+            the time the response has been read, the connection is closed
+            instead of being kept.
+
+        :rtype: bytes
+        :raises: :exc:`urllib.error.HTTPError` for a non-200 response.
+        :raises: ``OSError`` for connection failures.
+        """
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.hostname, parts.port)
+        target = parts.path or '/'
+        if parts.query:
+            target = '{0}?{1}'.format(target, parts.query)
+
+        if timeout is None:
+            timeout = self.timeout
+
+        conn, is_reused = self._acquire(host, timeout)
+
+        try:
+            trace.mark('connect')
+            self._send(conn, target, trace)
+        except (ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not is_reused:
+                raise
+
+            # The server closed the idle connection before it had our whole
+            # request, so it can't have acted on it.
+            self._count('reconnects')
+            conn = self._connect(host, timeout)
+            try:
+                conn.connect()
+                trace.mark('connect')
+                self._send(conn, target, trace)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        # From here on, the server may have used the token, so a failure must
+        # not be retried.
+        try:
+            response = conn.getresponse()
+            trace.mark('wait')
+            body = response.read()
+            trace.mark('read')
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close or ((discard is not None) and discard.is_set()):
+            conn.close()
+        else:
+            self._release(host, conn)
+
+        location = response.getheader('Location')
+        if (response.status in _REDIRECT_STATUSES) and location:
+            # urllib follows the rest of the chain, with its usual limits.
+            location = urljoin(url, location)
+            if urlsplit(location).scheme in ('http', 'https'):
+                return fetch(location, timeout, trace)
+
+        if response.status != 200:
+            raise HTTPError(
+                url, response.status, response.reason, response.headers, None
+            )
+
+        return body
+
+    def close(self):
+        """
+        Closes all idle connections, and any connections still in use as they
+        are released.
+        """
+        with self._lock:
+            self._closed = True
+
+        self.clear()
+
+    def clear(self):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for conn, released in connections:
+                conn.close()
+
+    def stats(self):
+        """
+        Returns a snapshot of the pool's counters.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'connections': self.connections,
+                'reused': self.reused,
+                'reconnects': self.reconnects,
+                'evicted': self.evicted,
+                'idle': sum(len(connections) for connections in self._idle.values()),
+            }
+
+    def _acquire(self, host, timeout):
+        stale = []
+        conn = None
+        now = time.monotonic()
+
+        with self._lock:
+            self.requests += 1
+
+            connections = self._idle.get(host)
+            while connections:
+                candidate, released = connections.pop()
+                if now - released <= self.idle_timeout:
+                    conn = candidate
+                    break
+
+                # Everything below an expired connection is older still.
+                stale.append(candidate)
+                while connections:
+                    stale.append(connections.pop()[0])
+
+            self.evicted += len(stale)
+
+        for candidate in stale:
+            candidate.close()
+
+        if (conn is not None) and _is_dropped(conn):
+            conn.close()
+            self._count('reconnects')
+            conn = None
+
+        if conn is None:
+            conn = self._connect(host, timeout)
+            try:
+                conn.connect()
+            except Exception:
+                conn.close()
+                raise
+
+            return (conn, False)
+
+        self._count('reused')
+
+        if (timeout is not None) and (conn.sock is not None):
+            conn.sock.settimeout(timeout)
+
+        return (conn, True)
+
+    def _release(self, host, conn):
+        with self._lock:
+            if not self._closed:
+                connections = self._idle.setdefault(host, deque())
+                if len(connections) < self.maxsize:
+                    connections.append((conn, time.monotonic()))
+                    conn = None
+                else:
+                    self.evicted += 1
+
+        if conn is not None:
+            conn.close()
+
+    def _connect(self, host, timeout):
+        scheme, hostname, port = host
+        kwargs = {} if (timeout is None) else {'timeout': timeout}
+
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                hostname, port, context=self._get_ssl_context(), **kwargs
+            )
+        elif scheme == 'http':
+            conn = http.client.HTTPConnection(hostname, port, **kwargs)
+        else:
+            raise ValueError('Unsupported URL scheme: {0}'.format(scheme))
+
+        self._count('connections')
+
+        return conn
+
+    def _send(self, conn, target, trace):
+        conn.request(
+            'GET',
+            target,
+            headers={'Connection': 'keep-alive', 'User-Agent': USER_AGENT},
+        )
+        trace.mark('request')
+
+    def _get_ssl_context(self):
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+
+        return self._ssl_context
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def _is_dropped(conn):
+    """
+    Returns ``True`` if an idle connection has been closed by the server. An
+    idle connection should have nothing to read, so if it is readable, it has
+    either reached EOF or received something we can't use.
+    """
+    if conn.sock is None:
+        return True
+
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+
+    return bool(readable)
+
+
+def uses_proxy(url):
+    """
+    Returns ``True`` if the environment configures a proxy for this URL, in
+    which case the request should go through :mod:`urllib.request` instead of a
+    pool.
+    """
+    parts = urlsplit(url)
+
+    return (parts.scheme in getproxies()) and not proxy_bypass(parts.hostname)
+
+
+def fetch(url, timeout=None, trace=NULL_TRACE):
+    """
+    Sends a GET request with :func:`urllib.request.urlopen`, on a new
+    connection, and returns the response body.
+
+    :raises: :exc:`urllib.error.HTTPError` for an error response.
+    """
+    kwargs = {} if (timeout is None) else {'timeout': timeout}
+    stream = urlopen(url, **kwargs)
+    trace.mark('wait')
+
+    try:
+        body = stream.read()
+        trace.mark('read')
+    finally:
+        stream.close()
+
+    return body
@@ -0,0 +1,259 @@
+"""
+An asyncio implementation of the server side of the Yubico validation
+protocol, version 2.0. Tokens are verified locally by a
+:class:`~yubiotp.validator.Validator`, so this can stand in for YubiCloud in
+development and load testing.
+
+>>> from binascii import unhexlify
+>>> from yubiotp.keystore import MemoryKeyStore
+>>> from yubiotp.validator import Validator
+>>> store = MemoryKeyStore()
+>>> store.add(b'cclngiuv', b'0123456789abcdef', unhexlify(b'0123456789ab'))
+>>> server = ValidationServer(Validator(store), clients={'1': b'secret'})
+>>> query = 'id=1&otp=cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl&nonce=0123456789abcdef'
+>>> fields = dict(server.verify(query))
+>>> fields['status'], fields['nonce']
+('OK', '0123456789abcdef')
+>>> dict(server.verify(query))['status']
+'REPLAYED_OTP'
+>>> dict(server.verify('id=2&otp=x&nonce=0123456789abcdef'))['status']
+'NO_SUCH_CLIENT'
+>>> dict(server.verify('id=1&nonce=0123456789abcdef'))['status']
+'MISSING_PARAMETER'
+"""
+
+import asyncio
+from base64 import b64decode, b64encode
+import binascii
+from datetime import datetime, timezone
+import hmac
+import re
+from urllib.parse import parse_qsl, urlsplit
+
+from .client import param_signature
+from .validator import OK
+
+__all__ = ['ValidationServer']
+
+
+class ValidationServer(object):
+    """
+    A Yubico validation server, protocol version 2.0.
+
+    :param validator: Verifies tokens and tracks device counters.
+    :type validator: :class:`~yubiotp.validator.Validator`
+    :param dict clients: Maps API ids (as strings) to raw API keys. Requests
+        are signed and checked with the client's key; a key of ``None``
+        disables signing for that client. If this is ``None``, any id is
+        accepted and nothing is signed.
+    :param str path: The URL path of the verify endpoint.
+    """
+
+    def __init__(self, validator, clients=None, path='/wsapi/2.0/verify'):
+        self.validator = validator
+        self.clients = clients
+        self.path = path
+
+    def verify(self, query):
+        """
+        Handles a single verify request.
+
+        :param str query: The URL query string.
+
+        :returns: The response fields, in order, including the signature.
+        :rtype: list of 2-tuples
+        """
+        params = dict(parse_qsl(query, keep_blank_values=True))
+        api_key = None
+
+        if (self.clients is not None) and ('id' in params):
+            if params['id'] not in self.clients:
+                return self._response(params, None, 'NO_SUCH_CLIENT')
+            api_key = self.clients[params['id']]
+
+        if (api_key is not None) and ('h' in params):
+            if not self._is_signature_valid(params, api_key):
+                return self._response(params, api_key, 'BAD_SIGNATURE')
+
+        if not self._has_required_params(params):
+            return self._response(params, api_key, 'MISSING_PARAMETER')
+
+        token = params['otp']
+        if not (32 <= len(token) <= 48):
+            return self._response(params, api_key, 'BAD_OTP')
+
+        status, otp = self.validator.verify(token.encode('ascii', 'replace'))
+
+        extra = []
+        if (status == OK) and (params.get('timestamp') == '1'):
+            extra = [
+                ('timestamp', otp.timestamp),
+                ('sessioncounter', otp.session),
+                ('sessionuse', otp.counter),
+            ]
+
+        return self._response(params, api_key, status, extra)
+
+    async def start(self, host='127.0.0.1', port=8000, **kwargs):
+        """
+        Starts listening for HTTP connections.
+
+        :returns: The listening server. Call ``serve_forever()`` or ``close()``
+            on it as needed.
+        :rtype: :class:`asyncio.Server`
+        """
+        return await asyncio.start_server(self.handle_connection, host, port, **kwargs)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves HTTP/1.1 requests on a single connection, with keep-alive.
+        """
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+
+                method, target, version, headers = request
+                status, body = self._dispatch(method, target)
+                keep_alive = self._keep_alive(version, headers)
+
+                writer.write(self._render(status, body, version, keep_alive))
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (
+            ConnectionError,
+            ValueError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    #
+    # Protocol
+    #
+
+    _NONCE_RE = re.compile(r'^[A-Za-z0-9]{16,40}$')
+
+    def _has_required_params(self, params):
+        if not all(params.get(name) for name in ['id', 'otp', 'nonce']):
+            return False
+
+        if not self._NONCE_RE.match(params['nonce']):
+            return False
+
+        for name in ['sl', 'timeout']:
+            if (name in params) and not params[name].isdigit():
+                return False
+
+        return True
+
+    def _is_signature_valid(self, params, api_key):
+        try:
+            signature = b64decode(params['h'].encode(), validate=True)
+        except (binascii.Error, ValueError):
+            return False
+
+        unsigned = [(k, v) for k, v in params.items() if k != 'h']
+        expected = param_signature(unsigned, api_key)
+
+        return hmac.compare_digest(signature, expected)
+
+    def _response(self, params, api_key, status, extra=()):
+        fields = [('t', self._timestamp())]
+
+        if 'otp' in params:
+            fields.append(('otp', params['otp']))
+
+        if 'nonce' in params:
+            fields.append(('nonce', params['nonce']))
+
+        if (status == OK) and ('sl' in params):
+            fields.append(('sl', 100))
+
+        fields.extend(extra)
+        fields.append(('status', status))
+
+        if api_key is not None:
+            signature = b64encode(param_signature(fields, api_key)).decode()
+            fields.insert(0, ('h', signature))
+
+        return fields
+
+    @staticmethod
+    def _timestamp():
+        now = datetime.now(timezone.utc)
+
+        return '{0}Z0{1:03d}'.format(
+            now.strftime('%Y-%m-%dT%H:%M:%S'), now.microsecond // 1000
+        )
+
+    #
+    # HTTP
+    #
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line.strip():
+            return None
+
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise ValueError('Malformed request line')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', '0') or '0')
+        if length > 0:
+            await reader.readexactly(length)
+
+        return (method, target, version, headers)
+
+    def _dispatch(self, method, target):
+        if method != 'GET':
+            return ('405 Method Not Allowed', '')
+
+        url = urlsplit(target)
+        if url.path != self.path:
+            return ('404 Not Found', '')
+
+        fields = self.verify(url.query)
+        body = ''.join('{0}={1}\r\n'.format(k, v) for k, v in fields) + '\r\n'
+
+        return ('200 OK', body)
+
+    @staticmethod
+    def _keep_alive(version, headers):
+        connection = headers.get('connection', '').lower()
+
+        if version == 'HTTP/1.1':
+            return connection != 'close'
+        else:
+            return connection == 'keep-alive'
+
+    @staticmethod
+    def _render(status, body, version, keep_alive):
+        body = body.encode('utf-8')
+        head = '\r\n'.join(
+            [
+                '{0} {1}'.format(version, status),
+                'Content-Type: text/plain; charset=utf-8',
+                'Content-Length: {0}'.format(len(body)),
+                'Connection: {0}'.format('keep-alive' if keep_alive else 'close'),
+                '',
+                '',
+            ]
+        )
+
+        return head.encode('latin-1') + body
@@ -1,7 +1,35 @@
+import asyncio
+from base64 import b64encode
+from binascii import unhexlify
+from contextlib import redirect_stderr, redirect_stdout
+import copy
 from doctest import DocTestSuite
+import http.client
+import io
+import json
+import os
+import pickle
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
 
-from . import crc, modhex, otp
+from . import aioclient, bench
+from . import client as validation_client
+from . import crc, keystore, metrics, modhex, otp, pool, server, validator
+from .cli import devicestore
+from .cli import yubiclient as yubiclient_cli
+from .cli import yubikey as yubikey_cli
+from .cli import yubiserver as yubiserver_cli
+
+try:
+    from . import batch
+except ImportError:
+    batch = None
 
 
 def load_tests(loader, tests, pattern):
@@ -11,5 +39,1211 @@ def load_tests(loader, tests, pattern):
     suite.addTest(DocTestSuite(crc))
     suite.addTest(DocTestSuite(modhex))
     suite.addTest(DocTestSuite(otp))
+    suite.addTest(DocTestSuite(keystore))
+    suite.addTest(DocTestSuite(validator))
+    suite.addTest(DocTestSuite(server))
+    suite.addTest(DocTestSuite(validation_client))
+    suite.addTest(DocTestSuite(aioclient))
+    suite.addTest(DocTestSuite(metrics))
+    suite.addTest(DocTestSuite(bench))
+    if batch is not None:
+        suite.addTest(DocTestSuite(batch))
 
     return suite
+
+
+class YubiKeyTestCase(unittest.TestCase):
+    key = b'0123456789abcdef'
+
+    def make_yubikey(self, session=0, seed=1):
+        return otp.YubiKey(b'\x00' * 6, session, clock=otp.VirtualClock(), seed=seed)
+
+    def test_reproducible(self):
+        tokens1 = self.make_yubikey().encode_many(10, self.key)
+        tokens2 = self.make_yubikey().encode_many(10, self.key)
+        tokens3 = self.make_yubikey(seed=2).encode_many(10, self.key)
+
+        self.assertEqual(tokens1, tokens2)
+        self.assertNotEqual(tokens1, tokens3)
+
+    def test_matches_generate(self):
+        yubikey1 = self.make_yubikey()
+        yubikey2 = self.make_yubikey()
+
+        self.assertEqual(
+            yubikey1.generate_many(600), [yubikey2.generate() for i in range(600)]
+        )
+        self.assertEqual((yubikey1.session, yubikey1.counter), (2, 88))
+
+    def test_session_limit(self):
+        yubikey = self.make_yubikey(session=0x7FFF)
+        otps = yubikey.generate_many(300)
+
+        self.assertEqual({o.session for o in otps}, {0x7FFF})
+        self.assertEqual(otps[256].counter, 0)
+
+    def test_fast_forward(self):
+        yubikey = self.make_yubikey()
+        start = yubikey.generate().timestamp
+        yubikey.clock.advance(86400 * 90)
+
+        ticks = (yubikey.generate().timestamp - start) % 0x1000000
+        self.assertEqual(ticks, (86400 * 90 * 8) % 0x1000000)
+
+    def test_timestamp_wraps_at_24_bits(self):
+        yubikey = self.make_yubikey()
+        yubikey._timestamp_base = 0xFFFFFF
+
+        self.assertEqual(yubikey.generate().timestamp, 0xFFFFFF)
+        yubikey.clock.advance(0.125)
+        self.assertEqual(yubikey.generate().timestamp, 0)
+
+
+class OTPTestCase(unittest.TestCase):
+    def setUp(self):
+        self.otp = otp.OTP(b'\x01\x02\x03\x04\x05\x06', 5, 0xABCDEF, 7, 0x1234)
+
+    def test_pack_into_round_trip(self):
+        otps = [self.otp, otp.OTP(b'\xff' * 6, 0x7FFF, 0, 0xFF, 0xFFFF)]
+        buf = bytearray(3 + otp.OTP.size * len(otps))
+        for index, o in enumerate(otps):
+            o.pack_into(buf, 3 + index * otp.OTP.size)
+
+        unpacked = [
+            otp.OTP.unpack_from(buf, 3 + index * otp.OTP.size)
+            for index in range(len(otps))
+        ]
+        self.assertEqual(unpacked, otps)
+        self.assertEqual(otp.OTP.unpack(self.otp.pack()), self.otp)
+
+    def test_unpack_from_errors(self):
+        buf = bytearray(otp.OTP.size + 1)
+        self.otp.pack_into(buf, 1)
+
+        with self.assertRaises(ValueError):
+            otp.OTP.unpack_from(buf, 2)
+        with self.assertRaises(ValueError):
+            otp.OTP.unpack_from(buf, -1)
+
+        buf[5] ^= 1
+        with self.assertRaises(otp.CRCError):
+            otp.OTP.unpack_from(buf, 1)
+
+    def test_hash(self):
+        copy = otp.OTP(self.otp.uid, 5, 0xABCDEF, 7, 0x1234)
+        fields = (self.otp.uid, 5, 0xABCDEF, 7, 0x1234)
+
+        self.assertEqual(copy, self.otp)
+        self.assertEqual(hash(copy), hash(self.otp))
+        self.assertNotEqual(hash(self.otp), hash(fields))
+        self.assertEqual(len({self.otp, copy, fields}), 2)
+        self.assertNotEqual(self.otp, fields)
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.otp.counter = 1
+        with self.assertRaises(AttributeError):
+            self.otp.extra = 1
+        with self.assertRaises(AttributeError):
+            del self.otp.uid
+        self.assertFalse(hasattr(self.otp, '__dict__'))
+
+    def test_pickle(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.otp)), self.otp)
+        self.assertEqual(copy.copy(self.otp), self.otp)
+
+    def test_not_a_sequence(self):
+        other = otp.OTP(b'\x01\x02\x03\x04\x05\x06', 5, 0xABCDEF, 8, 0x1234)
+
+        for op in [
+            lambda: len(self.otp),
+            lambda: list(self.otp),
+            lambda: self.otp[0],
+            lambda: 5 in self.otp,
+            lambda: self.otp < other,
+            lambda: sorted([other, self.otp]),
+            lambda: self.otp + other,
+            lambda: (1,) + self.otp,
+            lambda: self.otp * 2,
+        ]:
+            with self.assertRaises(TypeError):
+                op()
+
+
+class ModhexTestCase(unittest.TestCase):
+    def test_text_input(self):
+        with self.assertRaisesRegex(ValueError, 'Illegal hex character'):
+            modhex.hex_to_modhex('69b6')
+        with self.assertRaisesRegex(ValueError, 'Illegal modhex character'):
+            modhex.modhex_to_hex('hknh')
+        with self.assertRaises(ValueError):
+            modhex.unmodhex('hknh')
+        with self.assertRaises(ValueError):
+            modhex.ModhexDecoder().decode('hknh')
+
+    def test_buffer_input(self):
+        self.assertEqual(modhex.modhex_to_hex(bytearray(b'hknh')), b'69b6')
+        self.assertEqual(modhex.hex_to_modhex(memoryview(b'69B6')), b'hknh')
+
+
+class CipherCacheTestCase(unittest.TestCase):
+    keys = [bytes([i]) * 16 for i in range(4)]
+
+    def test_eviction(self):
+        cache = otp.CipherCache(maxsize=2)
+        c0 = cache.get(self.keys[0])
+        cache.get(self.keys[1])
+
+        # Touching key 0 makes key 1 the least recently used.
+        self.assertIs(cache.get(self.keys[0]), c0)
+        cache.get(self.keys[2])
+
+        self.assertIs(cache.get(self.keys[0]), c0)
+        self.assertEqual(
+            cache.stats(),
+            {'hits': 2, 'misses': 3, 'evictions': 1, 'size': 2, 'maxsize': 2},
+        )
+
+        cache.get(self.keys[1])
+        self.assertEqual(cache.stats()['misses'], 4)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_clear(self):
+        cache = otp.CipherCache(maxsize=2)
+        for key in self.keys:
+            cache.get(key)
+        cache.clear()
+
+        self.assertEqual(
+            cache.stats(),
+            {'hits': 0, 'misses': 4, 'evictions': 2, 'size': 0, 'maxsize': 2},
+        )
+
+    def test_bad_maxsize(self):
+        with self.assertRaises(ValueError):
+            otp.CipherCache(maxsize=0)
+
+
+class DecodeMetricsTestCase(unittest.TestCase):
+    key = b'0123456789abcdef'
+    token = b'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl'
+
+    def setUp(self):
+        self.metrics = otp.DecodeMetrics()
+        self.previous = otp.set_decode_metrics(self.metrics)
+
+    def tearDown(self):
+        otp.set_decode_metrics(self.previous)
+
+    def test_decode_many(self):
+        items = [(self.token, self.key)] * 3
+        items.append((self.token, b'fedcba9876543210'))
+        items.append((self.token[:-2], self.key))
+        items.append((self.token[-30:], self.key))
+        items.append((self.token, b'short'))
+
+        otp.decode_otp_many(items)
+        otp.decode_otp(self.token, self.key)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['decoded'], 4)
+        self.assertEqual(
+            snapshot['errors'], {'key': 1, 'modhex': 0, 'length': 1, 'crc': 2}
+        )
+        self.assertEqual(snapshot['latency']['count'], 1)
+
+    def test_decode_many_bad_types(self):
+        items = [
+            (self.token, self.key),
+            (self.token.decode(), self.key),
+            (self.token, None),
+            (None, self.key),
+            (self.token, self.key.decode()),
+            (self.token, self.key),
+        ]
+
+        results = otp.decode_otp_many(items)
+
+        expected = otp.decode_otp(self.token, self.key)
+        self.assertEqual(results[0], expected)
+        self.assertEqual(results[-1], expected)
+        self.assertIsInstance(results[1], ValueError)
+        for result in results[2:5]:
+            self.assertIsInstance(result, TypeError)
+
+        errors = self.metrics.snapshot()['errors']
+        self.assertEqual((errors['key'], errors['modhex']), (1, 2))
+
+    def test_modhex_error(self):
+        with self.assertRaises(ValueError):
+            otp.decode_otp(self.token[:-1] + b'x', self.key)
+
+        self.assertEqual(self.metrics.snapshot()['errors']['modhex'], 1)
+
+    def test_uppercase_token(self):
+        # Upper case modhex decodes, so a short token is a length error.
+        with self.assertRaises(ValueError):
+            otp.decode_otp(self.token[-30:].upper(), self.key)
+
+        errors = self.metrics.snapshot()['errors']
+        self.assertEqual((errors['modhex'], errors['length']), (0, 1))
+
+    def test_prometheus_text(self):
+        for i in range(5):
+            otp.decode_otp(self.token, self.key)
+
+        lines = self.metrics.prometheus_text('test').splitlines()
+        self.assertIn('test_decoded_total 5', lines)
+        self.assertIn('test_decode_errors_total{reason="crc"} 0', lines)
+        self.assertIn('test_decrypt_seconds_bucket{le="+Inf"} 5', lines)
+        self.assertIn('test_decrypt_seconds_count 5', lines)
+
+        buckets = [
+            int(line.rsplit(' ', 1)[1])
+            for line in lines
+            if line.startswith('test_decrypt_seconds_bucket')
+        ]
+        self.assertEqual(buckets, sorted(buckets))
+
+
+class CorpusTestCase(unittest.TestCase):
+    def make_shards(self, jobs, **kwargs):
+        return [
+            yubikey_cli.CorpusShard(shard, jobs, 10, 500, **kwargs)
+            for shard in range(jobs)
+        ]
+
+    def test_corpus(self):
+        output = io.BytesIO()
+        manifests = yubikey_cli.write_corpus(self.make_shards(1, seed='1'), output)
+        tokens = output.getvalue().splitlines()
+
+        store = keystore.MemoryKeyStore()
+        for record in manifests[0]:
+            store.add(
+                record.public_id.encode(), unhexlify(record.key), unhexlify(record.uid)
+            )
+
+        results = [validator.Validator(store).verify(token)[0] for token in tokens]
+        self.assertEqual(results, [validator.OK] * 500)
+        self.assertEqual(len({token[:12] for token in tokens}), 10)
+
+    def test_parse_stream(self):
+        shard = self.make_shards(1, seed='1')[0]
+        lines = b''.join(shard.chunks()).splitlines(True)
+        keys = {
+            record.public_id.encode(): (record.name, unhexlify(record.key))
+            for record in shard.manifest()
+        }
+        lines[3] = lines[3].strip()[:-10] + b'cccccccccc\n'
+        lines.extend([b'\n', b'bogus\n'])
+
+        output, errors = io.StringIO(), io.StringIO()
+        writer = yubikey_cli.JSONLinesWriter(output, errors)
+        yubikey_cli.parse_stream(lines, keys, writer, batch_size=64)
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(len(results), 499)
+        self.assertEqual(results[0]['token'], lines[0].strip().decode())
+        self.assertEqual(results[0]['device'], keys[lines[0][:12]][0])
+
+        failures = [json.loads(line) for line in errors.getvalue().splitlines()]
+        self.assertEqual(
+            [failure['error'] for failure in failures],
+            ['OTP checksum is invalid', 'Unknown public_id'],
+        )
+
+        output, errors = io.StringIO(), io.StringIO()
+        writer = yubikey_cli.CSVWriter(output, errors)
+        yubikey_cli.parse_stream(lines[:1], keys, writer)
+        rows = output.getvalue().splitlines()
+        self.assertEqual(rows[0], ','.join(yubikey_cli.CSVWriter.FIELDS))
+        self.assertTrue(rows[1].startswith(lines[0].strip().decode() + ','))
+
+    def test_reproducible(self):
+        outputs = []
+        for i in range(2):
+            output = io.BytesIO()
+            yubikey_cli.write_corpus(self.make_shards(1, seed='1'), output)
+            outputs.append(output.getvalue())
+
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_derived_keys(self):
+        shard = self.make_shards(2, master_key=b'secret')[1]
+        same = self.make_shards(1, master_key=b'secret')[0]
+        other = self.make_shards(1, master_key=b'other')[0]
+
+        self.assertEqual(shard._secret(3), same._secret(3))
+        self.assertNotEqual(shard._secret(3), other._secret(3))
+
+
+class DeviceStoreTestCase(unittest.TestCase):
+    records = [
+        devicestore.DeviceRecord('0', 'cccccccccccb', '00' * 16, '11' * 6, 0),
+        devicestore.DeviceRecord('1', 'cccccccccccd', '22' * 16, '33' * 6, 5),
+    ]
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def open_store(self, filename):
+        store = devicestore.open_store(os.path.join(self.tmpdir, filename))
+        self.addCleanup(store.close)
+
+        return store
+
+    def check_store(self, store):
+        store.update(self.records)
+        self.assertEqual(list(store), self.records)
+        self.assertEqual(store.get('1'), self.records[1])
+        self.assertEqual(store.find('cccccccccccd'), self.records[1])
+        self.assertIsNone(store.get('2'))
+
+        self.assertEqual(store.reserve_session('1'), 5)
+        self.assertEqual(store.reserve_session('1'), 6)
+        store.update_session('1', 10)
+        store.update_session('1', 3)
+        self.assertEqual(store.get('1').session, 10)
+
+        with self.assertRaises(devicestore.DeviceExistsError):
+            store.add(self.records[0])
+        store.remove('0')
+        with self.assertRaises(devicestore.NoSuchDeviceError):
+            store.remove('0')
+
+    def test_config(self):
+        store = self.open_store('devices')
+        self.assertIsInstance(store, devicestore.ConfigDeviceStore)
+        self.check_store(store)
+
+    def test_sqlite(self):
+        store = self.open_store('devices.db')
+        self.assertIsInstance(store, devicestore.SQLiteDeviceStore)
+        self.check_store(store)
+
+        # A second connection sees committed changes and new reservations.
+        other = devicestore.SQLiteDeviceStore(store.path)
+        self.addCleanup(other.close)
+        self.assertEqual(other.reserve_session('1'), 10)
+        self.assertEqual(store.reserve_session('1'), 11)
+
+    def test_round_trip(self):
+        output = io.StringIO()
+        devicestore.write_config(self.records, output)
+        path = os.path.join(self.tmpdir, 'devices')
+        with open(path, 'w') as f:
+            f.write(output.getvalue())
+
+        self.assertEqual(devicestore.read_config(path), self.records)
+
+
+@unittest.skipIf(batch is None, 'NumPy is not installed')
+class OTPBatchTestCase(unittest.TestCase):
+    key = b'0123456789abcdef'
+
+    def test_matches_decode_otp(self):
+        yubikeys = [otp.YubiKey(os.urandom(6), session) for session in range(4)]
+        otps = [yubikey.generate() for i in range(50) for yubikey in yubikeys]
+        tokens = [otp.encode_otp(o, self.key, b'cclngiuv') for o in otps]
+        tokens[7] = otp.encode_otp(otps[7], b'fedcba9876543210', b'cclngiuv')
+
+        otp_batch = batch.OTPBatch.from_tokens(tokens, self.key)
+        crc_ok = otp_batch.check_crc()
+        expected = [
+            not isinstance(result, otp.CRCError)
+            for result in otp.decode_otp_many((token, self.key) for token in tokens)
+        ]
+        self.assertEqual(crc_ok.tolist(), expected)
+
+        valid = otp_batch.filter(crc_ok)
+        self.assertEqual(valid.to_otps(), otps[:7] + otps[8:])
+        self.assertEqual(
+            valid.timestamp.tolist(), [o.timestamp for o in valid.to_otps()]
+        )
+
+        ordered = valid.sorted().to_otps()
+        self.assertEqual(
+            ordered,
+            sorted(valid.to_otps(), key=lambda o: (o.uid, o.session, o.counter)),
+        )
+
+    def test_fields(self):
+        otps = [otp.OTP(b'\x01\x02\x03\x04\x05\x06', 1, 0xABCDEF, 2, 3)]
+        fields = batch.OTPBatch.from_otps(otps).fields()
+
+        self.assertEqual(fields.dtype, batch.OTP_DTYPE)
+        self.assertEqual(fields[0]['timestamp'], 0xABCDEF)
+        self.assertEqual(fields[0]['uid'], b'\x01\x02\x03\x04\x05\x06')
+
+    def test_bad_shape(self):
+        with self.assertRaises(ValueError):
+            batch.OTPBatch.from_buffer(b'\x00' * 17)
+
+
+class NonceTestCase(unittest.TestCase):
+    def test_unique(self):
+        client = validation_client.YubiClient20()
+        nonces = {client.nonce() for i in range(1000)}
+
+        self.assertEqual(len(nonces), 1000)
+        self.assertTrue(all(len(nonce) == 32 for nonce in nonces))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_fork(self):
+        client = validation_client.YubiClient20()
+        client.nonce()
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                os.write(write_fd, client.nonce().encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            child = f.read().decode()
+        os.waitpid(pid, 0)
+
+        self.assertEqual(len(child), 32)
+        self.assertNotEqual(child, client.nonce())
+
+
+class YubiResponseTestCase(unittest.TestCase):
+    api_key = b'0123456789abcdef0123'
+    token = 'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl'
+    nonce = 'abcdefghijklmnop'
+
+    def make_raw(self, **fields):
+        params = dict(
+            otp=self.token, nonce=self.nonce, status='OK', timestamp='1234', sl='x'
+        )
+        params.update(fields)
+        signature = validation_client.param_signature(params.items(), self.api_key)
+        params['h'] = b64encode(signature).decode()
+
+        return ''.join('{0}={1}\r\n'.format(k, v) for k, v in params.items())
+
+    def make_response(self, raw):
+        return validation_client.YubiResponse(raw, self.api_key, self.token, self.nonce)
+
+    def test_lazy_parse(self):
+        response = self.make_response(self.make_raw().encode())
+        self.assertIsNone(response._fields)
+
+        self.assertEqual(response.fields['status'], 'OK')
+        self.assertNotIn('h', response.fields)
+        self.assertEqual(len(response.signature), 20)
+        self.assertIsInstance(response.raw, str)
+
+    def test_typed_fields(self):
+        response = self.make_response(self.make_raw())
+
+        self.assertEqual(response.public_id, 'cclngiuv')
+        self.assertEqual(response.timestamp, 1234)
+        self.assertIsNone(response.sessioncounter)
+        self.assertIsNone(response.sl)
+
+    def test_checks_memoized(self):
+        response = self.make_response(self.make_raw())
+        self.assertTrue(response.is_ok())
+
+        with mock.patch.object(validation_client, 'param_signature') as signature:
+            self.assertTrue(response.is_ok())
+            self.assertTrue(response.is_signature_valid())
+            signature.assert_not_called()
+
+    def test_set_raw(self):
+        response = self.make_response(self.make_raw())
+        self.assertTrue(response.is_ok())
+
+        response.raw = self.make_raw(status='REPLAYED_OTP')
+        self.assertFalse(response.is_ok())
+        self.assertEqual(response.status(), 'REPLAYED_OTP')
+
+        response.raw = self.make_raw(nonce='wrong')
+        self.assertFalse(response.is_valid())
+        self.assertFalse(response.is_nonce_valid())
+
+    def test_set_fields(self):
+        response = self.make_response(self.make_raw())
+        self.assertTrue(response.is_ok())
+
+        response.fields = dict(response.fields, status='BAD_OTP')
+        self.assertFalse(response.is_signature_valid())
+        self.assertEqual(response.status(), 'BAD_RESPONSE')
+
+    def test_set_signature(self):
+        response = self.make_response(self.make_raw())
+        self.assertTrue(response.is_valid())
+
+        response.signature = b'\x00' * 20
+        self.assertFalse(response.is_valid())
+        self.assertEqual(response.fields['status'], 'OK')
+
+
+class LiveServerTestCase(unittest.TestCase):
+    """
+    Runs a local validation server on a background event loop.
+    """
+
+    api_key = b'secret'
+    key = b'0123456789abcdef'
+    uid = unhexlify(b'0123456789ab')
+    public_id = b'cclngiuv'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = server.ValidationServer(
+            validator.Validator(cls.make_keystore()), clients={'1': cls.api_key}
+        )
+
+        cls.loop = asyncio.new_event_loop()
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+        cls.listener = cls.run_async(cls.server.start('127.0.0.1', 0))
+        port = cls.listener.sockets[0].getsockname()[1]
+        cls.base_url = 'http://127.0.0.1:{0}/wsapi/2.0/verify'.format(port)
+
+        cls.yubikey = otp.YubiKey(cls.uid, 0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.listener.close()
+        cls.run_async(cls.listener.wait_closed())
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.loop.close()
+
+    @classmethod
+    def make_keystore(cls):
+        store = keystore.MemoryKeyStore()
+        store.add(cls.public_id, cls.key, cls.uid)
+
+        return store
+
+    @classmethod
+    def run_async(cls, coro):
+        return asyncio.run_coroutine_threadsafe(coro, cls.loop).result()
+
+    def gen_token(self):
+        return otp.encode_otp(
+            self.yubikey.generate(), self.key, self.public_id
+        ).decode()
+
+    def make_client(self):
+        client = validation_client.YubiClient20(1, self.api_key, timestamp=True)
+        client.base_url = self.base_url
+        self.addCleanup(client.close)
+
+        return client
+
+
+class RecordingObserver(metrics.ClientObserver):
+    def __init__(self, traces):
+        self.traces = traces
+
+    def request_finished(self, trace):
+        self.traces.append(trace)
+
+
+class RedirectingServer(object):
+    """
+    Redirects every request to another server and records the User-Agent.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.user_agents = []
+
+    async def handle_connection(self, reader, writer):
+        request_line = await reader.readline()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.lower() == 'user-agent':
+                self.user_agents.append(value.strip())
+
+        query = urlsplit(request_line.split()[1].decode('latin-1')).query
+        writer.write(
+            'HTTP/1.1 302 Found\r\nLocation: {0}?{1}\r\n'
+            'Content-Length: 0\r\nConnection: close\r\n\r\n'.format(
+                self.target, query
+            ).encode('latin-1')
+        )
+        await writer.drain()
+        writer.close()
+
+
+class ServerTestCase(LiveServerTestCase):
+    def test_verify(self):
+        client = self.make_client()
+        token = self.gen_token()
+
+        response = client.verify(token)
+        self.assertTrue(response.is_ok())
+        self.assertEqual(response.fields['sessionuse'], str(self.yubikey.counter - 1))
+
+        response = client.verify(token)
+        self.assertFalse(response.is_ok())
+        self.assertEqual(response.status(), 'REPLAYED_OTP')
+
+    def gen_tokens(self, count):
+        """
+        Generates one token from each of a number of new devices, since a
+        device's tokens are only accepted in order.
+        """
+        tokens = []
+        for i in range(count):
+            public_id = modhex.modhex(os.urandom(6))
+            self.server.validator.keystore.add(public_id, self.key, self.uid)
+            token = otp.encode_otp(self.yubikey.generate(), self.key, public_id)
+            tokens.append(token.decode())
+
+        return tokens
+
+    def test_verify_many(self):
+        client = self.make_client()
+        tokens = self.gen_tokens(20)
+        tokens.append(tokens[0])
+        tokens.append('bogus')
+
+        results = list(client.verify_many(tokens, max_workers=4))
+        self.assertEqual([token for token, result in results], tokens)
+        self.assertTrue(all(result.is_ok() for token, result in results[:20]))
+        self.assertEqual(results[-2][1].status(), 'REPLAYED_OTP')
+        self.assertEqual(results[-1][1].status(), 'BAD_OTP')
+
+    def test_verify_many_unordered(self):
+        client = self.make_client()
+        tokens = self.gen_tokens(20)
+
+        results = list(client.verify_many(iter(tokens), 4, ordered=False, window=5))
+        self.assertEqual(sorted(token for token, result in results), sorted(tokens))
+        self.assertTrue(all(result.is_ok() for token, result in results))
+
+    def test_verify_many_errors(self):
+        client = self.make_client()
+        client.base_url = 'http://127.0.0.1:1/wsapi/2.0/verify'
+
+        results = list(client.verify_many(['token'], max_workers=1))
+        self.assertEqual(results[0][0], 'token')
+        self.assertIsInstance(results[0][1], OSError)
+
+    def test_errors_raise_by_default(self):
+        client = self.make_client()
+        client.base_url = 'http://127.0.0.1:1/wsapi/2.0/verify'
+        traces = []
+        client.observers.append(RecordingObserver(traces))
+
+        for i in range(10):
+            with self.assertRaises(OSError):
+                client.verify('token')
+
+        self.assertEqual(traces[-1].status, 'ERROR')
+        self.assertEqual(traces[-1].base_url, client.base_url)
+
+    def test_circuit_breaker_v10(self):
+        client = validation_client.YubiClient10(1, self.api_key)
+        client.base_url = 'http://127.0.0.1:1/wsapi/2.0/verify'
+        client.failure_threshold = 2
+        self.addCleanup(client.close)
+
+        for i in range(2):
+            with self.assertRaises(OSError):
+                client.verify('token')
+
+        response = client.verify('token')
+        self.assertEqual(response.status(), 'CIRCUIT_OPEN')
+        self.assertEqual(client.server_stats()[client.base_url]['rejected'], 1)
+
+    def test_redirect(self):
+        redirector = RedirectingServer(self.base_url)
+        listener = self.run_async(
+            asyncio.start_server(redirector.handle_connection, '127.0.0.1', 0)
+        )
+        self.addCleanup(self.run_async, listener.wait_closed())
+        self.addCleanup(listener.close)
+
+        client = self.make_client()
+        client.base_url = 'http://127.0.0.1:{0}/wsapi/2.0/verify'.format(
+            listener.sockets[0].getsockname()[1]
+        )
+
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+        self.assertEqual(redirector.user_agents, [pool.USER_AGENT])
+
+    def test_close(self):
+        client = self.make_client()
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+        self.assertEqual(client.pool.stats()['idle'], 1)
+
+        client.close()
+        self.assertEqual(client.pool.stats()['idle'], 0)
+
+        # The client still works, but no longer keeps connections.
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+        self.assertEqual(client.pool.stats()['idle'], 0)
+
+    def test_cli_batch(self):
+        tokens = self.gen_tokens(10)
+        tokens.append(tokens[0])
+
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write('\n'.join(tokens[1:]) + '\n\n')
+            f.flush()
+
+            argv = ['yubiclient', '-u', self.base_url, '-i', '1', '-k']
+            argv += ['c2VjcmV0', '--input', f.name, '--concurrency', '4']
+            argv += ['--format', 'jsonl', tokens[0]]
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with mock.patch('sys.argv', argv), redirect_stdout(stdout):
+                with redirect_stderr(stderr), self.assertRaises(SystemExit) as cm:
+                    yubiclient_cli.main()
+
+        self.assertEqual(cm.exception.code, 2)
+
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(sorted(r['token'] for r in results), sorted(tokens))
+        self.assertEqual(sum(r['ok'] for r in results), 10)
+
+        summary = json.loads(stderr.getvalue().splitlines()[0])['summary']
+        self.assertEqual(summary['counts'], {'OK': 10, 'REPLAYED_OTP': 1})
+        self.assertEqual(summary['overall']['count'], 11)
+        self.assertEqual(list(summary['base_url']), [self.base_url])
+        self.assertIsNotNone(summary['overall']['p99'])
+
+    def test_cli_error(self):
+        argv = ['yubiclient', '-u', 'http://127.0.0.1:1/wsapi/2.0/verify']
+        argv += ['--format', 'jsonl', self.gen_token()]
+        stdout = io.StringIO()
+        with mock.patch('sys.argv', argv), redirect_stdout(stdout):
+            with self.assertRaises(SystemExit) as cm:
+                yubiclient_cli.main()
+
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(json.loads(stdout.getvalue())['status'], 'ERROR')
+
+    def test_replay_cache(self):
+        client = self.make_client()
+        client.replay_cache = validation_client.ReplayCache()
+        token = self.gen_token()
+
+        self.assertTrue(client.verify(token).is_ok())
+        response = client.verify(token)
+        self.assertIsInstance(response, validation_client.LocalResponse)
+        self.assertEqual(response.status(), 'REPLAYED_OTP')
+        self.assertEqual(client.pool.stats()['requests'], 1)
+
+        # Rejected tokens are not remembered.
+        client.verify('bogus')
+        client.verify('bogus')
+        self.assertEqual(client.pool.stats()['requests'], 3)
+        self.assertEqual(len(client.replay_cache), 1)
+
+    def test_keep_alive(self):
+        client = self.make_client()
+
+        for i in range(3):
+            self.assertTrue(client.verify(self.gen_token()).is_ok())
+
+        stats = client.pool.stats()
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused'], 2)
+
+    def test_reconnect(self):
+        client = self.make_client()
+        client.verify(self.gen_token())
+
+        # Simulate the server dropping the idle connection.
+        for connections in client.pool._idle.values():
+            for conn, released in connections:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+        self.assertEqual(client.pool.stats()['connections'], 2)
+        self.assertEqual(client.pool.stats()['reconnects'], 1)
+
+    def test_retry_unsent_request(self):
+        client = self.make_client()
+        client.verify(self.gen_token())
+        request = http.client.HTTPConnection.request
+        calls = []
+
+        def fail_once(conn, *args, **kwargs):
+            calls.append(conn)
+            if len(calls) == 1:
+                raise BrokenPipeError()
+            return request(conn, *args, **kwargs)
+
+        with mock.patch.object(http.client.HTTPConnection, 'request', fail_once):
+            self.assertTrue(client.verify(self.gen_token()).is_ok())
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(client.pool.stats()['reconnects'], 1)
+
+    def test_no_retry_after_send(self):
+        client = self.make_client()
+        client.verify(self.gen_token())
+
+        # The request went out, so the server may have used the token.
+        with mock.patch.object(
+            http.client.HTTPConnection,
+            'getresponse',
+            side_effect=http.client.RemoteDisconnected(),
+        ):
+            with self.assertRaises(http.client.RemoteDisconnected):
+                client.verify(self.gen_token())
+
+        stats = client.pool.stats()
+        self.assertEqual((stats['connections'], stats['reconnects']), (1, 0))
+
+    def test_no_pool(self):
+        client = self.make_client()
+        client.pool = None
+
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+
+    def test_observers(self):
+        client = self.make_client()
+        collector = metrics.LatencyCollector()
+        traces = []
+        client.observers = [collector, RecordingObserver(traces)]
+
+        token = self.gen_token()
+        client.verify(token)
+        client.verify(token)
+
+        self.assertEqual([trace.status for trace in traces], ['OK', 'REPLAYED_OTP'])
+        phases = [phase for phase, timestamp in traces[0].marks]
+        self.assertEqual(
+            phases,
+            [
+                'start',
+                'nonce',
+                'url',
+                'connect',
+                'request',
+                'wait',
+                'read',
+                'parse',
+                'validate',
+            ],
+        )
+
+        snapshot = collector.snapshot()
+        self.assertEqual(snapshot['status']['OK']['count'], 1)
+        self.assertEqual(snapshot['base_url'][self.base_url]['count'], 2)
+
+    def test_bad_signature(self):
+        client = self.make_client()
+        client.api_key = b'wrong'
+
+        response = client.verify(self.gen_token())
+        self.assertEqual(response.fields['status'], 'BAD_SIGNATURE')
+
+
+class SQLiteServerTestCase(LiveServerTestCase):
+    """
+    Serves the devices in an SQLite store, as written by yubikey corpus.
+    """
+
+    @classmethod
+    def make_keystore(cls):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'devices.db')
+            devices = devicestore.SQLiteDeviceStore(path)
+            devices.add(
+                devicestore.DeviceRecord(
+                    'test', cls.public_id.decode(), cls.key.hex(), cls.uid.hex(), 0
+                )
+            )
+            devices.add(devicestore.DeviceRecord('bad', 'cccccccccccb', 'xx', '', 0))
+            devices.close()
+
+            store = keystore.MemoryKeyStore()
+            with redirect_stderr(io.StringIO()) as stderr:
+                yubiserver_cli.load_devices(path, store)
+
+        cls.load_errors = stderr.getvalue()
+
+        return store
+
+    def test_verify(self):
+        response = self.make_client().verify(self.gen_token())
+        self.assertTrue(response.is_ok())
+
+    def test_bad_device_skipped(self):
+        self.assertTrue(self.load_errors.startswith('Skipping bad:'))
+        self.assertEqual(len(self.server.validator.keystore), 1)
+
+
+class AsyncClientTestCase(LiveServerTestCase):
+    def make_client(self):
+        client = aioclient.AsyncYubiClient20(1, self.api_key)
+        client.base_url = self.base_url
+
+        return client
+
+    def test_verify(self):
+        client = self.make_client()
+        token = self.gen_token()
+
+        response = self.run_async(client.verify(token, timeout=5))
+        self.assertTrue(response.is_ok())
+
+    def test_verify_many(self):
+        client = self.make_client()
+        tokens = [self.gen_token() for i in range(20)]
+
+        responses = self.run_async(client.verify_many(tokens + tokens[:1], 4, 5))
+        self.assertTrue(all(response.is_ok() for response in responses[:-1]))
+        self.assertEqual(responses[-1].status(), 'REPLAYED_OTP')
+
+    def test_observers(self):
+        client = self.make_client()
+        traces = []
+        client.observers.append(RecordingObserver(traces))
+
+        self.run_async(client.verify(self.gen_token(), timeout=5))
+
+        self.assertEqual(len(traces), 1)
+        self.assertEqual((traces[0].status, traces[0].base_url), ('OK', self.base_url))
+        self.assertEqual(
+            [phase for phase, t in traces[0].marks],
+            [
+                'start',
+                'nonce',
+                'url',
+                'connect',
+                'request',
+                'wait',
+                'read',
+                'parse',
+                'validate',
+            ],
+        )
+
+    def test_circuit_breaker(self):
+        client = self.make_client()
+        client.base_url = 'http://127.0.0.1:1/wsapi/2.0/verify'
+        client.failure_threshold = 1
+
+        with self.assertRaises(OSError):
+            self.run_async(client.verify(self.gen_token(), timeout=5))
+
+        response = self.run_async(client.verify(self.gen_token(), timeout=5))
+        self.assertEqual(response.status(), 'CIRCUIT_OPEN')
+
+        stats = client.server_stats()[client.base_url]
+        self.assertEqual((stats['errors'], stats['rejected']), (1, 1))
+
+    def test_no_hedging(self):
+        client = self.make_client()
+
+        self.assertEqual(client.base_urls, [self.base_url])
+        with self.assertRaises(NotImplementedError):
+            client.base_urls = [self.base_url, self.base_url]
+
+    def test_ssl_context_reused(self):
+        client = self.make_client()
+
+        self.assertIsNone(client._get_ssl_context(self.base_url))
+        with mock.patch('ssl.create_default_context') as create:
+            context = client._get_ssl_context('https://127.0.0.1/verify')
+            self.assertIs(client._get_ssl_context('https://127.0.0.1/verify'), context)
+            create.assert_called_once_with()
+
+    def test_not_found(self):
+        client = self.make_client()
+        client.base_url = self.base_url + '/bogus'
+
+        with self.assertRaises(HTTPError):
+            self.run_async(client.verify(self.gen_token(), timeout=5))
+
+
+class DelayedWriter(object):
+    """
+    Holds back a stream writer's output for a while after each drain.
+    """
+
+    def __init__(self, writer, delay):
+        self.writer = writer
+        self.delay = delay
+        self.buffer = []
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    async def drain(self):
+        await asyncio.sleep(self.delay)
+        self.writer.write(b''.join(self.buffer))
+        self.buffer = []
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class SlowValidationServer(server.ValidationServer):
+    """
+    Verifies tokens as soon as they arrive, but answers late.
+    """
+
+    delay = 0.3
+
+    async def handle_connection(self, reader, writer):
+        await super().handle_connection(reader, DelayedWriter(writer, self.delay))
+
+
+class LateValidationServer(server.ValidationServer):
+    """
+    Waits a while before reading each request.
+    """
+
+    delay = 0.3
+
+    async def handle_connection(self, reader, writer):
+        await asyncio.sleep(self.delay)
+        await super().handle_connection(reader, writer)
+
+
+class HedgeTestCase(LiveServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.listeners = []
+        cls.slow_url = cls.start_peer(SlowValidationServer)
+        cls.late_url = cls.start_peer(LateValidationServer)
+        cls.wrong_key_url = cls.start_peer(
+            server.ValidationServer, clients={'1': b'wrong'}
+        )
+
+    @classmethod
+    def start_peer(cls, server_class, clients=None):
+        if clients is None:
+            clients = cls.server.clients
+        peer = server_class(cls.server.validator, clients)
+        listener = cls.run_async(peer.start('127.0.0.1', 0))
+        cls.listeners.append(listener)
+        port = listener.sockets[0].getsockname()[1]
+
+        return 'http://127.0.0.1:{0}/wsapi/2.0/verify'.format(port)
+
+    @classmethod
+    def tearDownClass(cls):
+        for listener in cls.listeners:
+            listener.close()
+            cls.run_async(listener.wait_closed())
+
+        super().tearDownClass()
+
+    def make_client(self, base_urls):
+        client = super().make_client()
+        client.base_urls = base_urls
+        client.hedge_delay = 0.05
+
+        return client
+
+    def test_fast_hedge_wins(self):
+        client = self.make_client([self.late_url, self.base_url])
+
+        response = client.verify(self.gen_token())
+        self.assertTrue(response.is_ok())
+
+        stats = client.server_stats()
+        self.assertEqual(stats[self.base_url]['wins'], 1)
+        self.assertEqual(stats[self.late_url]['wins'], 0)
+
+    def test_losing_connection_discarded(self):
+        client = self.make_client([self.late_url, self.base_url])
+
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+
+        executor = client._hedge_executor
+        self.assertEqual(executor._max_workers, client.max_hedge_workers)
+
+        # Wait for the losing request to finish on the shared executor.
+        deadline = time.monotonic() + 2
+        while client.server_stats()[self.late_url]['discarded'] == 0:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+        # Only the winner's connection went back to the pool.
+        self.assertEqual(client.pool.stats()['idle'], 1)
+
+    def test_replay_from_hedge_is_held(self):
+        # The slow server accepts the token first; the fast hedge then sees
+        # a replay, which must not beat the slow server's OK.
+        client = self.make_client([self.slow_url, self.base_url])
+        client.hedge_delay = 0.1
+
+        response = client.verify(self.gen_token())
+        self.assertTrue(response.is_ok())
+        self.assertEqual(client.server_stats()[self.slow_url]['wins'], 1)
+
+    def test_invalid_response_fails_over(self):
+        client = self.make_client([self.wrong_key_url, self.base_url])
+        client.hedge_delay = 5
+
+        response = client.verify(self.gen_token())
+        self.assertTrue(response.is_ok())
+        self.assertEqual(client.server_stats()[self.base_url]['wins'], 1)
+
+    def test_failover(self):
+        client = self.make_client(
+            ['http://127.0.0.1:1/wsapi/2.0/verify', self.base_url]
+        )
+
+        response = client.verify(self.gen_token())
+        self.assertTrue(response.is_ok())
+        self.assertEqual(client.server_stats()[self.base_url]['wins'], 1)
+
+    def test_circuit_breaker(self):
+        dead_url = 'http://127.0.0.1:1/wsapi/2.0/verify'
+        client = self.make_client([dead_url, self.base_url])
+        client.failure_threshold = 1
+
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+        self.assertEqual(client.server_stats()[dead_url]['state'], 'open')
+
+        # The open server is no longer tried.
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+        self.assertEqual(client.server_stats()[dead_url]['requests'], 1)
+
+    def test_circuit_open(self):
+        client = super().make_client()
+        client.failure_threshold = 1
+        client._get_server_stats(self.base_url).record(0.0, error=True, threshold=1)
+
+        response = client.verify(self.gen_token())
+        self.assertIsInstance(response, validation_client.LocalResponse)
+        self.assertEqual(response.status(), 'CIRCUIT_OPEN')
+        self.assertEqual(client.pool.stats()['requests'], 0)
+        self.assertEqual(client.server_stats()[self.base_url]['rejected'], 1)
+
+        # After the reset timeout, a probe closes the circuit.
+        client.reset_timeout = 0
+        self.assertTrue(client.verify(self.gen_token()).is_ok())
+        self.assertEqual(client.server_stats()[self.base_url]['state'], 'closed')
+
+    def test_adaptive_timeout(self):
+        client = super().make_client()
+        client.adaptive_timeout = True
+        client.verify(self.gen_token())
+        self.assertEqual(client.server_stats()[self.base_url]['timeout'], 2.0)
+
+        client.timeout = 1
+        self.assertEqual(client.server_stats()[self.base_url]['timeout'], 1.0)
+
+        client.adaptive_timeout = False
+        client.timeout = None
+        self.assertIsNone(client.server_stats()[self.base_url]['timeout'])
@@ -0,0 +1,166 @@
+"""
+Local token validation with replay protection. A :class:`Validator` combines a
+:class:`~yubiotp.keystore.KeyStore` with a :class:`CounterStore` that remembers
+the last (session, counter) pair accepted from each device. Results are
+reported with the same status strings as the Yubico validation service.
+
+>>> from binascii import unhexlify
+>>> from yubiotp.keystore import MemoryKeyStore
+>>> store = MemoryKeyStore()
+>>> store.add(b'cclngiuv', b'0123456789abcdef', unhexlify(b'0123456789ab'))
+>>> validator = Validator(store)
+>>> token = b'cclngiuvttkhthcilurtkerbjnnkljfkjccklkhl'
+>>> validator.verify(token)[0]
+'OK'
+>>> validator.verify(token)[0]
+'REPLAYED_OTP'
+>>> validator.verify(b'cclngiuvcccccccccccccccccccccccccccccccc')
+('BAD_OTP', None)
+"""
+
+import threading
+
+from .keystore import KeyStore
+
+__all__ = [
+    'Validator',
+    'CounterStore',
+    'MemoryCounterStore',
+    'OK',
+    'REPLAYED_OTP',
+    'BAD_OTP',
+]
+
+
+OK = 'OK'
+REPLAYED_OTP = 'REPLAYED_OTP'
+BAD_OTP = 'BAD_OTP'
+
+
+class CounterStore(object):
+    """
+    Abstract interface to per-device usage counters.
+    """
+
+    def check_and_update(self, public_id, session, counter):
+        """
+        Atomically records a device's usage counters if they are strictly
+        greater than the last ones recorded.
+
+        :param bytes public_id: The modhex-encoded public ID.
+        :param int session: The non-volatile usage counter from the OTP.
+        :param int counter: The volatile usage counter from the OTP.
+
+        :returns: ``True`` if the counters were accepted; ``False`` if they
+            represent a replay.
+        :rtype: bool
+        """
+        raise NotImplementedError()
+
+
+class MemoryCounterStore(CounterStore):
+    """
+    An in-memory :class:`CounterStore`. Devices are spread over a number of
+    independently locked shards according to their public ID, so threads
+    verifying tokens from different devices rarely contend.
+
+    :param int stripes: The number of shards.
+
+    >>> counters = MemoryCounterStore(stripes=4)
+    >>> counters.check_and_update(b'cccccccb', 1, 5)
+    True
+    >>> counters.check_and_update(b'cccccccb', 1, 5)
+    False
+    >>> counters.check_and_update(b'cccccccb', 2, 0)
+    True
+    >>> counters.get(b'cccccccb')
+    (2, 0)
+    """
+
+    def __init__(self, stripes=64):
+        if stripes < 1:
+            raise ValueError('stripes must be at least 1')
+
+        self.stripes = stripes
+
+        self._shards = [{} for i in range(stripes)]
+        self._locks = [threading.Lock() for i in range(stripes)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def check_and_update(self, public_id, session, counter):
+        stripe = hash(public_id) % self.stripes
+        shard = self._shards[stripe]
+        usage = (session, counter)
+
+        with self._locks[stripe]:
+            last = shard.get(public_id)
+            if (last is not None) and (usage <= last):
+                return False
+
+            shard[public_id] = usage
+
+        return True
+
+    def get(self, public_id):
+        """
+        Returns the last accepted (session, counter) pair for a device, or
+        ``None``.
+        """
+        stripe = hash(public_id) % self.stripes
+
+        with self._locks[stripe]:
+            return self._shards[stripe].get(public_id)
+
+    def set(self, public_id, session, counter):
+        """
+        Unconditionally sets a device's counters. Use this to load persisted
+        state.
+        """
+        stripe = hash(public_id) % self.stripes
+
+        with self._locks[stripe]:
+            self._shards[stripe][public_id] = (session, counter)
+
+
+class Validator(object):
+    """
+    Verifies tokens locally and rejects replays.
+
+    :param keystore: The source of device keys.
+    :type keystore: :class:`~yubiotp.keystore.KeyStore`
+    :param counters: The device counter state. Defaults to a new
+        :class:`MemoryCounterStore`.
+    :type counters: :class:`CounterStore`
+    """
+
+    def __init__(self, keystore, counters=None):
+        if not isinstance(keystore, KeyStore):
+            raise TypeError('keystore must be a KeyStore')
+
+        self.keystore = keystore
+        self.counters = counters if (counters is not None) else MemoryCounterStore()
+
+    def verify(self, token):
+        """
+        Verifies a single token.
+
+        :param bytes token: A modhex-encoded token, including the public ID.
+
+        :returns: A status (:data:`OK`, :data:`REPLAYED_OTP`, or
+            :data:`BAD_OTP`) and the decoded OTP, if the token could be
+            decrypted.
+        :rtype: (str, :class:`~yubiotp.otp.OTP` or ``None``)
+        """
+        try:
+            public_id, otp = self.keystore.verify_token(token)
+        except ValueError:
+            return (BAD_OTP, None)
+
+        if self.counters.check_and_update(public_id, otp.session, otp.counter):
+            status = OK
+        else:
+            status = REPLAYED_OTP
+
+        return (status, otp)